@@ -1,5 +1,4 @@
 import os
-from subprocess import Popen, PIPE
 from fassembler.tasks import Task
 
 class CheckApache(Task):
@@ -68,7 +67,7 @@ class ApacheMixin(object):
         return required_modules
 
     def compiled_in_modules(self):
-        return set(Popen([self.apache_exec(), "-l"], stdout=PIPE).communicate()[0].split()[3:])
+        return set(self.maker.probe([self.apache_exec(), "-l"])[0].split()[3:])
 
     def extra_modules(self):
         required_modules = list(self.required_modules)
@@ -125,7 +124,7 @@ class ApacheMixin(object):
 
     def apache_version(self):
         "Returns a pair of integers [major, minor]"
-        major, minor, _ = Popen([self.apache_exec(), "-v"], stdout=PIPE).communicate()[0].split()[2].split('/')[1].split('.')
+        major, minor, _ = self.maker.probe([self.apache_exec(), "-v"])[0].split()[2].split('/')[1].split('.')
         return [int(i) for i in (major, minor)]
 
     def apache_fg_flag(self):
@@ -142,7 +141,7 @@ class ApacheMixin(object):
 
     def php_version(self):
         "Returns major as a string"
-        return Popen([self.php_cgi_exec(), '-v'], stdout=PIPE).communicate()[0].split()[1].split('.')[0]
+        return self.maker.probe([self.php_cgi_exec(), '-v'])[0].split()[1].split('.')[0]
 
     def find_exec(self, names):
         paths = os.environ['PATH'].split(os.path.pathsep)
@@ -0,0 +1,201 @@
+"""
+Changesets: applying a series of file tasks as one unit.
+
+While a changeset is active (``Maker.changeset``) the Maker records
+how to undo each change it makes to the filesystem -- the previous
+version of each file it replaces, the files and directories it
+creates, the trees it moves away -- and puts off asking about files
+that conflict with their new content.  After each task its conflicts
+are presented together (before the next task can change those files);
+if anything fails (or the user aborts) all the changes of all the
+tasks are rolled back.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+
+class Changeset(object):
+    """
+    The undo journal and the put-off conflicts of one changeset.
+
+    ``journal`` is a list of undo records, oldest first:
+
+    ``('file', path, saved)``
+        ``path`` was replaced or created; ``saved`` is where its old
+        version was saved (None if it didn't exist).  Symlinks are
+        recorded as ``('link', path, old_target)``.
+    ``('mode', path, old_mode)``
+        ``path`` was chmod'ed.
+    ``('dir', path)``
+        The directory was created.
+    ``('moved', path, new_path)``
+        The tree at ``path`` was renamed to ``new_path``.
+    ``('created', path)``
+        A copy (of a file or tree) was made at ``path``.
+    """
+
+    def __init__(self, journal_parent=None):
+        self.journal_parent = journal_parent
+        self.journal_dir = None
+        self.journal = []
+        # Paths whose original state is already recorded:
+        self._recorded = set()
+        # (filename, redo) for each conflict that was put off:
+        self.conflicts = []
+        # False once the conflicts are being resolved:
+        self.deferring = True
+        self._lock = threading.RLock()
+        self._counter = 0
+
+    def __repr__(self):
+        return '<%s %i changes, %i conflicts>' % (
+            self.__class__.__name__, len(self.journal), len(self.conflicts))
+
+    def _save_path(self, path):
+        """
+        A new filename in the journal directory to save the old version
+        of ``path`` in
+        """
+        if self.journal_dir is None:
+            if self.journal_parent and not os.path.exists(self.journal_parent):
+                os.makedirs(self.journal_parent)
+            self.journal_dir = tempfile.mkdtemp(
+                prefix='changeset-', dir=self.journal_parent)
+        self._counter += 1
+        return os.path.join(self.journal_dir, '%i-%s' % (
+            self._counter, os.path.basename(path.rstrip(os.sep))))
+
+    def file_changing(self, path):
+        """
+        Called before the file (or symlink) at ``path`` is written,
+        created or removed.
+        """
+        self._lock.acquire()
+        try:
+            if path in self._recorded:
+                return
+            self._recorded.add(path)
+            if os.path.islink(path):
+                self.journal.append(('link', path, os.readlink(path)))
+            elif os.path.exists(path):
+                saved = self._save_path(path)
+                try:
+                    # Files are replaced (not rewritten in place), so a
+                    # hard link keeps the old version intact:
+                    os.link(path, saved)
+                except OSError:
+                    shutil.copy2(path, saved)
+                self.journal.append(('file', path, saved))
+            else:
+                self.journal.append(('file', path, None))
+        finally:
+            self._lock.release()
+
+    def mode_changing(self, path):
+        """
+        Called before ``path`` is chmod'ed
+        """
+        self._lock.acquire()
+        try:
+            if path in self._recorded:
+                return
+            self.journal.append(('mode', path, os.stat(path).st_mode))
+        finally:
+            self._lock.release()
+
+    def dir_created(self, path):
+        self._lock.acquire()
+        try:
+            self.journal.append(('dir', path))
+        finally:
+            self._lock.release()
+
+    def created(self, path):
+        self._lock.acquire()
+        try:
+            self.journal.append(('created', path))
+        finally:
+            self._lock.release()
+
+    def moved(self, path, new_path):
+        self._lock.acquire()
+        try:
+            self.journal.append(('moved', path, new_path))
+        finally:
+            self._lock.release()
+
+    def move_away(self, path):
+        """
+        Moves the tree at ``path`` into the journal (instead of
+        deleting it).  Returns false if it couldn't be moved.
+        """
+        self._lock.acquire()
+        try:
+            new_path = self._save_path(path)
+            try:
+                os.rename(path, new_path)
+            except OSError:
+                return False
+            self.journal.append(('moved', path, new_path))
+            return True
+        finally:
+            self._lock.release()
+
+    def defer(self, filename, redo):
+        """
+        Puts off the conflict at ``filename``; ``redo()`` is called
+        to ask about it (and make the change) when the conflicts are
+        resolved.
+        """
+        self._lock.acquire()
+        try:
+            self.conflicts.append((filename, redo))
+        finally:
+            self._lock.release()
+
+    def rollback(self, logger, forget_dirs=None):
+        """
+        Undoes all the changes, newest first.  ``forget_dirs(path)`` is
+        called for each directory that is removed or moved.  Returns
+        the number of changes that couldn't be undone.
+        """
+        failed = 0
+        journal = self.journal
+        self.journal = []
+        for record in reversed(journal):
+            kind, path = record[0], record[1]
+            try:
+                if kind == 'file':
+                    if record[2] is not None:
+                        shutil.move(record[2], path)
+                    elif os.path.lexists(path):
+                        os.unlink(path)
+                elif kind == 'link':
+                    if os.path.lexists(path):
+                        os.unlink(path)
+                    os.symlink(record[2], path)
+                elif kind == 'mode':
+                    os.chmod(path, record[2])
+                elif kind == 'dir':
+                    if forget_dirs is not None:
+                        forget_dirs(path)
+                    os.rmdir(path)
+                elif kind == 'moved':
+                    if forget_dirs is not None:
+                        forget_dirs(record[2])
+                    os.rename(record[2], path)
+                elif kind == 'created':
+                    if forget_dirs is not None:
+                        forget_dirs(path)
+                    if os.path.isdir(path) and not os.path.islink(path):
+                        shutil.rmtree(path)
+                    elif os.path.lexists(path):
+                        os.unlink(path)
+                else:
+                    assert 0, "Unknown record: %r" % (record, )
+            except (OSError, IOError, shutil.Error), e:
+                logger.warn('Could not undo the change to %s: %s' % (path, e))
+                failed += 1
+        return failed
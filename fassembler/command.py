@@ -8,6 +8,7 @@ It implements the command-line API, and some of the outermost level of setup.
 import sys
 import os
 import re
+import socket
 from cmdutils import OptionParser, CommandError, main_func
 from datetime import datetime
 import pkg_resources
@@ -15,6 +16,10 @@ from fassembler.filemaker import Maker
 from fassembler.config import ConfigParser
 from fassembler.text import indent
 from fassembler.environ import Environment
+from fassembler.snapshots import describe_snapshot, diff_snapshots
+from fassembler.garbage import GarbageCollector, plan_paths, read_backup_log
+from fassembler.util import format_size
+from fassembler.events import EventStream
 
 description = """\
 fassembler assembles files.
@@ -74,6 +79,22 @@ parser.add_option(
     dest='quick',
     help='Try to do things quickly (may not be as safe)')
 
+parser.add_option(
+    '-j', '--jobs',
+    metavar='N',
+    dest='jobs',
+    type='int',
+    default=4,
+    help='Number of files to copy at once when copying directories (default %default)')
+
+parser.add_option(
+    '--changesets',
+    action='store_true',
+    dest='changesets',
+    help='Apply each series of file tasks as one changeset: ask about all the '
+    'conflicting files of each task after it has run, and roll everything back '
+    'if anything fails')
+
 parser.add_option(
     '--beep',
     action='store_true',
@@ -92,6 +113,36 @@ parser.add_option(
     dest='list_projects',
     help="List available projects")
 
+parser.add_option(
+    '--history',
+    action='store_true',
+    dest='history',
+    help="Show the history of builds (of all projects, or of the PROJECTs given)")
+
+parser.add_option(
+    '--config-diff',
+    action='store_true',
+    dest='config_diff',
+    help="Show how the configuration changed between two builds (give build ids or "
+    "project names; with one, compare to the build before it; with none, compare "
+    "the last two builds of each project)")
+
+parser.add_option(
+    '--gc',
+    action='store_true',
+    dest='gc',
+    help="Find what the build no longer uses (backups, stale .orig/.base files, "
+    "checkouts not in any requirements file, leftover tarballs), using the plans "
+    "of the PROJECTs given (or of all built projects), and offer to delete it")
+
+parser.add_option(
+    '--events',
+    metavar='TARGET',
+    dest='events',
+    help="Write a stream of build events (projects, tasks, commands, files written, "
+    "settings saved, prompts) as lines of JSON to TARGET: a file, - for stdout (the log then goes to "
+    "stderr), tcp:HOST:PORT or unix:PATH")
+
 parser.add_verbose()
 
 try:
@@ -122,7 +173,7 @@ def main(options, args):
                 "You cannot use arguments with --list-projects")
         list_projects(options)
         return
-    if len(args) < 1:
+    if len(args) < 1 and not options.history and not options.config_diff and not options.gc:
         raise CommandError(
             "You must provide at least one project")
     base_path = options.base_path
@@ -152,8 +203,29 @@ def main(options, args):
                 base_path, options.log_file))
 
     logger = options.logger
+    # (Before anything is written, as --events - moves the log to stderr)
+    try:
+        events = EventStream(options.events, logger)
+    except (ImportError, IOError, OSError, socket.error, ValueError), e:
+        raise CommandError(
+            "Cannot write events to %s: %s" % (options.events, e), show_usage=False)
+    try:
+        build(options, base_path, project_names, variables, logger, events)
+    finally:
+        events.close()
+
+def build(options, base_path, project_names, variables, logger, events):
+    """
+    The rest of `main`, once the event stream is open
+    """
     logger.debug('%s\nStarting new run of fassembler at %s' %
                  ('-' * 72, datetime.now().strftime('%c')))
+    if options.history:
+        show_history(Environment(base_path, logger=logger), project_names)
+        return
+    if options.config_diff:
+        show_config_diff(Environment(base_path, logger=logger), project_names)
+        return
     if 'all' in project_names:
         project_names.remove('all')
         extra_projects = get_all_projects(base_path)
@@ -174,10 +246,33 @@ def main(options, args):
     # Merge both ways:
     merge_config(environ.config, config)
     merge_config(config, environ.config, overwrite=True)
+    durability = config.getdefault('general', 'durability', 'task')
+    if durability not in Maker.durability_policies:
+        raise CommandError(
+            "[general] durability must be one of %s (not %r)"
+            % (', '.join(Maker.durability_policies), durability),
+            show_usage=False)
+    section_log_memory = config.getdefault('general', 'section_log_memory', 1024*1024)
+    try:
+        section_log_memory = int(section_log_memory)
+    except ValueError:
+        raise CommandError(
+            "[general] section_log_memory must be a number of bytes (not %r)"
+            % section_log_memory, show_usage=False)
     maker = Maker(base_path, simulate=options.simulate,
+                  manifest_dir=os.path.join(environ.state_path, 'manifests'),
                   interactive=not options.no_interactive, logger=logger,
-                  quick=options.quick, beep=options.beep)
+                  quick=options.quick, beep=options.beep, jobs=options.jobs,
+                  durability=durability, trash_dir=environ.trash_path,
+                  changesets=options.changesets,
+                  probe_cache=os.path.join(environ.state_path, 'probes.json'),
+                  section_log_memory=section_log_memory,
+                  events=events,
+                  backup_log=os.path.join(environ.state_path, 'backups.txt'))
     environ.maker = maker
+    maker.empty_trash()
+    if options.gc and not project_names:
+        project_names = environ.registry.built_projects()
     
     projects = []
     for project_name in project_names:
@@ -187,6 +282,12 @@ def main(options, args):
             raise CommandError('Could not find project %s' % project_name, show_usage=False)
         project = ProjectClass(project_name, maker, environ, logger, config)
         projects.append(project)
+    if options.gc:
+        try:
+            collect_garbage(environ, maker, projects, logger, config)
+        finally:
+            finish_run(environ, maker, logger)
+        return
     success = True
     errors = []
     # Needs to be writable for easy_install:
@@ -214,41 +315,64 @@ def main(options, args):
         ## FIXME: maybe ask if they want to see effective configuration here?
         #config.write(sys.stdout)
         raise CommandError('Errors in configuration', show_usage=False)
-    for project in projects:
-        if options.project_help:
-            description = project.make_description()
-            print description
-        else:
-            if len(projects) > 1:
-                logger.notify(' Starting project %s' % project.project_name, color='black green_bg')
-                logger.indent += 2
-            try:
+    try:
+        for project in projects:
+            if options.project_help:
+                description = project.make_description()
+                print description
+            else:
+                if len(projects) > 1:
+                    logger.notify(' Starting project %s' % project.project_name, color='black green_bg')
+                    logger.indent += 2
                 try:
-                    project.run()
-                    logger.notify('Done with project %s' % project.project_name)
-                    environ.save()
-                finally:
-                    if len(projects) > 1:
-                        logger.indent -= 2
-            except CommandError:
-                raise
-            except KeyboardInterrupt:
-                raise CommandError('^C', show_usage=False)
-            except Exception, e:
-                success = False
-                continue_projects = maker.handle_exception(sys.exc_info())
-                if continue_projects:
-                    continue
-                else:
-                    break
-                ## FIXME: should revert environ here
+                    try:
+                        project.run()
+                        logger.notify('Done with project %s' % project.project_name)
+                        environ.save()
+                    finally:
+                        if len(projects) > 1:
+                            logger.indent -= 2
+                except CommandError:
+                    raise
+                except KeyboardInterrupt:
+                    raise CommandError('^C', show_usage=False)
+                except Exception, e:
+                    success = False
+                    continue_projects = maker.handle_exception(sys.exc_info())
+                    if continue_projects:
+                        continue
+                    else:
+                        break
+                    ## FIXME: should revert environ here
+    finally:
+        finish_run(environ, maker, logger, save_settings=not options.project_help)
     if not options.project_help:
         if success:
             logger.notify('Installation successful.')
         else:
             logger.notify('Installation not completely successful.')
+    maker.log_command_report()
     ## FIXME: commit etc/?
 
+def finish_run(environ, maker, logger, save_settings=True):
+    """
+    Keeps what is kept between runs, and logs how the caches did,
+    however the run ended
+    """
+    # Settings saved by a failed or aborted project are still kept
+    # (but a failure to save them must not hide the original error):
+    if save_settings and environ.unsaved_settings:
+        try:
+            environ.save()
+        except Exception, e:
+            logger.warn('Could not save the settings in %s: %s'
+                        % (environ.config_filename, e))
+    if not maker.simulate:
+        maker.probes.save()
+    maker.reap_deleters()
+    environ.log_cache_stats()
+    maker.log_cache_stats()
+
 _var_re = re.compile(r'^(?:\[(\w+)\])?\s*(\w+)=(.*)$')
 _dot_var_re = re.compile(r'^(\w+)\.(\w+)=([^=>].*)$')
 
@@ -370,6 +494,131 @@ def merge_config(source, dest, overwrite=False):
 ## Project listing
 ############################################################
 
+def show_history(environ, project_names):
+    """
+    Implements --history
+    """
+    builds = environ.registry.history(projects=project_names)
+    if not builds:
+        print 'No builds recorded in %s' % environ.registry.db_filename
+        return
+    print '%-5s %-19s %-20s %-7s %9s %-10s %s' % (
+        'id', 'time', 'project', 'status', 'duration', 'version', 'fingerprint')
+    for build in builds:
+        if build['status']:
+            status = 'failed'
+        else:
+            status = 'ok'
+        if build['duration'] is None:
+            duration = ''
+        else:
+            duration = '%.1fs' % build['duration']
+        print '%-5s %-19s %-20s %-7s %9s %-10s %s' % (
+            build['id'], build['time'], build['project'], status, duration,
+            build['fassembler_version'] or '', (build['fingerprint'] or '')[:12])
+
+def show_config_diff(environ, idents):
+    """
+    Implements --config-diff
+    """
+    snapshots = environ.snapshots
+    if len(idents) > 2:
+        raise CommandError(
+            "You may only give two builds to --config-diff")
+    pairs = []
+    if not idents:
+        latest = {}
+        for snapshot in snapshots.all():
+            latest[snapshot['project']] = snapshot
+        for project in sorted(latest):
+            pairs.append((snapshots.previous(latest[project]), latest[project]))
+        if not pairs:
+            print 'No config snapshots in %s' % snapshots.dirname
+            return
+    else:
+        found = []
+        for ident in idents:
+            snapshot = snapshots.find(ident)
+            if snapshot is None:
+                raise CommandError(
+                    "No config snapshot found for %s (in %s)" % (ident, snapshots.dirname),
+                    show_usage=False)
+            found.append(snapshot)
+        if len(found) == 1:
+            pairs.append((snapshots.previous(found[0]), found[0]))
+        else:
+            pairs.append(tuple(found))
+    for old, new in pairs:
+        if old is None:
+            print 'Only one snapshot of %s: %s' % (new['project'], describe_snapshot(new))
+            continue
+        print '--- %s' % describe_snapshot(old)
+        print '+++ %s' % describe_snapshot(new)
+        lines = diff_snapshots(old, new)
+        if lines:
+            print '\n'.join(lines)
+        else:
+            print 'No changes'
+        print
+
+def collect_garbage(environ, maker, projects, logger, config):
+    """
+    Implements --gc
+    """
+    # Projects can use each other's files, so all the built projects
+    # are planned, not just the ones given:
+    all_projects = list(projects)
+    complete = True
+    names = set([project.project_name for project in projects])
+    for project_name in environ.registry.built_projects():
+        if project_name in names:
+            continue
+        project_name, ProjectClass = find_project_class(project_name, logger)
+        if ProjectClass is None:
+            logger.warn('Could not find the built project %s' % project_name)
+            complete = False
+            continue
+        all_projects.append(ProjectClass(project_name, maker, environ, logger, config))
+    paths, tarball_names, planned = plan_paths(all_projects, logger)
+    if not complete or len(planned) < len(all_projects):
+        # Any checkout might belong to a project that wasn't planned:
+        logger.warn('Not looking for unused checkouts, as not all plans are known')
+        src_projects = []
+    else:
+        src_projects = [project.name for project in projects]
+    collector = GarbageCollector(
+        environ.base_path, reachable=paths, src_projects=src_projects,
+        tarball_names=tarball_names, tarball_dirs=[os.getcwd()],
+        skip_paths=[environ.trash_path],
+        backups=read_backup_log(maker.backup_log),
+        manifest_dir=maker.manifest_dir)
+    garbage = collector.find()
+    if not garbage:
+        logger.notify('Nothing unused found in %s' % environ.base_path)
+        return
+    total = 0
+    for item in garbage:
+        print '%-9s %9s  %s  (%s)' % (
+            item.kind, format_size(item.size), maker.display_path(item.path), item.reason)
+        total += item.size
+    print '%s in %i files and directories can be deleted' % (format_size(total), len(garbage))
+    if not maker.interactive:
+        logger.notify('Not deleting anything (run without --no-interactive to delete)')
+        return
+    if maker.ask('Delete them?', default='n') != 'y':
+        return
+    for item in garbage:
+        if not os.path.lexists(item.path):
+            continue
+        if item.is_dir:
+            # (Trees go to the trash, and are deleted in the background)
+            maker.rmtree(item.path)
+        else:
+            logger.info('Deleting %s' % item.path)
+            if not maker.simulate:
+                os.unlink(item.path)
+    logger.notify('Deleted %i files and directories (%s)' % (len(garbage), format_size(total)))
+
 def list_projects(options):
     """
     Implements --list-projects
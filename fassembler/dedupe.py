@@ -0,0 +1,241 @@
+"""
+Sharing identical files between virtualenvs with hard links.
+
+Many projects install the same packages (Paste, lxml, SQLObject...)
+in their own virtualenvs.  After a project is built, the files in its
+``site-packages`` that are identical to files already in another
+virtualenv are replaced with hard links to them, and made read-only.
+The index of the files (``var/fassembler/dedupe.txt``) records which
+files were linked, so that before a project is built again its links
+can be broken (giving it its own copies to change).
+
+This is turned on with ``[general] dedupe_virtualenvs = true``.
+"""
+
+import glob
+import os
+import shutil
+from fassembler.manifest import stat_key
+from fassembler.util import atomic_write, file_md5, format_size
+
+class Deduper(object):
+    """
+    The index of the files in the virtualenvs, kept in ``filename``.
+    ``entries`` maps each path to a dictionary with the keys ``stat``
+    (see `fassembler.manifest.stat_key`), ``md5``, ``linked`` (true if
+    the file was replaced with or is the target of a link) and
+    ``mode`` (its mode before it was made read-only).
+    """
+
+    # Python rewrites these in place, so they are never shared:
+    skip_extensions = ['.pyc', '.pyo']
+    # Files smaller than this aren't worth a link:
+    min_size = 1024
+
+    def __init__(self, filename, logger, simulate=False):
+        self.filename = filename
+        self.logger = logger
+        self.simulate = simulate
+        self.entries = {}
+        self.dirty = False
+        self._load()
+
+    def __repr__(self):
+        return '<%s %s (%i files)>' % (
+            self.__class__.__name__, self.filename, len(self.entries))
+
+    def _load(self):
+        if not os.path.exists(self.filename):
+            return
+        f = open(self.filename, 'rb')
+        try:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) != 7 or line.startswith('#'):
+                    continue
+                path, size, mtime, ino, digest, linked, mode = parts
+                try:
+                    stat = (int(size), float(mtime), int(ino))
+                    if mode:
+                        mode = int(mode, 8)
+                    else:
+                        mode = None
+                except ValueError:
+                    continue
+                self.entries[path] = dict(stat=stat, md5=digest,
+                                          linked=linked == '1', mode=mode)
+        finally:
+            f.close()
+
+    def save(self):
+        if not self.dirty or self.simulate:
+            return
+        dirname = os.path.dirname(self.filename)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        lines = ['# Written by fassembler; files in virtualenvs, and which are hard links\n']
+        for path in sorted(self.entries):
+            if '\t' in path or '\n' in path:
+                continue
+            entry = self.entries[path]
+            size, mtime, ino = entry['stat']
+            if entry['mode'] is None:
+                mode = ''
+            else:
+                mode = '%o' % entry['mode']
+            lines.append('%s\t%i\t%r\t%i\t%s\t%i\t%s\n' % (
+                path, size, mtime, ino, entry['md5'], int(entry['linked']), mode))
+        atomic_write(self.filename, ''.join(lines), fsync=False)
+        self.dirty = False
+
+    def site_packages(self, venv_path):
+        return glob.glob(os.path.join(venv_path, 'lib', 'python*', 'site-packages'))
+
+    def _files(self, venv_path):
+        """
+        Yields ``(path, stat)`` for the files in the virtualenv that
+        may be shared
+        """
+        for site_packages in self.site_packages(venv_path):
+            for dirpath, dirnames, filenames in os.walk(site_packages):
+                for name in filenames:
+                    if os.path.splitext(name)[1] in self.skip_extensions:
+                        continue
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.lstat(path)
+                    except OSError:
+                        continue
+                    if not os.path.stat.S_ISREG(st.st_mode) or st.st_size < self.min_size:
+                        continue
+                    yield path, st
+
+    def _digest(self, path, st):
+        entry = self.entries.get(path)
+        if entry is not None and entry['stat'] == stat_key(st):
+            return entry['md5']
+        digest = file_md5(path)
+        if entry is None:
+            entry = self.entries[path] = dict(linked=False, mode=None)
+        entry['stat'] = stat_key(st)
+        entry['md5'] = digest
+        self.dirty = True
+        return digest
+
+    def _content_key(self, st, digest):
+        # Files can only be shared if they'd look the same through
+        # either path (write permission is taken away anyway):
+        return (st.st_dev, st.st_size, digest, st.st_mode & ~0222,
+                st.st_uid, st.st_gid)
+
+    def _under(self, path, venv_path):
+        return path.startswith(venv_path.rstrip(os.sep) + os.sep)
+
+    def dedupe(self, venv_path):
+        """
+        Replaces the files in the virtualenv's site-packages that are
+        identical to other files in the index (or in the same
+        virtualenv) with hard links.  Returns the number of bytes saved.
+        """
+        shared = {}
+        for path, entry in self.entries.items():
+            if self._under(path, venv_path):
+                continue
+            try:
+                st = os.lstat(path)
+            except OSError:
+                del self.entries[path]
+                self.dirty = True
+                continue
+            if stat_key(st) != entry['stat']:
+                # It has changed; it is read again when its own
+                # virtualenv is deduplicated (links are kept, so they
+                # can still be broken)
+                if not entry['linked']:
+                    del self.entries[path]
+                    self.dirty = True
+                continue
+            shared.setdefault(self._content_key(st, entry['md5']), (path, st))
+        linked = saved = 0
+        seen = set()
+        for path, st in self._files(venv_path):
+            seen.add(path)
+            digest = self._digest(path, st)
+            key = self._content_key(st, digest)
+            if key not in shared:
+                shared[key] = (path, st)
+                continue
+            target, target_st = shared[key]
+            if target_st.st_ino == st.st_ino:
+                continue
+            if not self.simulate:
+                self._link(target, path, st, digest)
+            linked += 1
+            saved += st.st_size
+        # Files that are gone from the virtualenv:
+        for path in self.entries.keys():
+            if self._under(path, venv_path) and path not in seen:
+                del self.entries[path]
+                self.dirty = True
+        if linked:
+            self.logger.notify('Replaced %i files in %s with links to identical files (%s saved)'
+                               % (linked, venv_path, format_size(saved)))
+        else:
+            self.logger.info('No files in %s are the same as files in other virtualenvs' % venv_path)
+        self.save()
+        return saved
+
+    def _link(self, target, path, st, digest):
+        tmp = path + '.fassembler-link'
+        os.link(target, tmp)
+        os.rename(tmp, path)
+        target_entry = self.entries[target]
+        if not target_entry['linked']:
+            target_entry['linked'] = True
+            target_entry['mode'] = os.lstat(target).st_mode & 07777
+            # Writing to the file in place would change it in every
+            # virtualenv:
+            os.chmod(target, target_entry['mode'] & ~0222)
+        self.entries[path] = dict(stat=stat_key(os.lstat(path)), md5=digest,
+                                  linked=True, mode=st.st_mode & 07777)
+        self.dirty = True
+
+    def break_links(self, venv_path):
+        """
+        Gives the virtualenv its own copies of all the files that were
+        linked, so that it can be changed safely.  Returns the number
+        of files copied.
+        """
+        copied = 0
+        for path, entry in sorted(self.entries.items()):
+            if not entry['linked'] or not self._under(path, venv_path):
+                continue
+            if self.simulate:
+                copied += 1
+                continue
+            try:
+                st = os.lstat(path)
+            except OSError:
+                del self.entries[path]
+                self.dirty = True
+                continue
+            mode = entry['mode']
+            if mode is None:
+                mode = (st.st_mode & 07777) | 0200
+            if st.st_nlink > 1:
+                tmp = path + '.fassembler-copy'
+                shutil.copyfile(path, tmp)
+                os.chmod(tmp, mode)
+                os.rename(tmp, path)
+                copied += 1
+            else:
+                os.chmod(path, mode)
+            entry['linked'] = False
+            entry['mode'] = None
+            entry['stat'] = stat_key(os.lstat(path))
+            self.dirty = True
+        if copied:
+            self.logger.notify('Copied %i linked files in %s, so they can be changed'
+                               % (copied, venv_path))
+        self.save()
+        return copied
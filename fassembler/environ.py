@@ -1,8 +1,13 @@
 import os
 import socket
+import threading
 from fassembler.config import ConfigParser
-from fassembler.util import asbool
+from fassembler.registry import BuildRegistry
+from fassembler.dedupe import Deduper
+from fassembler.snapshots import ConfigSnapshots
+from fassembler.util import asbool, atomic_write
 from initools.configparser import CanonicalFilenameSet
+from cStringIO import StringIO
 import string
 import random
 from datetime import datetime
@@ -43,6 +48,14 @@ class Environment(object):
         self.base_path = os.path.abspath(base_path)
         self.logger = logger
         self._parser = None
+        # (section, option) pairs changed since the last save():
+        self._dirty = set()
+        self._registry = None
+        self._snapshots = None
+        self._deduper = None
+        # Results of host and credential lookups, for this run:
+        self._introspection_cache = {}
+        self.introspection_hits = 0
         # Gets set later:
         self.maker = None
         self.simulated_built_projects = []
@@ -65,13 +78,98 @@ class Environment(object):
         The fully-qualified hostname of this computer.
 
         This uses reverse DNS to determine the complete domain name.
+        The lookup is done once per run, and gives up after ``[general]
+        dns_timeout`` seconds (default 5); then the last value found
+        (kept in var/fassembler/fq_hostname) is used, or
+        ``'localhost'``.
         """
+        if 'fq_hostname' in self._introspection_cache:
+            self.introspection_hits += 1
+            return self._introspection_cache['fq_hostname']
+        try:
+            timeout = float(self.config.getdefault('general', 'dns_timeout', '5'))
+        except ValueError:
+            timeout = 5
         ## this seems to return localhost.localdomain and other useless stuff sometimes:
+        result = []
+        def lookup():
+            try:
+                result.append(socket.gethostbyaddr(socket.gethostname())[0])
+            except socket.error, e:
+                result.append(e)
+        thread = threading.Thread(target=lookup)
+        thread.setDaemon(True)
+        thread.start()
+        thread.join(timeout)
+        last_known_filename = os.path.join(self.state_path, 'fq_hostname')
+        if result and not isinstance(result[0], Exception):
+            hostname = result[0]
+            self._save_last_known(last_known_filename, hostname)
+        else:
+            if result:
+                reason = str(result[0])
+            else:
+                reason = 'timed out after %s seconds' % timeout
+            hostname = self._read_last_known(last_known_filename)
+            if hostname:
+                self.logger.debug('Could not get full hostname (using last known name %s instead): %s'
+                                  % (hostname, reason))
+            else:
+                self.logger.debug('Could not get full hostname (using "localhost" instead): %s' % reason)
+                hostname = 'localhost'
+        self._introspection_cache['fq_hostname'] = hostname
+        return hostname
+
+    def _read_last_known(self, filename):
+        if not os.path.exists(filename):
+            return None
+        f = open(filename, 'rb')
+        value = f.read().strip()
+        f.close()
+        return value or None
+
+    def _save_last_known(self, filename, value):
+        if self.maker is not None and self.maker.simulate:
+            return
+        if self._read_last_known(filename) == value:
+            return
         try:
-            return socket.gethostbyaddr(socket.gethostname())[0]
-        except socket.error, e:
-            self.logger.debug('Could not get full hostname (using "localhost" instead): %s' % e)
-            return 'localhost'
+            dir = os.path.dirname(filename)
+            if not os.path.exists(dir):
+                os.makedirs(dir)
+            atomic_write(filename, value+'\n', fsync=False)
+        except (IOError, OSError), e:
+            self.logger.debug('Could not save %s: %s' % (filename, e))
+
+    def _read_file_cached(self, filename, parse, restricted=False):
+        """
+        Returns ``parse(contents)`` for the file, only reading and
+        parsing it again if the file has changed during this run.
+
+        If ``restricted`` is true, the file permissions are checked
+        (see ``.check_restricted_permissions()``) when it is read.
+        """
+        st = os.stat(filename)
+        key = ('file', filename, parse)
+        cached = self._introspection_cache.get(key)
+        if cached is not None and cached[0] == (st.st_mtime, st.st_size, st.st_mode):
+            self.introspection_hits += 1
+            return cached[1]
+        if restricted:
+            self.check_restricted_permissions(filename)
+        f = open(filename, 'rb')
+        value = parse(f.read())
+        f.close()
+        self._introspection_cache[key] = ((st.st_mtime, st.st_size, st.st_mode), value)
+        return value
+
+    def log_cache_stats(self):
+        """
+        Logs how many lookups were avoided by caching.
+        """
+        if self.introspection_hits:
+            self.logger.info('Host and credential introspection: %s lookups saved by caching'
+                             % self.introspection_hits)
 
     @property
     def config_filename(self):
@@ -142,21 +240,73 @@ class Environment(object):
     def var(self):
         return self.config.get('general', 'var')
 
+    def set_setting(self, section, option, value):
+        """
+        Set a value in the global configuration, remembering it as
+        changed so that the next ``.save()`` writes it out.  Returns
+        true if the value actually changed.
+        """
+        config = self.config
+        if not config.has_section(section):
+            config.add_section(section)
+        elif (config.has_option(section, option)
+              and config.get(section, option) == value):
+            return False
+        config.set(section, option, value)
+        self.mark_dirty(section, option)
+        return True
+
+    def mark_dirty(self, section, option):
+        """
+        Mark a setting as changed, so it will be written on the next
+        ``.save()``
+        """
+        self._dirty.add((section, option))
+
+    @property
+    def unsaved_settings(self):
+        """
+        True if some setting has been changed but not yet saved.
+        """
+        return bool(self._dirty)
+
     def save(self):
         """
         Save the configuration in etc/build.ini
+
+        Settings are written behind: nothing is written unless some
+        setting was changed (with ``.set_setting()`` or
+        ``.mark_dirty()``) since the last save, and the file is left
+        alone if its content would not change.  The file is replaced
+        atomically, so an interrupted write cannot truncate it.
         """
-        if self._parser is None:
+        if self._parser is None or not self._dirty:
             # Nothing was changed
             self.logger.info('No config file changes made')
             return
-        ## FIXME: this should use ensure_file or something
-        ## FIXME: somehow this is clearing the config file when no changes are made
-        ## (the self._parser is None check avoids this, but only incidentally)
+        out = StringIO()
+        self.config.write_sources(out, CanonicalFilenameSet([self.config_filename, None, '<cmdline>']))
+        content = out.getvalue()
+        dirty = sorted(self._dirty)
+        # (The settings are only forgotten once they are in the file,
+        # so a failed write is retried by the next save)
+        if os.path.exists(self.config_filename):
+            f = open(self.config_filename, 'rb')
+            existing = f.read()
+            f.close()
+            if existing == content:
+                self.logger.info('Environment config file %s is up-to-date' % self.config_filename)
+                self._dirty.difference_update(dirty)
+                return
         self.logger.info('Writing environment config file: %s' % self.config_filename)
-        f = open(self.config_filename, 'wb')
-        self.config.write_sources(f, CanonicalFilenameSet([self.config_filename, None, '<cmdline>']))
-        f.close()
+        self.logger.debug('Changed settings: %s' % ', '.join(
+            ['[%s] %s' % (section, option) for section, option in dirty]))
+        atomic_write(self.config_filename, content)
+        self._dirty.difference_update(dirty)
+        if self.maker is not None:
+            for section, option in dirty:
+                self.maker.events.emit('setting_saved', section=section, option=option,
+                                       filename=self.config_filename)
 
     random_string = staticmethod(random_string)
 
@@ -169,15 +319,85 @@ class Environment(object):
 
             env.parse_auth(env.config.get('general', 'admin_info_filename'))
         """
-        f = open(filename)
-        line = f.read().strip()
-        f.close()
-        username, password = line.split(':', 1)
+        username, password = self._read_file_cached(filename, _parse_auth_content)
         return bunch(username=username, password=password)
 
-    def add_built_project(self, name, time=None):
+    @property
+    def trash_path(self):
+        """
+        The directory where ``Maker.rmtree`` moves trees to be deleted
+        in the background: ``.trash/`` under the var directory.
         """
-        Adds the named project to etc/projects.txt, so that it is listed as built
+        var = (self.config.getdefault('general', 'var')
+               or os.path.join(self.base_path, 'var'))
+        return os.path.join(var, '.trash')
+
+    @property
+    def state_path(self):
+        """
+        The directory where fassembler keeps its own records (build
+        history and the like): ``fassembler/`` under the var directory.
+        """
+        var = (self.config.getdefault('general', 'var')
+               or os.path.join(self.base_path, 'var'))
+        return os.path.join(var, 'fassembler')
+
+    @property
+    def registry(self):
+        """
+        The BuildRegistry for this build (etc/projects.txt plus the
+        history of builds in var/fassembler/builds.db)
+        """
+        db_filename = os.path.join(self.state_path, 'builds.db')
+        if self._registry is None or self._registry.db_filename != db_filename:
+            self._registry = BuildRegistry(
+                os.path.join(self.base_path, 'etc', 'projects.txt'),
+                db_filename, self.logger)
+        return self._registry
+
+    @property
+    def snapshots(self):
+        """
+        The ConfigSnapshots kept for this build (in
+        var/fassembler/snapshots/)
+        """
+        dirname = os.path.join(self.state_path, 'snapshots')
+        if self._snapshots is None or self._snapshots.dirname != dirname:
+            self._snapshots = ConfigSnapshots(dirname, self.logger)
+        return self._snapshots
+
+    @property
+    def deduper(self):
+        """
+        The Deduper that shares identical files between the
+        virtualenvs (index in var/fassembler/dedupe.txt), or None
+        unless ``[general] dedupe_virtualenvs`` is true
+        """
+        if not asbool(self.config.getdefault('general', 'dedupe_virtualenvs', 'false')):
+            return None
+        filename = os.path.join(self.state_path, 'dedupe.txt')
+        if self._deduper is None or self._deduper.filename != filename:
+            simulate = self.maker is not None and self.maker.simulate
+            self._deduper = Deduper(filename, self.logger, simulate)
+        return self._deduper
+
+    @property
+    def fassembler_version(self):
+        """
+        The version of fassembler doing the build.
+        """
+        try:
+            import pkg_resources
+            return pkg_resources.get_distribution('fassembler').version
+        except Exception:
+            return 'unknown'
+
+    def add_built_project(self, name, time=None, duration=None, fingerprint=None,
+                          commands=None):
+        """
+        Adds the named project to etc/projects.txt, so that it is listed as built,
+        and records the build in the build history.  Returns the id of
+        the build record, if any.
         """
         if time is None:
             time = datetime.now()
@@ -185,26 +405,45 @@ class Environment(object):
             # Didn't really build at all
             self.simulated_built_projects.append(name)
             return
-        dest = self.maker.path('etc/projects.txt')
-        if os.path.exists(dest):
-            f = open(dest, 'r')
-            lines = f.readlines()
-            f.close()
-        else:
-            lines = []
-        new_lines = []
-        for line in lines:
-            if not line.strip() or line.strip().startswith('#'):
-                new_lines.append(line)
-                continue
-            if line.split()[0] != name:
-                new_lines.append(line)
-        new_lines.append('%s %s\n' % (name, time.strftime('%Y-%m-%d %H:%M:%S')))
-        self.logger.info('Writing build info for %s to %s' % (name, dest))
-        f = open(dest, 'w')
-        f.writelines(new_lines)
-        f.close()
-        
+        self.registry.add_built(name, time)
+        return self.record_build(name, time=time, duration=duration,
+                                 fingerprint=fingerprint, status=0,
+                                 commands=commands)
+
+    def record_build(self, name, time=None, duration=None, fingerprint=None, status=0,
+                     commands=None):
+        """
+        Records a build of the project (successful or not; ``status``
+        is 0 for success) in the build history, with the resources
+        used by its ``commands`` (see `BuildRegistry.record`).  Returns
+        the id of the record, if any.
+        """
+        if time is None:
+            time = datetime.now()
+        if self.maker.simulate:
+            return None
+        return self.registry.record(
+            name, time, duration=duration,
+            fassembler_version=self.fassembler_version,
+            fingerprint=fingerprint, status=status, commands=commands)
+
+    def save_config_snapshot(self, name, build_id=None, settings=None,
+                             build_properties=None, time=None):
+        """
+        Writes a snapshot of the effective configuration a project was
+        built with (see ``Project.config_snapshot``)
+        """
+        if time is None:
+            time = datetime.now()
+        if self.maker.simulate:
+            return None
+        return self.snapshots.save(dict(
+            project=name, build=build_id,
+            time=time.strftime('%Y-%m-%d %H:%M:%S'),
+            fassembler_version=self.fassembler_version,
+            settings=settings or {},
+            build_properties=build_properties or {}))
+
     def is_project_built(self, name):
         """
         Checks if the given project is built.  If this is a simulated run, this
@@ -212,16 +451,7 @@ class Environment(object):
         """
         if name in self.simulated_built_projects:
             return True
-        dest = self.maker.path('etc/projects.txt')
-        if os.path.exists(dest):
-            f = open(dest, 'r')
-            lines = f.readlines()
-            for line in lines:
-                if not line.strip() or line.strip().startswith('#'):
-                    continue
-                if line.split()[0] == name:
-                    return True
-        return False
+        return self.registry.is_built(name)
 
     @property
     def db_root_password(self):
@@ -238,11 +468,8 @@ class Environment(object):
         filename = self.config.getdefault('general', 'db_root_password_filename', '~/.mysql-root-pw')
         filename = os.path.expanduser(filename)
         if os.path.exists(filename):
-            self.check_restricted_permissions(filename)
-            f = open(filename, 'rb')
-            c = f.read().strip()
-            f.close()
-            return c
+            return self._read_file_cached(filename, _strip_content,
+                                          restricted=True)
         else:
             self.logger.debug('No root password file %s (using empty password)' % filename)
         return ''
@@ -258,3 +485,9 @@ class Environment(object):
             raise OSError(
                 "The file %s must not be readable by other users; use \"chmod 600 %s\" to fix"
                 % (filename, filename))
+
+def _parse_auth_content(content):
+    return tuple(content.strip().split(':', 1))
+
+def _strip_content(content):
+    return content.strip()
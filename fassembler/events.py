@@ -0,0 +1,129 @@
+"""
+A stream of build events, as JSON (``fassembler --events TARGET``).
+
+Each event is a line with a JSON object, which has the keys ``event``
+(the kind of event) and ``time`` (in seconds since the epoch), and
+depending on the event:
+
+``project_start``, ``project_end``
+    ``project``; when ending also ``duration``, ``status`` (0 for
+    success) and ``build`` (the id in the build history, if any)
+``task_start``, ``task_end``
+    ``project``, ``task``; when ending also ``duration`` and
+    ``status``
+``command_start``
+    ``pid``, ``argv``, ``cwd`` and ``task``
+``command_end``
+    ``pid``, ``argv``, ``task``, ``duration``, ``returncode``, and
+    ``user``, ``sys`` (CPU seconds) and ``maxrss`` (KB) if known
+``file_written``
+    ``path`` and ``kind``: ``file`` (with its ``size``), ``directory``
+    or ``symlink`` (with its ``target``)
+``setting_saved``
+    ``section``, ``option`` and ``filename`` (values aren't included,
+    as they are often passwords)
+``prompt``
+    ``message``, ``responses``, ``response`` (None for passwords) and
+    ``wait`` (the seconds spent waiting for the answer); one for each
+    line read from the user
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+class EventStream(object):
+    """
+    Writes events to ``target``: a filename (which is appended to),
+    ``-`` for stdout, ``tcp:HOST:PORT`` or ``unix:PATH`` for a socket,
+    or None to drop all events.  If writing fails, a warning is logged
+    (to ``logger``) and no more events are written.
+
+    With ``-`` stdout is left to the events alone: anything else
+    written to stdout afterwards (like the log) goes to stderr
+    instead.
+    """
+
+    def __init__(self, target=None, logger=None):
+        self.target = target
+        self.logger = logger
+        self._lock = threading.Lock()
+        self.file = None
+        if target is None:
+            return
+        if json is None:
+            raise ImportError(
+                "Neither json nor simplejson is available, so events can't be written")
+        if target == '-':
+            sys.stdout.flush()
+            self.file = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+            os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        elif target.startswith('tcp:'):
+            host, port = target[4:].rsplit(':', 1)
+            sock = socket.create_connection((host, int(port)))
+            self.file = sock.makefile('wb')
+            sock.close()
+        elif target.startswith('unix:'):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(target[5:])
+            self.file = sock.makefile('wb')
+            sock.close()
+        else:
+            self.file = open(target, 'ab')
+
+    def __repr__(self):
+        return '<%s to %s>' % (self.__class__.__name__, self.target)
+
+    @property
+    def enabled(self):
+        return self.file is not None
+
+    def emit(self, event, **fields):
+        """
+        Writes one event (of the kind ``event``, with the given fields)
+        """
+        if self.file is None:
+            return
+        fields['event'] = event
+        fields['time'] = time.time()
+        try:
+            line = json.dumps(fields, sort_keys=True)
+        except UnicodeDecodeError:
+            # Some bytes (like a filename) aren't UTF-8:
+            line = json.dumps(fields, sort_keys=True, encoding='latin-1')
+        self._lock.acquire()
+        try:
+            if self.file is None:
+                return
+            try:
+                self.file.write(line + '\n')
+                self.file.flush()
+            except (IOError, socket.error), e:
+                if self.logger is not None:
+                    self.logger.warn('Could not write events to %s (%s); no more events will be written'
+                                     % (self.target, e))
+                self.file = None
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            if self.file is not None:
+                try:
+                    self.file.close()
+                except (IOError, socket.error):
+                    pass
+            self.file = None
+        finally:
+            self._lock.release()
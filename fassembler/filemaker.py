@@ -6,6 +6,7 @@ Everything happens in the Maker object.
 # (c) 2005 Ian Bicking, Ben Bangert, and contributors; written for Paste (http://pythonpaste.org)
 # Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
 # This was originally based on paste.filemaker
+import errno
 import os
 import re
 import shutil
@@ -14,10 +15,19 @@ import subprocess
 import sys
 import tempfile
 import tempita
+import threading
+import time
 import util
 
+from changeset import Changeset
 from difflib import unified_diff, context_diff
 from environ import random_string
+from manifest import Manifest, content_hash
+from procio import communicate, kill_process, kill_process_group, TimeoutExpired
+from procio import CommandStats, OutputBuffer
+from probes import ProbeCache, find_executable
+from sectionlog import SectionLog
+from events import EventStream
 from getpass import getpass
 
 EXE_MODE = 0111
@@ -39,6 +49,113 @@ class RunCommandError(OSError):
                                              self.command,
                                              self.returncode)
 
+class CommandTimeoutError(RunCommandError):
+    """
+    A script that was killed because it ran longer than its timeout
+    (``stdout`` and ``stderr`` are its output until then).
+    """
+
+class DeferredLogger(object):
+    """
+    Stands in for a logger in a worker thread: messages (and changes
+    to the indentation) are kept, to be sent to the real logger (with
+    ``replay()``) by the main thread, so that output isn't
+    interleaved.  Progress dots aren't written either, but counted
+    (see ``take_progress()``).
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.messages = []
+        self.indent_change = 0
+        self.progress = 0
+
+    def __getattr__(self, attr):
+        return getattr(self.logger, attr)
+
+    def _get_indent(self):
+        return self.logger.indent + self.indent_change
+
+    def _set_indent(self, value):
+        change = value - self._get_indent()
+        self.indent_change += change
+        self.messages.append(('indent', (change, ), {}))
+
+    indent = property(_get_indent, _set_indent)
+
+    def show_progress(self):
+        self.progress += 1
+
+    def take_progress(self):
+        """
+        True if there was some progress since the last call
+        """
+        progress = self.progress
+        self.progress = 0
+        return bool(progress)
+
+    def log(self, *args, **kw):
+        self.messages.append(('log', args, kw))
+
+    def debug(self, *args, **kw):
+        self.messages.append(('debug', args, kw))
+
+    def info(self, *args, **kw):
+        self.messages.append(('info', args, kw))
+
+    def notify(self, *args, **kw):
+        self.messages.append(('notify', args, kw))
+
+    def warn(self, *args, **kw):
+        self.messages.append(('warn', args, kw))
+
+    def error(self, *args, **kw):
+        self.messages.append(('error', args, kw))
+
+    def fatal(self, *args, **kw):
+        self.messages.append(('fatal', args, kw))
+
+    def replay(self):
+        messages = self.messages
+        self.messages = []
+        self.indent_change = 0
+        for method, args, kw in messages:
+            if method == 'indent':
+                self.logger.indent += args[0]
+            else:
+                getattr(self.logger, method)(*args, **kw)
+
+class _CopyJob(object):
+    """
+    One file being copied by ``Maker.copy_dir`` in a worker thread.
+    """
+
+    def __init__(self, src, dest, logger):
+        self.src = src
+        self.dest = dest
+        self.logger = DeferredLogger(logger)
+        # Set if the copy has to be done (again) in the main thread:
+        self.redo = False
+        self.done = False
+
+class _CommandJob(object):
+    """
+    One command being run by ``Maker.run_commands`` in a worker thread.
+    """
+
+    def __init__(self, cmd, kw, logger):
+        self.cmd = cmd
+        self.kw = kw
+        self.logger = DeferredLogger(logger)
+        self.result = None
+        self.exc_info = None
+        self.done = False
+
+class _RedoInMainThread(Exception):
+    """
+    Raised in a worker thread when the copy needs to ask a question
+    """
+
 class Maker(object):
     """
     Instances of Maker are abstractions of several pieces of context:
@@ -54,21 +171,134 @@ class Maker(object):
     This object is generally instantiated just once per fassembler
     run, and used by all projects and tasks.
     """
+
+    durability_policies = ['file', 'task', 'none']
+
+    # Files at least this big are compared and copied a chunk at a
+    # time, and aren't diffed:
+    large_file_size = 1024*1024
     
     def __init__(self, base_path, logger,
                  simulate=False, 
                  interactive=True,
+                 manifest_dir=None,
                  quick=False,
-                 beep=False):
+                 beep=False,
+                 jobs=4,
+                 durability='task',
+                 trash_dir=None,
+                 changesets=False,
+                 probe_cache=None,
+                 section_log_memory=1024*1024,
+                 events=None,
+                 backup_log=None):
         """
         Initialize the Maker.  Files go under base_path.
+
+        ``manifest_dir`` is where the manifests of the files written
+        are kept (see `fassembler.manifest`); if None, they are only
+        kept for this run.
+
+        ``jobs`` is the number of threads ``copy_dir`` may use to copy
+        files.
+
+        ``durability`` is when written files are flushed to disk:
+        ``'file'`` (each file as it is written), ``'task'`` (all the
+        files written by a task, at the end of the task; see
+        ``sync()``) or ``'none'`` (left to the OS).
+
+        ``trash_dir``, if given, is where ``rmtree`` moves trees to be
+        deleted in the background.
+
+        If ``changesets`` is true, projects run each series of file
+        tasks as a changeset (see `begin_changeset`).
+
+        ``probe_cache`` is the file the output of ``probe()`` is kept
+        in between runs (if None, it is only kept for this run).
+
+        ``section_log_memory`` is the most bytes of the log of a
+        section kept in memory (see `set_log_section`).
+
+        ``events`` is the `EventStream` that commands, written files
+        and prompts are reported to (by default, one that drops them).
+
+        ``backup_log`` is a file the backups made by `backup` (also
+        used by `ask_difference`) are listed in, so that ``fassembler --gc``
+        knows which backups are its own.
         """
+        if durability not in self.durability_policies:
+            raise ValueError(
+                "Bad durability %r (should be one of: %s)"
+                % (durability, ', '.join(self.durability_policies)))
+        # Holds the _CopyJob when in a copy_dir worker thread:
+        self._local = threading.local()
+        # Serializes template filling and the manifests across threads:
+        self._lock = threading.RLock()
+        # Normalized forms of absolute paths, and directories known to
+        # exist (forgotten by rmtree() and backup(), and all of them
+        # after each command and task; see forget_known_dirs()):
+        self._normpaths = {}
+        self._known_dirs = set()
+        self.normpath_hits = 0
+        self.known_dir_hits = 0
+        # Devices where backup() couldn't make copy-on-write clones:
+        self._no_reflink_devs = set()
         self.base_path = self._normpath(base_path)
         self.logger = logger
         self.simulate = simulate
         self.interactive = interactive
+        self.manifest_dir = manifest_dir
         self.quick = quick
         self.beep = beep
+        self.jobs = jobs
+        self.durability = durability
+        self.trash_dir = trash_dir
+        self.changesets = changesets
+        self.probes = ProbeCache(probe_cache, logger)
+        self.section_log_memory = section_log_memory
+        if events is None:
+            events = EventStream()
+        self.events = events
+        self.backup_log = backup_log
+        # The active Changeset, if any:
+        self.changeset = None
+        # Paths waiting for svn add (see svn_add()):
+        self._svn_adds = []
+        self._svn_add_set = set()
+        # Files written but not yet synced to disk (for durability='task'):
+        self._unsynced_files = set()
+        # Manifests of written files, by directory:
+        self._manifests = {}
+        # The default timeout of run_command, and the name of the
+        # task running commands (both set for each task by the project):
+        self.command_timeout = None
+        self.current_task = None
+        # CommandStats of each command run:
+        self.command_stats = []
+        # The rm processes started by _delete_in_background():
+        self._deleters = []
+
+    def _get_logger(self):
+        job = getattr(self._local, 'job', None)
+        if job is not None:
+            return job.logger
+        return self._logger
+
+    def _set_logger(self, logger):
+        self._logger = logger
+
+    logger = property(_get_logger, _set_logger)
+
+    def _get_interactive(self):
+        if getattr(self._local, 'job', None) is not None:
+            # Questions are never asked in worker threads
+            return False
+        return self._interactive
+
+    def _set_interactive(self, value):
+        self._interactive = value
+
+    interactive = property(_get_interactive, _set_interactive)
     
     def copy_file(self, src, dest=None, dest_dir=None, template_vars=None,
                   interpolater=None, overwrite=False, svn_add=True):
@@ -89,39 +319,101 @@ class Maker(object):
         dest = self.path(dest)
         src = self.path(src)
         self._warn_filename(dest)
+        src_st = os.stat(src)
+        source = (src, src_st.st_size, src_st.st_mtime)
+        if not src.endswith('_tmpl'):
+            entry = self._manifest_entry(dest)
+            if entry is not None and entry['source'] == source:
+                # Nothing has changed since this file was last copied
+                self.logger.info('File %s exists with same content' % self.display_path(dest))
+                if src_st.st_mode&0111 and not os.stat(dest).st_mode&0111:
+                    self.make_executable(dest)
+                return
+            if src_st.st_size >= self.large_file_size:
+                self._copy_large_file(src, dest, src_st, source, svn_add)
+                return
         contents, raw_contents = self._get_contents(src, template_vars, interpolater)
         overwrite = False
         if os.path.exists(dest):
-            existing = self._get_raw_contents(dest)
-            base_content = self._get_base_contents(dest)
-            if existing == contents:
+            if self._content_matches(dest, contents):
                 self.logger.info('File %s exists with same content' % self.display_path(dest))
-            elif base_content and existing == base_content:
+            elif self._base_matches(dest):
                 # logging happens in ensure_file
                 pass
             else:
+                if self._defer_conflict(dest, lambda: self.copy_file(
+                        src, dest, template_vars=template_vars,
+                        interpolater=interpolater, svn_add=svn_add)):
+                    return
+                if self._interactive and getattr(self._local, 'job', None) is not None:
+                    raise _RedoInMainThread()
                 message = 'File %s already exists (with different content)' % self.display_path(dest)
-                if os.path.exists(self._orig_filename(dest)):
-                    existing_raw = self._get_raw_contents(self._orig_filename(dest))
-                    if existing_raw == raw_contents:
-                        message = (
-                            'File %s already exists (with different substitutions, but same original template)'
-                            % self.display_path(dest))
+                orig_filename = self._orig_filename(dest)
+                if (os.path.exists(orig_filename)
+                    and util.content_equals_file(raw_contents, orig_filename)):
+                    message = (
+                        'File %s already exists (with different substitutions, but same original template)'
+                        % self.display_path(dest))
                 if self.interactive:
-                    response = self.ask_difference(dest, message, contents, existing)
+                    response = self.ask_difference(dest, message, contents,
+                                                   self._read_for_diff(dest))
                     if not response:
                         self.logger.notify('Aborting copy')
                         return
                 overwrite = True
 
         self.ensure_file(dest, contents, overwrite=overwrite, 
-                         executable=os.stat(src).st_mode&0111, svn_add=svn_add)
+                         executable=src_st.st_mode&0111, svn_add=svn_add)
         if contents != raw_contents:
             if not self.simulate:
                 self.ensure_file(self._orig_filename(dest), raw_contents, overwrite=True,
                                  svn_add=svn_add, quiet=True)
                 self.ensure_file(self._base_filename(dest), contents, overwrite=True,
                                  svn_add=svn_add, quiet=True)
+        else:
+            self._manifest_set_source(dest, contents, source)
+
+    def _copy_large_file(self, src, dest, src_st, source, svn_add):
+        """
+        Copies a big file (that isn't a template) like ``copy_file``
+        does, but without ever reading either file whole into memory.
+        """
+        executable = src_st.st_mode&0111
+        self.ensure_dir(os.path.dirname(dest), svn_add=svn_add)
+        if not os.path.exists(dest):
+            self.logger.info('Creating %s' % dest)
+            if not self.simulate:
+                self._copyfile(src, dest, source)
+            if executable:
+                self.make_executable(dest)
+            if svn_add:
+                self.svn_add(dest)
+            return
+        if util.files_equal(src, dest):
+            self.logger.info('File %s exists with same content' % self.display_path(dest))
+            if executable and not os.stat(dest).st_mode&0111:
+                self.make_executable(dest)
+            self._manifest_record_digest(dest, util.file_md5(dest), source)
+            return
+        if self._base_matches(dest):
+            self.logger.notify('File %s was not edited and content has changed, overwriting'
+                               % self.display_path(dest), color='cyan')
+        else:
+            if self._defer_conflict(dest, lambda: self.copy_file(
+                    src, dest, svn_add=svn_add)):
+                return
+            if self._interactive and getattr(self._local, 'job', None) is not None:
+                raise _RedoInMainThread()
+            if self.interactive:
+                message = 'File %s already exists (with different content)' % self.display_path(dest)
+                if not self.ask_difference(dest, message, None, None, new_filename=src):
+                    self.logger.notify('Aborting copy')
+                    return
+            self.logger.notify('Overwriting %s with new content' % dest)
+        if not self.simulate:
+            self._copyfile(src, dest, source)
+            if executable:
+                self.make_executable(dest)
 
     def _orig_filename(self, filename):
         """
@@ -158,10 +450,15 @@ class Maker(object):
                 % filename)
         raw_contents = contents = self._get_raw_contents(filename)
         if is_tmpl:
-            if interpolater is not None:
-                contents = interpolater(contents, template_vars, filename=filename)
-            else:
-                contents = self.fill(contents, template_vars, filename=filename)
+            # Namespaces aren't thread-safe, so only one file is filled at a time:
+            self._lock.acquire()
+            try:
+                if interpolater is not None:
+                    contents = interpolater(contents, template_vars, filename=filename)
+                else:
+                    contents = self.fill(contents, template_vars, filename=filename)
+            finally:
+                self._lock.release()
         return contents, raw_contents
 
     def _get_raw_contents(self, filename):
@@ -174,21 +471,276 @@ class Maker(object):
         finally:
             f.close()
 
-    def _get_base_contents(self, filename):
-        new_filename = self._base_filename(filename)
-        if not os.path.exists(new_filename):
+    def _base_matches(self, filename):
+        """
+        Is there a .base file for filename with the same content as
+        the file?  (I.e., the file was generated, and can be replaced
+        because it hasn't been edited.)
+        """
+        base_filename = self._base_filename(filename)
+        try:
+            if not os.path.getsize(base_filename):
+                return False
+        except OSError:
+            return False
+        entry = self._manifest_entry(filename)
+        base_entry = self._manifest_entry(base_filename)
+        if entry is not None and base_entry is not None:
+            return entry['md5'] == base_entry['md5']
+        return util.files_equal(filename, base_filename)
+
+    def _content_matches(self, filename, content):
+        """
+        Does the (existing) file have this content?  This doesn't read
+        the file if the manifest or its size answers the question, and
+        otherwise reads it in chunks.
+        """
+        return (self._manifest_matches(filename, content)
+                or util.content_equals_file(content, filename))
+
+    def _read_for_diff(self, filename):
+        """
+        The content of the file, or None if it is too large to diff
+        """
+        if os.path.getsize(filename) > self.large_file_size:
             return None
-        return self._get_raw_contents(new_filename)
+        return self._get_raw_contents(filename)
+
+    def _manifest(self, dirname):
+        """
+        The Manifest for the directory
+        """
+        self._lock.acquire()
+        try:
+            manifest = self._manifests.get(dirname)
+            if manifest is None:
+                manifest = self._manifests[dirname] = Manifest(dirname, self.manifest_dir)
+            return manifest
+        finally:
+            self._lock.release()
+
+    def _manifest_entry(self, filename):
+        """
+        The manifest entry for the file, if the file is unchanged
+        since the entry was recorded (otherwise None)
+        """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return self._manifest(os.path.dirname(filename)).lookup(
+            os.path.basename(filename), st)
+
+    def _manifest_matches(self, filename, content):
+        """
+        True if the manifest shows that the file has this content
+        (without reading the file)
+        """
+        entry = self._manifest_entry(filename)
+        return entry is not None and entry['md5'] == content_hash(content)
+
+    def _manifest_record(self, filename, content):
+        """
+        Records that the file now has the given content.
+        """
+        self._manifest_record_digest(filename, content_hash(content))
+
+    def _manifest_record_digest(self, filename, digest, source=None):
+        """
+        Records that the file now has content with the given md5 digest
+        """
+        if self.simulate:
+            return
+        self._manifest(os.path.dirname(filename)).record(
+            os.path.basename(filename), os.stat(filename), digest, source=source)
+
+    def _manifest_set_source(self, filename, content, source):
+        """
+        Records the source (as ``(filename, size, mtime)``) the file
+        was copied from, if the file has the content of that source.
+        """
+        if self.simulate or not os.path.exists(filename):
+            return
+        digest = content_hash(content)
+        manifest = self._manifest(os.path.dirname(filename))
+        name = os.path.basename(filename)
+        entry = manifest.lookup(name, os.stat(filename))
+        if entry is not None and entry['md5'] == digest:
+            manifest.record(name, os.stat(filename), digest, source=source)
+
+    def save_manifests(self):
+        """
+        Writes out any manifests that have changed.  In a changeset
+        this waits until the changeset is committed.
+        """
+        if self.changeset is not None:
+            return
+        self._lock.acquire()
+        try:
+            for manifest in self._manifests.values():
+                manifest.save()
+        finally:
+            self._lock.release()
 
     def _writefile(self, filename, contents):
         """
         Write the contents to a file.
+
+        The file is written to a temporary file that is renamed into
+        place (keeping the mode of any existing file), so an
+        interrupted write never leaves a truncated file.  How it is
+        flushed to disk depends on ``self.durability``.
         """
         self.logger.debug('Writing %i bytes to %s' %
                           (len(contents), filename))
-        f = open(filename, 'wb')
-        f.write(contents)
-        f.close()
+        # (Through a symlink it is the target that is replaced)
+        self._changing(os.path.realpath(filename))
+        util.atomic_write(filename, contents, fsync=self.durability == 'file')
+        self._written(filename)
+
+    def _copyfile(self, src, dest, source=None):
+        """
+        Copies the file ``src`` to ``dest`` in chunks, like
+        ``_writefile`` does.  ``source`` is recorded in the manifest.
+        """
+        self.logger.debug('Copying %s to %s' % (src, dest))
+        self._changing(os.path.realpath(dest))
+        digest = util.atomic_copy(src, dest, fsync=self.durability == 'file')
+        self._written(dest)
+        self._manifest_record_digest(dest, digest, source)
+
+    def _written(self, filename):
+        if self.events.enabled:
+            self.events.emit('file_written', path=filename, kind='file',
+                             size=os.path.getsize(filename))
+        if self.durability == 'task':
+            self._lock.acquire()
+            try:
+                self._unsynced_files.add(os.path.realpath(filename))
+            finally:
+                self._lock.release()
+
+    def _created(self, path, kind, **fields):
+        # (For directories and symlinks, which need no syncing)
+        if self.events.enabled:
+            self.events.emit('file_written', path=path, kind=kind, **fields)
+
+    def sync(self):
+        """
+        Flushes the files written since the last sync (and their
+        directories) to disk.  Called at the end of each task, when
+        ``self.durability`` is ``'task'``.
+        """
+        self._lock.acquire()
+        try:
+            files = self._unsynced_files
+            self._unsynced_files = set()
+        finally:
+            self._lock.release()
+        if not files:
+            return
+        dirs = set()
+        for filename in files:
+            if os.path.exists(filename):
+                util.fsync_file(filename)
+                dirs.add(os.path.dirname(filename))
+        for dirname in dirs:
+            util.fsync_dir(dirname)
+        self.logger.debug('Synced %i files in %i directories to disk'
+                          % (len(files), len(dirs)))
+
+    def begin_changeset(self):
+        """
+        Starts a changeset (see `fassembler.changeset`): until it is
+        committed or rolled back, every change is recorded so it can be
+        undone, and questions about conflicting files are put off.
+        """
+        assert self.changeset is None, (
+            "A changeset is already active: %r" % self.changeset)
+        self.changeset = Changeset(self.trash_dir)
+
+    def resolve_conflicts(self):
+        """
+        Presents the conflicts that were put off in the active
+        changeset, and asks about each of them.  The changeset stays
+        active.  This is done after each task, so that a later task
+        can't change a file before it has been asked about.
+        """
+        changeset = self.changeset
+        conflicts = changeset.conflicts
+        if not conflicts:
+            return
+        changeset.conflicts = []
+        self.logger.notify('%i files conflict with their new content:'
+                           % len(conflicts), color='bold cyan')
+        for filename, redo in conflicts:
+            self.logger.notify('  %s' % self.display_path(filename))
+        changeset.deferring = False
+        try:
+            for filename, redo in conflicts:
+                redo()
+        finally:
+            changeset.deferring = True
+
+    def commit_changeset(self):
+        """
+        Resolves the conflicts that are left (see `resolve_conflicts`),
+        and ends the changeset.  If this raises an exception the
+        changeset is still active, and should be rolled back.
+        """
+        changeset = self.changeset
+        self.resolve_conflicts()
+        self.changeset = None
+        self.logger.info('Applied %i changes' % len(changeset.journal))
+        if changeset.journal_dir is not None:
+            self._delete_in_background(changeset.journal_dir)
+        self.flush_svn_adds()
+        self.save_manifests()
+
+    def rollback_changeset(self):
+        """
+        Undoes all the changes made in the active changeset, and ends it.
+        """
+        changeset = self.changeset
+        self.changeset = None
+        self.logger.notify('Rolling back %i changes' % len(changeset.journal),
+                           color='red')
+        self._lock.acquire()
+        try:
+            self._svn_adds = []
+            self._svn_add_set = set()
+            # The manifests' changes since the changeset began (which
+            # haven't been saved) describe files that are being undone:
+            self._manifests = {}
+        finally:
+            self._lock.release()
+        failed = changeset.rollback(self.logger, self._forget_dirs)
+        if failed:
+            self.logger.warn('%i changes could not be rolled back' % failed)
+        if changeset.journal_dir is not None:
+            self._delete_in_background(changeset.journal_dir)
+
+    def _changing(self, filename):
+        """
+        Called before a file or symlink is written, created or removed
+        """
+        if self.changeset is not None:
+            self.changeset.file_changing(filename)
+
+    def _defer_conflict(self, filename, redo):
+        """
+        In a changeset, puts off asking about a conflicting file until
+        the task is done (when ``redo()`` is called, see
+        `resolve_conflicts`).
+        Returns true if it was put off.
+        """
+        changeset = self.changeset
+        if changeset is None or not changeset.deferring or not self._interactive:
+            return False
+        self.logger.notify('File %s conflicts with its new content; will ask later'
+                           % self.display_path(filename))
+        changeset.defer(filename, redo)
+        return True
 
     def fill(self, contents, template_vars, filename=None):
         """
@@ -229,8 +781,58 @@ class Maker(object):
         A more thorough normalization of a path than just what ``os.path.normpath`` does.
         """
         assert isinstance(path, basestring), "Bad path: %r" % (path, )
-        path = os.path.expanduser(path)
-        return os.path.normcase(os.path.abspath(path))
+        try:
+            result = self._normpaths[path]
+        except KeyError:
+            pass
+        else:
+            self.normpath_hits += 1
+            return result
+        result = os.path.expanduser(path)
+        # Relative paths depend on the current directory, so they
+        # aren't remembered:
+        cache = os.path.isabs(result)
+        result = os.path.normcase(os.path.abspath(result))
+        if cache:
+            self._normpaths[path] = result
+        return result
+
+    def _forget_dirs(self, path):
+        """
+        Forgets that ``path`` and any directories under it exist
+        """
+        path = self._normpath(path)
+        prefix = path.rstrip(os.sep) + os.sep
+        self._lock.acquire()
+        try:
+            for dir in list(self._known_dirs):
+                if dir == path or dir.startswith(prefix):
+                    self._known_dirs.discard(dir)
+        finally:
+            self._lock.release()
+
+    def forget_known_dirs(self):
+        """
+        Forgets all the directories known to exist.  This is called
+        after anything that might have removed directories without
+        the Maker knowing (commands, and the code of tasks).
+        """
+        self._lock.acquire()
+        try:
+            self._known_dirs.clear()
+        finally:
+            self._lock.release()
+
+    def log_cache_stats(self):
+        """
+        Logs how much path checking was avoided by caching.
+        """
+        if self.known_dir_hits or self.normpath_hits:
+            self.logger.info('Paths: %s directory stat calls and %s normalizations saved by caching'
+                             % (self.known_dir_hits, self.normpath_hits))
+        if self.probes.hits:
+            self.logger.info('Probes: %s commands not run because their output was cached'
+                             % self.probes.hits)
     
     def copy_dir(self, src, dest, sub_filenames=True, template_vars=None, interpolater=None, include_hidden=False,
                  add_dest_to_svn=False):
@@ -256,6 +858,7 @@ class Maker(object):
         if template_vars is None:
             sub_filenames = False
         skips = []
+        files = []
         dest = self.path(dest)
         self.ensure_dir(dest, svn_add=add_dest_to_svn)
         for dirpath, dirnames, filenames in os.walk(src):
@@ -296,7 +899,78 @@ class Maker(object):
                     destfn = self.fill_filename(destfn, template_vars)
                     if orig_destfn != destfn:
                         self.logger.debug('Filling name %s to %s' % (orig_destfn, destfn))
-                self.copy_file(os.path.join(src, dirpath, filename), destfn, template_vars=template_vars, interpolater=interpolater)
+                # Directories are all created here, in order, before any copying:
+                self.ensure_dir(os.path.dirname(destfn))
+                files.append((os.path.join(src, dirpath, filename), destfn))
+        if self.jobs > 1 and len(files) > 1:
+            self._copy_files_parallel(files, template_vars, interpolater)
+        else:
+            for src_fn, dest_fn in files:
+                self.copy_file(src_fn, dest_fn, template_vars=template_vars, interpolater=interpolater)
+        self.save_manifests()
+
+    def _copy_files_parallel(self, files, template_vars, interpolater):
+        """
+        Copies ``files`` (a list of ``(src, dest)``) with up to
+        ``self.jobs`` worker threads.
+
+        The workers read, fill and write the files.  The calling
+        thread reports their output, in order.  Any file that needs a question (or fails) is copied
+        again by the calling thread, just like ``copy_file`` would.
+        """
+        jobs = [_CopyJob(src, dest, self._logger) for src, dest in files]
+        pending = list(jobs)
+        pending.reverse()
+        condition = threading.Condition()
+        stopped = []
+        def worker():
+            while 1:
+                condition.acquire()
+                try:
+                    if stopped or not pending:
+                        return
+                    job = pending.pop()
+                finally:
+                    condition.release()
+                self._local.job = job
+                try:
+                    try:
+                        self.copy_file(job.src, job.dest, template_vars=template_vars,
+                                       interpolater=interpolater)
+                    except:
+                        job.redo = True
+                finally:
+                    self._local.job = None
+                    condition.acquire()
+                    job.done = True
+                    condition.notifyAll()
+                    condition.release()
+        threads = []
+        for i in range(min(self.jobs, len(jobs))):
+            t = threading.Thread(target=worker)
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        try:
+            for job in jobs:
+                condition.acquire()
+                try:
+                    while not job.done:
+                        # (A timeout keeps this interruptable with ^C)
+                        condition.wait(0.5)
+                finally:
+                    condition.release()
+                if job.redo:
+                    self.copy_file(job.src, job.dest, template_vars=template_vars,
+                                   interpolater=interpolater)
+                    continue
+                job.logger.replay()
+        finally:
+            condition.acquire()
+            stopped.append(True)
+            condition.release()
+            for t in threads:
+                t.join()
 
     def is_hidden(self, filename):
         return os.path.basename(filename).startswith('.')
@@ -354,24 +1028,30 @@ class Maker(object):
             # first?  Though presumably the current directory always
             # exists.
             return
+        if dir in self._known_dirs:
+            self.known_dir_hits += 1
+            self.logger.debug("Directory already exists: %s" % self.display_path(dir))
+            return
         if not os.path.exists(dir):
             self.ensure_dir(os.path.dirname(dir), svn_add=svn_add, package=package)
             self.logger.notify('Creating %s' % self.display_path(dir))
             if not self.simulate:
                 os.mkdir(dir)
-            if (svn_add and
-                os.path.exists(os.path.join(os.path.dirname(dir), '.svn'))):
-                self.svn_command('add', dir)
+                self._created(dir, 'directory')
+                self._known_dirs.add(dir)
+                if self.changeset is not None:
+                    self.changeset.dir_created(dir)
+            if svn_add:
+                self.svn_add(dir)
             if package:
                 initfile = os.path.join(dir, '__init__.py')
-                f = open(initfile, 'wb')
-                f.write("#\n")
-                f.close()
+                if not self.simulate:
+                    self._writefile(initfile, "#\n")
                 self.logger.notify('Creating %s' % self.display_path(initfile))
-                if (svn_add and
-                    os.path.exists(os.path.join(os.path.dirname(dir), '.svn'))):
-                    self.svn_command('add', initfile)
+                if svn_add:
+                    self.svn_add(initfile)
         else:
+            self._known_dirs.add(dir)
             self.logger.debug("Directory already exists: %s" % self.display_path(dir))
 
     def ensure_file(self, filename, content, svn_add=True, package=False,
@@ -387,36 +1067,39 @@ class Maker(object):
             if not quiet:
                 self.logger.info('Creating %s' % filename)
             if not self.simulate:
-                f = open(filename, 'wb')
-                f.write(content)
-                f.close()
+                self._writefile(filename, content)
             if executable:
                 self.make_executable(filename)
-            if svn_add and os.path.exists(os.path.join(os.path.dirname(filename), '.svn')):
-                self.svn_command('add', filename)
+            self._manifest_record(filename, content)
+            if svn_add:
+                self.svn_add(filename)
             return
-        f = open(filename, 'rb')
-        old_content = f.read()
-        f.close()
-        base_content = self._get_base_contents(filename)
-        if content == old_content:
+        if self._content_matches(filename, content):
             if not quiet:
                 self.logger.info('File %s matches expected content' % filename)
             if executable and not os.stat(filename).st_mode&0111:
                 self.make_executable(filename)
+            self._manifest_record(filename, content)
             return
         show_overwrite_warning = True
-        if base_content and base_content == old_content:
+        if self._base_matches(filename):
             if not quiet:
                 self.logger.notify('File %s was not edited and content has changed, overwriting'
                                    % self.display_path(filename),
                                    color='cyan')
             show_overwrite_warning = False
         elif not overwrite:
+            if self._defer_conflict(filename, lambda: self.ensure_file(
+                    filename, content, svn_add=svn_add, package=package,
+                    overwrite=overwrite, executable=executable, quiet=quiet)):
+                return
+            if self._interactive and getattr(self._local, 'job', None) is not None:
+                raise _RedoInMainThread()
             if not quiet:
                 self.logger.notify('Warning: file %s does not match expected content' % filename)
             if self.interactive:
-                response = self.ask_difference(filename, None, content, old_content)
+                response = self.ask_difference(filename, None, content,
+                                               self._read_for_diff(filename))
                 if not response:
                     return
             else:
@@ -426,11 +1109,10 @@ class Maker(object):
             if not quiet:
                 self.logger.notify('Overwriting %s with new content' % filename)
         if not self.simulate:
-            f = open(filename, 'wb')
-            f.write(content)
-            f.close()
+            self._writefile(filename, content)
             if executable:
                 self.make_executable(filename)
+            self._manifest_record(filename, content)
 
     def make_executable(self, filename):
         """
@@ -438,16 +1120,74 @@ class Maker(object):
         """
         self.logger.info('Making file %s executable' % filename)
         if not self.simulate:
+            if self.changeset is not None:
+                self.changeset.mode_changing(os.path.realpath(filename))
             st_mode = os.stat(filename).st_mode
             st_mode |= 0111
             os.chmod(filename, st_mode)
 
     _svn_failed = False
 
+    # Largest total length of the paths given to one svn add:
+    svn_add_max_length = 32*1024
+
+    def svn_add(self, path):
+        """
+        Queues ``path`` (just created) to be added to subversion, if
+        the directory it is in is under subversion (or is queued to
+        be).  The queue is flushed with ``flush_svn_adds()``, at the
+        end of each task.
+        """
+        self._lock.acquire()
+        try:
+            parent = os.path.dirname(path)
+            if (path not in self._svn_add_set
+                and (parent in self._svn_add_set
+                     or os.path.exists(os.path.join(parent, '.svn')))):
+                self._svn_adds.append(path)
+                self._svn_add_set.add(path)
+        finally:
+            self._lock.release()
+
+    def flush_svn_adds(self):
+        """
+        Adds all the queued paths to subversion, with as few ``svn
+        add`` commands as possible.  In a changeset this waits until
+        the changeset is committed.
+        """
+        if self.changeset is not None:
+            return
+        self._lock.acquire()
+        try:
+            paths = self._svn_adds
+            self._svn_adds = []
+            self._svn_add_set = set()
+        finally:
+            self._lock.release()
+        chunk = []
+        length = 0
+        for path in paths:
+            if chunk and length + len(path) > self.svn_add_max_length:
+                self._svn_add_paths(chunk)
+                chunk = []
+                length = 0
+            chunk.append(path)
+            length += len(path) + 1
+        if chunk:
+            self._svn_add_paths(chunk)
+
+    def _svn_add_paths(self, paths):
+        # Each path is added by itself (--depth=empty), parents first
+        # (--parents); --force skips anything already added.
+        self.svn_command('add', '--parents', '--depth=empty', '--force', *paths)
+
     def svn_command(self, *args, **kw):
         """
         Run an svn command, but don't raise an exception if it fails.
         """
+        if self._svn_adds and args[:1] != ('add',):
+            # Other commands should see the files that are to be added:
+            self.flush_svn_adds()
         try:
             return self.run_command('svn', *args, **kw)
         except OSError, e:
@@ -471,6 +1211,7 @@ class Maker(object):
             # Sign of a broken symlink
             self.logger.info('Removing broken link %s' % dest)
             if not self.simulate:
+                self._changing(dest)
                 os.unlink(dest)
         if os.path.exists(dest) and overwrite:
             if os.path.islink(dest):
@@ -478,6 +1219,7 @@ class Maker(object):
                 self.logger.notify('Removing symlink %s (-> %s)'
                                    % (dest, os.path.realpath(dest)))
                 if not self.simulate:
+                    self._changing(dest)
                     os.unlink(dest)
             else:
                 self.logger.warn('Cannot remove symlink destination %s because it is not a symlink'
@@ -485,7 +1227,9 @@ class Maker(object):
         if not os.path.exists(dest):
             self.logger.info('Symlinking %s to %s' % (source, dest))
             if not self.simulate:
+                self._changing(dest)
                 os.symlink(source, dest)
+                self._created(dest, 'symlink', target=source)
             return
         if os.path.realpath(dest) == source:
             self.logger.info('Symlink %s -> %s already exists and is correct' % (dest, source))
@@ -500,6 +1244,9 @@ class Maker(object):
                 noun = 'file'
             msg = 'At %s there is a %s; this should be a symlink from %s' % (
                 dest, noun, source)
+        if self._defer_conflict(dest, lambda: self.ensure_symlink(
+                source, dest, overwrite=overwrite)):
+            return
         response = self.ask(
             msg,
             responses=['(i)gnore',
@@ -510,30 +1257,131 @@ class Maker(object):
             self.logger.notify('Skipping symlinking %s to %s' % (source, dest))
             return
         elif response == 'b':
-            self.backup(dest)
+            self.backup(dest, replacing=True)
+            if os.path.lexists(dest) and not self.simulate:
+                # The backup had to be a copy:
+                if os.path.isdir(dest) and not os.path.islink(dest):
+                    self.rmtree(dest)
+                else:
+                    self._changing(dest)
+                    os.unlink(dest)
         elif response == 'w':
             if os.path.islink(dest):
                 self.logger.notify('Removing symlink at %s' % dest)
+                self._changing(dest)
                 os.unlink(dest)
             else:
                 self.logger.notify('Removing dir/file at %s' % dest)
-                shutil.rmtree(dest)
+                self.rmtree(dest)
         else:
             assert 0
         self.logger.info('Symlinking %s to %s' % (source, dest))
         if not self.simulate:
+            self._changing(dest)
             os.symlink(source, dest)
+            self._created(dest, 'symlink', target=source)
 
     def rmtree(self, filename):
         """
         Deletes a tree recursively.
+
+        If there is a ``trash_dir`` the tree is renamed into it and
+        deleted in the background, so this returns right away; if it
+        can't be moved there (e.g., it is on another filesystem) it is
+        deleted here.
         """
         if not os.path.isdir(filename):
             self.logger.fatal('%s is not a directory' % filename)
             raise OSError('%s is not a directory' % filename)
         self.logger.debug('Deleting recursively: %s' % filename)
         if not self.simulate:
-            shutil.rmtree(filename)
+            self._forget_dirs(filename)
+            if self.changeset is not None:
+                if self.changeset.move_away(filename):
+                    return
+                self.logger.warn('Cannot move %s aside; deleting it cannot be rolled back'
+                                 % filename)
+            if not self._move_to_trash(filename):
+                shutil.rmtree(filename)
+
+    def _move_to_trash(self, filename):
+        """
+        Moves the tree into the trash and starts deleting it.  Returns
+        false if it couldn't be moved.
+        """
+        if not self.trash_dir:
+            return False
+        try:
+            if not os.path.exists(self.trash_dir):
+                os.makedirs(self.trash_dir)
+            holder = tempfile.mkdtemp(
+                prefix=os.path.basename(filename.rstrip(os.sep)) + '-',
+                dir=self.trash_dir)
+        except OSError, e:
+            self.logger.info('Cannot use trash directory %s (%s); deleting %s now'
+                             % (self.trash_dir, e, filename))
+            return False
+        try:
+            os.rename(filename, os.path.join(holder, 'tree'))
+        except OSError, e:
+            os.rmdir(holder)
+            self.logger.debug('Cannot move %s to the trash (%s); deleting it now'
+                              % (filename, e))
+            return False
+        self._delete_in_background(holder)
+        return True
+
+    def empty_trash(self):
+        """
+        Starts deleting anything left in the trash by earlier runs.
+        """
+        if not self.trash_dir or self.simulate or not os.path.isdir(self.trash_dir):
+            return
+        names = os.listdir(self.trash_dir)
+        if names:
+            self.logger.info('Deleting %i trees left in %s'
+                             % (len(names), self.trash_dir))
+        for name in names:
+            self._delete_in_background(os.path.join(self.trash_dir, name))
+
+    def _delete_in_background(self, path):
+        """
+        Starts ``rm -rf`` on the path in its own session, so it carries
+        on after fassembler exits (or is interrupted).  Whatever it
+        doesn't get to is deleted by ``empty_trash`` in the next run.
+        """
+        self.reap_deleters()
+        devnull = open(os.devnull, 'r+')
+        try:
+            try:
+                proc = subprocess.Popen(['rm', '-rf', path],
+                                        stdin=devnull, stdout=devnull, stderr=devnull,
+                                        close_fds=True,
+                                        preexec_fn=getattr(os, 'setsid', None))
+            except OSError, e:
+                self.logger.debug('Cannot run rm (%s); deleting %s now' % (e, path))
+                shutil.rmtree(path, True)
+            else:
+                self._lock.acquire()
+                try:
+                    self._deleters.append(proc)
+                finally:
+                    self._lock.release()
+        finally:
+            devnull.close()
+
+    def reap_deleters(self):
+        """
+        Collects the exit status of the ``rm`` processes started by
+        `_delete_in_background` that have finished, so they don't stay
+        around as zombies.  The others are left running.
+        """
+        self._lock.acquire()
+        try:
+            self._deleters = [proc for proc in self._deleters
+                              if proc.poll() is None]
+        finally:
+            self._lock.release()
 
     def run_command(self, cmd, *args, **kw):
         """
@@ -579,11 +1427,29 @@ class Maker(object):
 
         ``log_filter``:
             This is a function that takes a line of output from the
-            program, and returns either a log level alone, or
-            (new_line, level).  If not provided, then the output of
-            the process will not be displayed.  You may also give an
-            integer which will be the level of all output (e.g.,
-            logger.INFO).
+            program (stdout or stderr), and returns either a log level
+            alone, or (new_line, level).  If not provided, then the
+            output of the process is only logged at the debug level.
+            You may also give an integer which will be the level of
+            all output (e.g., logger.INFO).  stderr is not merged into
+            stdout (the filter sees the lines of both, but only stdout
+            is returned); use ``capture_stderr`` for that.
+
+        ``max_output``:
+            If given, the most bytes of stdout (and of stderr) that
+            are kept and returned; past that the middle of the output
+            is dropped.  By default all of it is kept (only the output
+            shown in an error message is bounded, by
+            ``self.max_command_output``).
+
+        ``timeout``:
+            The most seconds the script may run (by default
+            ``self.command_timeout``; None for no limit).  After that
+            its process group gets SIGTERM, then SIGKILL after
+            ``self.kill_grace_period`` seconds, and a
+            `CommandTimeoutError` is raised.  A script with a timeout
+            runs in its own process group, so it can't read from the
+            terminal.
 
         ``shell``:
             Run the command string in a child shell. Default False.
@@ -604,6 +1470,8 @@ class Maker(object):
         stdin = popdefault(kw, 'stdin', None)
         log_filter = popdefault(kw, 'log_filter', None)
         use_shell = popdefault(kw, 'shell', False)
+        max_output = popdefault(kw, 'max_output', None)
+        timeout = popdefault(kw, 'timeout', self.command_timeout)
         if extra_path:
             env = env.copy()
             path_parts = env.get('PATH', '').split(os.path.pathsep)
@@ -611,7 +1479,7 @@ class Maker(object):
         if script_abspath:
             cmd = self._script_abspath(cmd, script_abspath)
         assert not kw, ("Arguments not expected: %s" % kw)
-        if capture_stderr or log_filter:
+        if capture_stderr:
             stderr_pipe = subprocess.STDOUT
         else:
             stderr_pipe = subprocess.PIPE
@@ -621,6 +1489,12 @@ class Maker(object):
             stdin_argument = subprocess.PIPE
         else:
             stdin_argument = None
+        if timeout:
+            # So the script and everything it starts can be killed together:
+            preexec_fn = os.setpgrp
+        else:
+            preexec_fn = None
+        start = time.time()
         try:
             proc = subprocess.Popen(cmd,
                                     cwd=cwd,
@@ -628,7 +1502,8 @@ class Maker(object):
                                     stdin=stdin_argument,
                                     stderr=stderr_pipe,
                                     stdout=subprocess.PIPE,
-                                    shell=use_shell)
+                                    shell=use_shell,
+                                    preexec_fn=preexec_fn)
         except OSError, e:
             if e.errno != 2:
                 # File not found
@@ -647,35 +1522,55 @@ class Maker(object):
                 return (None, None, 0)
             else:
                 return None
-        if stdin:
-            proc.stdin.write(stdin)
-        if log_filter:
-            stdout = []
-            stdout_pipe = proc.stdout
-            while 1:
-                line = stdout_pipe.readline()
-                if not line:
-                    break
-                stdout.append(line)
-                line = line.rstrip()
-                if isinstance(log_filter, int):
-                    level = log_filter
-                else:
-                    level = log_filter(line)
-                if isinstance(level, tuple):
-                    line, level = level
-                if line:
-                    self.logger.log(level, line)
-                if not self.logger.stdout_level_matches(level):
-                    self.logger.show_progress()
-            stdout = ''.join(stdout)
-            stderr = ''
-            # Bug #2128: The return code isn't set just by reading stdout;
-            # you have to call wait() or communicate().
-            proc.wait()
-        else:
-            stdout, stderr = proc.communicate()
-        if proc.returncode and not expect_returncode:
+        self.events.emit('command_start', pid=proc.pid, argv=cmd, cwd=cwd,
+                         task=self.current_task)
+        def log_line(line):
+            line = line.rstrip()
+            if log_filter is None:
+                level = self.logger.DEBUG
+            elif isinstance(log_filter, int):
+                level = log_filter
+            else:
+                level = log_filter(line)
+            if isinstance(level, tuple):
+                line, level = level
+            if line:
+                self.logger.log(level, line)
+            if log_filter is not None and not self.logger.stdout_level_matches(level):
+                self.logger.show_progress()
+        try:
+            try:
+                stdout, stderr = communicate(proc, stdin, log_line, log_line, max_output,
+                                             timeout=timeout or None,
+                                             grace_period=self.kill_grace_period)
+            except TimeoutExpired, e:
+                self.logger.warn('Killed %s after %s seconds' % (self._format_command(cmd), timeout),
+                                 color='bold red')
+                raise CommandTimeoutError(
+                    "Command %s timed out after %s seconds" % (self._format_command(cmd), timeout),
+                    command=cmd, stdout=e.stdout, stderr=e.stderr,
+                    returncode=proc.returncode)
+            except:
+                # Whatever went wrong (a KeyboardInterrupt, which a
+                # process group doesn't get from the terminal, or an
+                # error in log_filter), the command mustn't be left
+                # running and unwaited for:
+                exc_info = sys.exc_info()
+                if proc.returncode is None:
+                    try:
+                        if preexec_fn is not None:
+                            kill_process_group(proc, self.kill_grace_period)
+                        else:
+                            kill_process(proc)
+                    except OSError, e:
+                        self.logger.warn('Could not kill %s: %s' % (self._format_command(cmd), e))
+                raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            self._record_command(cmd, proc, time.time()-start)
+            self.forget_known_dirs()
+        # (A return code of None means the exit status was lost; see
+        # procio.wait)
+        if (proc.returncode or proc.returncode is None) and not expect_returncode:
             if log_error:
                 self.logger.log(slice(self.logger.WARN, self.logger.FATAL),
                                 'Running %s' % self._format_command(cmd), color='bold red')
@@ -684,29 +1579,211 @@ class Maker(object):
                     self.logger.warn('stdout:')
                     self.logger.indent += 2
                     try:
-                        self.logger.warn(stdout)
+                        self.logger.warn(self._bounded_output(stdout))
                     finally:
                         self.logger.indent -= 2
                 if stderr:
                     self.logger.warn('stderr:')
                     self.logger.indent += 2
                     try:
-                        self.logger.warn(stderr)
+                        self.logger.warn(self._bounded_output(stderr))
                     finally:
                         self.logger.indent -= 2
             raise RunCommandError("Error executing command %s (code %s)" %
                                   (self._format_command(cmd), proc.returncode),
                                   command=cmd, stdout=stdout, stderr=stderr,
                                   returncode=proc.returncode)
-        if stderr:
-            self.logger.debug('Command error output:\n%s' % stderr)
-        if stdout:
-            self.logger.debug('Command output:\n%s' % stdout)
         if return_full:
             return (stdout, stderr, proc.returncode)
         else:
             return stdout
 
+    def _bounded_output(self, output):
+        buffer = OutputBuffer(self.max_command_output)
+        buffer.write(output)
+        return buffer.getvalue()
+
+    def probe(self, cmd, depends=(), **kw):
+        """
+        Runs a command that only finds something out (like ``httpd
+        -v``), returning ``(stdout, stderr, returncode)``.  ``cmd`` is
+        a list of the executable and its arguments.  The command is run
+        even when simulating, and a non-zero exit code is not an error.
+
+        The output is kept (see `fassembler.probes`), and used instead
+        of running the command again until the executable or any of
+        the files in ``depends`` changes; if ``depends`` is None, what
+        the output depends on isn't known, and it isn't kept.  Other
+        keyword arguments are passed to ``run_command``.
+        """
+        env = kw.get('env', os.environ)
+        extra_path = kw.get('extra_path')
+        if extra_path:
+            # (As run_command will run it)
+            env = env.copy()
+            env['PATH'] = os.path.pathsep.join(list(extra_path) + [env.get('PATH', '')])
+        if depends is None:
+            executable = None
+        else:
+            executable = find_executable(cmd[0], env.get('PATH', os.defpath))
+        args = [str(arg) for arg in cmd[1:]]
+        if executable is not None:
+            self._lock.acquire()
+            try:
+                result = self.probes.lookup(executable, args, depends, env)
+            finally:
+                self._lock.release()
+            if result is not None:
+                self.logger.debug('Using the cached output of %s' % self._format_command(cmd))
+                return result
+        result = self.run_command(cmd, return_full=True, expect_returncode=True,
+                                  log_error=False, simulate=False, **kw)
+        if executable is not None and result[2] is not None:
+            self._lock.acquire()
+            try:
+                stdout, stderr, returncode = result
+                self.probes.store(executable, args, depends,
+                                  stdout, stderr, returncode, environ=env)
+            finally:
+                self._lock.release()
+        return result
+
+    def _record_command(self, cmd, proc, wall):
+        stats = CommandStats(cmd, self.current_task, wall,
+                             getattr(proc, 'rusage', None), proc.returncode)
+        self._lock.acquire()
+        try:
+            self.command_stats.append(stats)
+        finally:
+            self._lock.release()
+        self.events.emit('command_end', pid=proc.pid, argv=cmd, task=stats.task,
+                         duration=wall, returncode=stats.returncode,
+                         user=stats.user, sys=stats.sys, maxrss=stats.maxrss)
+        if stats.cpu is not None:
+            self.logger.debug('Took %.1fs (%.1fs CPU, %iMB peak memory, %i/%i blocks read/written)'
+                              % (wall, stats.cpu, stats.maxrss // 1024,
+                                 stats.inblock, stats.oublock))
+
+    def log_command_report(self, limit=5):
+        """
+        Logs the time taken by all the commands run, and the kinds of
+        commands (see `procio.command_label`) that took the most wall
+        time and CPU.
+        """
+        if not self.command_stats:
+            return
+        totals = {}
+        for stats in self.command_stats:
+            total = totals.setdefault(stats.label, [0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += stats.wall
+            total[2] += stats.cpu or 0.0
+        self.logger.notify('Ran %i commands: %.1fs wall time, %.1fs CPU' % (
+            len(self.command_stats), sum([t[1] for t in totals.values()]),
+            sum([t[2] for t in totals.values()])))
+        for title, index in [('wall time', 1), ('CPU', 2)]:
+            ranked = sorted(totals.items(), key=lambda item: -item[1][index])
+            self.logger.info('Commands that took the most %s:' % title)
+            self.logger.indent += 2
+            try:
+                for label, (count, wall, cpu) in ranked[:limit]:
+                    self.logger.info('%8.1fs wall %8.1fs CPU %5ix  %s' % (wall, cpu, count, label))
+            finally:
+                self.logger.indent -= 2
+
+    def run_commands(self, commands, max_workers=None):
+        """
+        Runs several independent commands at the same time, at most
+        ``max_workers`` (by default ``self.jobs``) at once.
+
+        Each command is either what you would pass as the first
+        argument of ``run_command`` (a string, or a list of the script
+        and its arguments), or a tuple ``(cmd, kw)`` of that and the
+        keyword arguments for ``run_command``.  Returns a list with
+        ``(stdout, stderr, returncode)`` for each command, in order.
+
+        The log output of each command is kept together, and written
+        (in the order of the commands) as they finish.  If a command
+        fails, no more commands are started, and once the running ones
+        have finished the first error is raised.
+        """
+        if max_workers is None:
+            max_workers = self.jobs
+        jobs = []
+        for command in commands:
+            if isinstance(command, tuple):
+                cmd, kw = command
+                kw = kw.copy()
+            else:
+                cmd, kw = command, {}
+            kw['return_full'] = True
+            jobs.append(_CommandJob(cmd, kw, self._logger))
+        if max_workers <= 1 or len(jobs) <= 1:
+            return [self.run_command(job.cmd, **job.kw) for job in jobs]
+        pending = list(jobs)
+        pending.reverse()
+        condition = threading.Condition()
+        stopped = []
+        def worker():
+            while 1:
+                condition.acquire()
+                try:
+                    if stopped or not pending:
+                        return
+                    job = pending.pop()
+                finally:
+                    condition.release()
+                self._local.job = job
+                try:
+                    try:
+                        job.result = self.run_command(job.cmd, **job.kw)
+                    except:
+                        job.exc_info = sys.exc_info()
+                finally:
+                    self._local.job = None
+                    condition.acquire()
+                    if job.exc_info is not None:
+                        stopped.append(True)
+                    job.done = True
+                    condition.notifyAll()
+                    condition.release()
+        threads = []
+        for i in range(min(max_workers, len(jobs))):
+            t = threading.Thread(target=worker)
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        results = []
+        exc_info = None
+        try:
+            for job in jobs:
+                condition.acquire()
+                try:
+                    while not job.done and not (stopped and job in pending):
+                        # (A timeout keeps this interruptable with ^C)
+                        condition.wait(0.5)
+                        # The workers' progress is shown from here:
+                        if [other for other in jobs if other.logger.take_progress()]:
+                            self._logger.show_progress()
+                finally:
+                    condition.release()
+                if not job.done:
+                    # Never started, because of an earlier failure
+                    continue
+                job.logger.replay()
+                if job.exc_info is not None and exc_info is None:
+                    exc_info = job.exc_info
+                results.append(job.result)
+        finally:
+            condition.acquire()
+            stopped.append(True)
+            condition.release()
+            for t in threads:
+                t.join()
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return results
+
     def _script_abspath(self, cmd, abspath):
         """
         Rewrite the command to use the given abspath
@@ -791,10 +1868,11 @@ class Maker(object):
                             ['svn', 'switch', repo, dest])
                     elif response == 'b' or response == 'w':
                         if response == 'b':
-                            self.backup(dest)
+                            self.backup(dest, replacing=True)
                         else:
                             self.logger.warn('Deleting checkout %s' % dest)
-                        self.rmtree(dest)
+                        if os.path.exists(dest):
+                            self.rmtree(dest)
                     else:
                         assert 0, response
         if self.exists(dest) and current_repo:
@@ -822,24 +1900,46 @@ class Maker(object):
 
     _repo_url_re = re.compile(r'^URL:\s+(.*)$', re.MULTILINE)
 
+    def _svn_metadata(self, path):
+        """
+        The files with the svn metadata of ``path`` (which change when
+        its URL does): the ``.svn/wc.db`` at the root of the working
+        copy for svn >= 1.7, which only has a ``.svn`` directory
+        there, or ``.svn/entries`` for older versions, which have one
+        in every directory.  None if ``path`` isn't in a working copy.
+        """
+        dir = os.path.abspath(path)
+        while 1:
+            svn_dir = os.path.join(dir, '.svn')
+            if os.path.isdir(svn_dir):
+                wc_db = os.path.join(svn_dir, 'wc.db')
+                if os.path.exists(wc_db):
+                    return [wc_db]
+                return [os.path.join(svn_dir, 'entries')]
+            parent = os.path.dirname(dir)
+            if parent == dir:
+                return None
+            dir = parent
+
     def _get_repo_url(self, path):
         """
         Get the subversion URL that path was checked out from
         """
         ## FIXME: ideally we'd set LANG or something, as the output
         ## can get i18n'd
-        try:
-            stdout = self.run_command(
-                ['svn', 'info', path],
-                log_error=False,
-                simulate=False)
-        except RunCommandError, e:
-            if 'is not a working copy' in e.stderr:
+        cmd = ['svn', 'info', path]
+        stdout, stderr, returncode = self.probe(
+            cmd, depends=self._svn_metadata(path))
+        if returncode:
+            if 'is not a working copy' in stderr:
                 # Not really a problem
                 return None
-            if 'no es una copia de trabajo' in e.stderr:
+            if 'no es una copia de trabajo' in stderr:
                 return None
-            raise
+            raise RunCommandError("Error executing command %s (code %s)" %
+                                  (self._format_command(cmd), returncode),
+                                  command=cmd, stdout=stdout, stderr=stderr,
+                                  returncode=returncode)
         match = self._repo_url_re.search(stdout)
         if not match:
             raise ValueError(
@@ -861,7 +1961,8 @@ class Maker(object):
         return highlight(text, lexers.get_lexer_by_name('diff'),
                          formatters.get_formatter_by_name('terminal'))
 
-    def ask_difference(self, dest_fn, message, new_content, cur_content):
+    def ask_difference(self, dest_fn, message, new_content, cur_content,
+                       new_filename=None):
         """
         Ask about the differences between two files, and whether the
         old content should be overwritten.
@@ -870,31 +1971,42 @@ class Maker(object):
         otherwise.  It may backup the file if the user asks to do so.
 
         This gives the user an option to see a diff of the file.
-        """
-        u_diff = list(unified_diff(
-            cur_content.splitlines(),
-            new_content.splitlines(),
-            dest_fn+' (old content)', dest_fn+' (new content)'))
-        u_diff = [line.rstrip() for line in u_diff]
-        c_diff = list(context_diff(
-            cur_content.splitlines(),
-            new_content.splitlines(),
-            dest_fn+' (old content)', dest_fn+' (new content)'))
-        c_diff = [line.rstrip() for line in c_diff]
-        added = len([l for l in u_diff if l.startswith('+')
-                       and not l.startswith('+++')])
-        removed = len([l for l in u_diff if l.startswith('-')
-                       and not l.startswith('---')])
-        if added > removed:
-            msg = '; %i lines added' % (added-removed)
-        elif removed > added:
-            msg = '; %i lines removed' % (removed-added)
+
+        The diff is only made if the user asks for it, and only the
+        first ``max_diff_lines`` lines are shown.  Content that is too
+        large to keep in memory is given as None (for ``cur_content``
+        the content is in ``dest_fn``, for ``new_content`` it is in
+        ``new_filename``); it is diffed with the external ``diff``
+        program, and can't be merged.
+        """
+        large = (new_content is None or cur_content is None
+                 or len(new_content) >= self.large_file_size
+                 or len(cur_content) >= self.large_file_size)
+        if new_content is None:
+            new_size = os.path.getsize(new_filename)
+        else:
+            new_size = len(new_content)
+        if large:
+            self.logger.notify(
+                'Replace %i bytes with %i bytes (too large to compare line by line)' % (
+                os.path.getsize(dest_fn), new_size))
         else:
-            msg = ''
-        self.logger.notify(
-            'Replace %i bytes with %i bytes (%i/%i lines changed%s)' % (
-            len(cur_content), len(new_content),
-            removed, len(cur_content.splitlines()), msg))
+            cur_lines = cur_content.splitlines()
+            removed, added = _count_line_changes(
+                cur_lines, new_content.splitlines())
+            if added > removed:
+                msg = '; %i lines added' % (added-removed)
+            elif removed > added:
+                msg = '; %i lines removed' % (removed-added)
+            else:
+                msg = ''
+            self.logger.notify(
+                'Replace %i bytes with %i bytes (%i/%i lines changed%s)' % (
+                len(cur_content), new_size,
+                removed, len(cur_lines), msg))
+        # Diffs are only made when asked for (and then kept here, by
+        # whether they are context diffs):
+        diffs = {}
         if message:
             print message
         prompt = 'Overwrite %s [y/n/d/b/m/?] ' % dest_fn
@@ -902,19 +2014,13 @@ class Maker(object):
         while 1:
             if self.all_answer is None:
                 self.beep_if_necessary()
-                response = raw_input(prompt).strip().lower()
+                response = self.read_input(
+                    prompt, message='Overwrite %s' % dest_fn,
+                    responses=['y', 'n', 'd', 'b', 'm', '?']).strip().lower()
             else:
                 response = self.all_answer
             if not response or response[0] == 'b':
-                import shutil
-                new_dest_fn = dest_fn + '.bak'
-                n = 0
-                while os.path.exists(new_dest_fn):
-                    n += 1
-                    new_dest_fn = dest_fn + '.bak' + str(n)
-                self.logger.notify('Backing up %s to %s' % (dest_fn, new_dest_fn))
-                if not self.simulate:
-                    shutil.copyfile(dest_fn, new_dest_fn)
+                self.backup(dest_fn)
                 return True
             elif response.startswith('all '):
                 rest = response[4:].strip()
@@ -926,10 +2032,18 @@ class Maker(object):
                 return True
             elif response[0] == 'n':
                 return False
-            elif response == 'dc':
-                print self.colorize_diff('\n'.join(c_diff))
+            elif response == 'm' and (new_content is None or cur_content is None):
+                print 'The files are too large to merge (over %i bytes)' % self.large_file_size
             elif response[0] == 'd':
-                print self.colorize_diff('\n'.join(u_diff))
+                context = response == 'dc'
+                if context not in diffs:
+                    diffs[context] = self._diff_text(
+                        dest_fn, new_content, cur_content, new_filename,
+                        context=context, external=large)
+                if diffs[context] is None:
+                    print 'Could not run diff to compare the files'
+                else:
+                    print diffs[context]
             elif response[0] == 't':
                 # Hidden feature
                 import traceback
@@ -945,6 +2059,89 @@ class Maker(object):
                     print 'Unknown command: %s' % response
                 print self.query_usage
 
+    # The most lines of a diff ask_difference() will show:
+    max_diff_lines = 2000
+    # The most output of a failed command (in bytes, for each of stdout
+    # and stderr) run_command shows:
+    max_command_output = 4*1024*1024
+    # Seconds between SIGTERM and SIGKILL when a command times out:
+    kill_grace_period = 10
+
+    def _diff_text(self, dest_fn, new_content, cur_content, new_filename,
+                   context=False, external=False):
+        """
+        Returns the (colorized, possibly truncated) diff for
+        ask_difference, or None if the external diff program failed.
+        """
+        old_label = dest_fn+' (old content)'
+        new_label = dest_fn+' (new content)'
+        if external:
+            lines = self._external_diff(dest_fn, new_content, new_filename,
+                                        old_label, new_label, context)
+            if lines is None:
+                return None
+        else:
+            if context:
+                differ = context_diff
+            else:
+                differ = unified_diff
+            lines = []
+            for line in differ(cur_content.splitlines(), new_content.splitlines(),
+                               old_label, new_label):
+                if len(lines) > self.max_diff_lines:
+                    break
+                lines.append(line.rstrip())
+        text = '\n'.join(lines[:self.max_diff_lines])
+        text = self.colorize_diff(text)
+        if len(lines) > self.max_diff_lines:
+            text += '\n(diff truncated after %i lines)' % self.max_diff_lines
+        return text
+
+    def _external_diff(self, dest_fn, new_content, new_filename,
+                       old_label, new_label, context=False):
+        """
+        Runs ``diff`` on the files, returning at most
+        ``max_diff_lines+1`` lines of its output (or None if it
+        couldn't be run).  ``new_content`` is written to a temporary
+        file if there is no ``new_filename``.
+        """
+        tmp_name = None
+        if new_filename is None:
+            fd, tmp_name = tempfile.mkstemp(prefix=os.path.basename(dest_fn) + '_new_')
+            try:
+                os.write(fd, new_content)
+            finally:
+                os.close(fd)
+            new_filename = tmp_name
+        if context:
+            style = '-c'
+        else:
+            style = '-u'
+        # diff complains if its output is cut short, so stderr is discarded:
+        devnull = open(os.devnull, 'w')
+        try:
+            try:
+                proc = subprocess.Popen(
+                    ['diff', style, '-L', old_label, '-L', new_label,
+                     dest_fn, new_filename],
+                    stdout=subprocess.PIPE, stderr=devnull)
+            except OSError, e:
+                self.logger.debug('Could not run diff: %s' % e)
+                return None
+            lines = []
+            for line in proc.stdout:
+                lines.append(line.rstrip())
+                if len(lines) > self.max_diff_lines:
+                    break
+            proc.stdout.close()
+            if proc.wait() not in (0, 1) and not lines:
+                return None
+            return lines
+        finally:
+            devnull.close()
+            if tmp_name is not None:
+                os.unlink(tmp_name)
+
     query_usage = '''\
 Responses:
   Y(es):    Overwrite the file with the new content.
@@ -1033,11 +2230,12 @@ Responses:
         if not self.interactive:
             return randpw()
         self.beep_if_necessary()
-        prompt2 = 'Confirm:'
+        message = prompt
+        prompt2 = message2 = 'Confirm:'
         if self.logger.supports_color(sys.stdout):
             prompt, prompt2 = [self.logger.colorize(p, 'bold cyan') for p in prompt, prompt2]
         for i in range(3):
-            inputpw = getpass(prompt).strip()
+            inputpw = self.read_input(prompt, message=message, echo=False, secret=True).strip()
             if not inputpw:
                 self.logger.info('Using randomly generated password')
                 return randpw()
@@ -1045,7 +2243,7 @@ Responses:
                 # would be nicer UI if this wasn't a hard error, but
                 # this is probably good enough.
                 validate(inputpw)
-            inputpw2 = getpass(prompt2).strip()
+            inputpw2 = self.read_input(prompt2, message=message2, echo=False, secret=True).strip()
             if inputpw == inputpw2:
                 return inputpw
         raise ValueError('Passwords did not match after 3 attempts')
@@ -1068,6 +2266,31 @@ Responses:
         """
         if not self.interactive:
             return default
+        return self._read_response(message, help, responses, default, first_char)
+
+    def read_input(self, prompt, message=None, responses=None,
+                   echo=True, secret=False):
+        """
+        Reads a line from the user (with ``getpass`` unless ``echo``),
+        emitting a ``prompt`` event for it.  ``message`` is the
+        question for the event (by default the ``prompt`` itself,
+        which may be colorized) and ``responses`` what can be
+        answered.  If ``secret``, what was typed isn't in the event.
+        """
+        start = time.time()
+        if echo:
+            line = raw_input(prompt)
+        else:
+            line = getpass(prompt)
+        if secret:
+            response = None
+        else:
+            response = line.strip()
+        self.events.emit('prompt', message=message or prompt, responses=responses,
+                         response=response, wait=time.time()-start)
+        return line
+
+    def _read_response(self, message, help, responses, default, first_char):
         responses = [res.lower() for res in responses]
         msg_responses = list(responses)
         if default:
@@ -1085,7 +2308,9 @@ Responses:
             self.beep_if_necessary()
             while 1:
                 try:
-                    response = raw_input(full_message).strip().lower()
+                    response = self.read_input(
+                        full_message, message=message,
+                        responses=responses).strip().lower()
                 except EOFError:
                     # This can happen when a user hits ^Z
                     continue
@@ -1115,6 +2340,23 @@ Responses:
             sys.stdout.write(chr(7))
             sys.stdout.flush()
             
+    def set_log_section(self, section):
+        """
+        Starts a new section of the log (see ``Logger.set_section``),
+        shown by ``handle_exception``.  Its messages are kept in
+        `SectionLog`s, so that no more than ``section_log_memory``
+        bytes of them are kept in memory; the rest go to a temporary
+        file.
+        """
+        logger = self._logger
+        for name in '_section_logs', '_section_color_logs':
+            old = getattr(logger, name, None)
+            if isinstance(old, SectionLog):
+                old.close()
+        logger.set_section(section)
+        logger._section_logs = SectionLog(self.section_log_memory)
+        logger._section_color_logs = SectionLog(self.section_log_memory)
+
     def handle_exception(self, exc_info, can_continue=False, can_retry=False):
         """
         Give an interactive way to handle an exception.
@@ -1158,15 +2400,49 @@ Responses:
             elif response == 'r':
                 return 'retry'
             elif response == 'v':
-                print self.logger.section_text()
+                self._write_section_log(
+                    sys.stdout, self.logger.supports_color(sys.stdout))
+                sys.stdout.flush()
             elif response == 'p':
                 pager = os.environ.get('PAGER', 'less')
                 proc = subprocess.Popen(pager,
                                         stdin=subprocess.PIPE)
-                proc.communicate(self.logger.section_text(color=False))
+                try:
+                    try:
+                        self._write_section_log(proc.stdin, False)
+                    except IOError, e:
+                        # The pager was quit before the end
+                        if e.errno != errno.EPIPE:
+                            raise
+                finally:
+                    try:
+                        proc.stdin.close()
+                    except IOError:
+                        pass
+                    proc.wait()
             else:
                 assert 0
 
+    def _write_section_log(self, f, color):
+        """
+        Writes the log of the current section to ``f`` a message at a
+        time (the log can be much bigger than what is kept in memory,
+        see `SectionLog`)
+        """
+        if color:
+            logs = self.logger._section_color_logs
+        else:
+            logs = self.logger._section_logs
+        first = True
+        for msg in logs:
+            if isinstance(msg, unicode):
+                msg = msg.encode('utf8')
+            if not first:
+                f.write('\n')
+            f.write(msg)
+            first = False
+        f.write('\n')
+
     def retrieve(self, url, filename):
         """Download a file and store it at filename.
         Depends on wget because urllib isn't reliable enough with large files
@@ -1174,22 +2450,69 @@ Responses:
         """
         self.run_command(['wget', '--no-check-certificate', url, '-O', filename])
 
-    def backup(self, filename):
+    def backup(self, filename, replacing=False):
         """
-        Moves the filename (file or directory) to a new location,
-        adding a .bak, .bak2, etc to the name to move it aside.
+        Copies the filename (file or directory) to a new location,
+        adding a .bak, .bak2, etc to the name to keep it aside.
+
+        If ``replacing`` is true the original is about to be removed
+        anyway, so it is simply renamed (and is gone afterwards).
+        Otherwise the copy is made with copy-on-write clones when the
+        filesystem supports them, and copied in full when it doesn't.
         """
         n = 1
         ext = '.bak'
-        while os.path.exists(filename + ext):
+        while os.path.lexists(filename + ext):
             n += 1
             ext = '.bak%s' % n
-        self.logger.notify('Backing up %s to %s' % (filename, filename + ext))
-        if not self.simulate:
-            if os.path.isdir(filename):
-                shutil.copytree(filename, filename+ext)
+        dest = filename + ext
+        self.logger.notify('Backing up %s to %s' % (filename, dest))
+        if self.simulate:
+            return
+        self._forget_dirs(filename)
+        self._record_backup(dest)
+        if replacing:
+            try:
+                os.rename(filename, dest)
+            except OSError, e:
+                self.logger.info('Could not rename %s (%s); copying it'
+                                 % (filename, e))
             else:
-                shutil.copy2(filename, filename+ext)
+                if self.changeset is not None:
+                    self.changeset.moved(filename, dest)
+                return
+        if self.changeset is not None:
+            self.changeset.created(dest)
+        dev = os.lstat(filename).st_dev
+        if dev not in self._no_reflink_devs:
+            if util.reflink_copy(filename, dest):
+                self.logger.debug('Backed up %s with copy-on-write clones' % filename)
+                return
+            # Don't try again on this filesystem:
+            self._no_reflink_devs.add(dev)
+        if os.path.isdir(filename) and not os.path.islink(filename):
+            shutil.copytree(filename, dest, symlinks=True)
+        else:
+            shutil.copy2(filename, dest)
+
+    def _record_backup(self, path):
+        """
+        Adds ``path`` to ``self.backup_log``
+        """
+        if self.backup_log is None:
+            return
+        self._lock.acquire()
+        try:
+            dirname = os.path.dirname(self.backup_log)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            f = open(self.backup_log, 'a')
+            try:
+                f.write(self._normpath(path) + '\n')
+            finally:
+                f.close()
+        finally:
+            self._lock.release()
 
 def popdefault(dict, name, default=None):
     """
@@ -1202,6 +2525,25 @@ def popdefault(dict, name, default=None):
         del dict[name]
         return v
 
+def _count_line_changes(old_lines, new_lines):
+    """
+    Returns ``(removed, added)``: how many lines of ``old_lines``
+    aren't in ``new_lines``, and the reverse.  This ignores the order
+    of the lines, so it is much cheaper than a real diff.
+    """
+    counts = {}
+    for line in old_lines:
+        counts[line] = counts.get(line, 0) + 1
+    for line in new_lines:
+        counts[line] = counts.get(line, 0) - 1
+    removed = added = 0
+    for n in counts.itervalues():
+        if n > 0:
+            removed += n
+        else:
+            added -= n
+    return removed, added
+
 def dict_diff(d1, d2):
     """
     Show the differences in two dictionaries (typically
@@ -0,0 +1,316 @@
+"""
+Finding the files in a build that nothing uses any more (``fassembler --gc``).
+
+Only things fassembler itself makes are looked at: the backups it
+made (see `read_backup_log`), shadow files of files that are gone,
+checkouts in ``PROJECT/src/``, ``custom_skel_*`` directories and
+tarballs left behind by failed downloads.  Of those, what the plans
+of the built projects (the paths their tasks use) or the requirements
+files name is kept.
+"""
+
+import fnmatch
+import glob
+import os
+import re
+from fassembler.manifest import Manifest, read_manifest_dirname
+from fassembler.requirements import read_requirements, parse_editable
+from fassembler.tasks import interpolated
+
+# Task attributes (besides the interpolated ones) that name paths:
+_path_attrs = ['path_resolved']
+
+def task_path_values(task):
+    """
+    The values of the attributes of the bound ``task`` that might be
+    paths: all its interpolated attributes and those in
+    ``_path_attrs``, as a list of strings (the strings in list values
+    included).
+    """
+    names = set(_path_attrs)
+    for cls in type(task).__mro__:
+        for name, value in vars(cls).items():
+            if isinstance(value, interpolated):
+                names.add(name)
+    values = []
+    for name in sorted(names):
+        try:
+            value = getattr(task, name)
+        except Exception:
+            # (Unset, or can't be interpolated)
+            continue
+        if isinstance(value, basestring):
+            values.append(value)
+        elif isinstance(value, (list, tuple)):
+            values.extend([v for v in value if isinstance(v, basestring)])
+    return values
+
+def plan_paths(projects, logger):
+    """
+    Computes what the plans of the (unbound) projects use.  Returns
+    ``(paths, tarball_names, planned_projects)``: the paths under the
+    base path the tasks use, the names of tarballs they download, and
+    the names of the projects whose plans could be computed.
+    """
+    paths = set()
+    tarball_names = set()
+    planned = set()
+    for project in projects:
+        project_paths = set()
+        maker = project.maker
+        try:
+            project.setup_config()
+            for task in project.bind_tasks():
+                for value in task_path_values(task):
+                    value = value.strip()
+                    if not value or '\n' in value:
+                        continue
+                    path = maker.path(value)
+                    if not path.startswith(maker.base_path + os.sep):
+                        continue
+                    if glob.has_magic(path):
+                        project_paths.update([maker.path(p) for p in glob.glob(path)])
+                    else:
+                        project_paths.add(path)
+                url = getattr(task, '_tarball_url', None)
+                if url:
+                    tarball_names.add(os.path.basename(url))
+        except Exception, e:
+            logger.warn('Could not compute the plan of %s (%s)'
+                        % (project.project_name, e))
+            continue
+        paths.update(project_paths)
+        planned.add(project.name)
+    return paths, tarball_names, planned
+
+def read_backup_log(filename):
+    """
+    The paths of the backups listed in ``filename`` (where
+    ``Maker.backup`` and ``Maker.ask_difference`` add them, one per
+    line) that still exist
+    """
+    if not filename or not os.path.exists(filename):
+        return []
+    f = open(filename)
+    try:
+        lines = f.read().splitlines()
+    finally:
+        f.close()
+    paths = []
+    seen = set()
+    for path in lines:
+        if path and path not in seen and os.path.lexists(path):
+            seen.add(path)
+            paths.append(path)
+    return paths
+
+def disk_usage(path):
+    """
+    The bytes the file or tree uses on disk (not following symlinks)
+    """
+    total = _st_bytes(os.lstat(path))
+    if os.path.isdir(path) and not os.path.islink(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in dirnames + filenames:
+                try:
+                    total += _st_bytes(os.lstat(os.path.join(dirpath, name)))
+                except OSError:
+                    pass
+    return total
+
+def _st_bytes(st):
+    blocks = getattr(st, 'st_blocks', None)
+    if blocks is None:
+        return st.st_size
+    return blocks * 512
+
+class Garbage(object):
+    """
+    A file or directory that nothing uses.  ``kind`` is the sort of
+    thing it is (like ``'backup'`` or ``'checkout'``).
+    """
+
+    def __init__(self, kind, path, reason):
+        self.kind = kind
+        self.path = path
+        self.reason = reason
+        self.size = disk_usage(path)
+
+    def __repr__(self):
+        return '<%s %s %s (%s)>' % (
+            self.__class__.__name__, self.kind, self.path, self.reason)
+
+    @property
+    def is_dir(self):
+        return os.path.isdir(self.path) and not os.path.islink(self.path)
+
+class GarbageCollector(object):
+    """
+    Finds the garbage under ``base_path``:
+
+    * ``backups`` (the backups fassembler made, see `read_backup_log`)
+    * ``.NAME.orig``/``.NAME.base`` files (kept by ``Maker.copy_file``)
+      when NAME is gone
+    * manifests (in ``manifest_dir``) none of whose files exist any
+      more
+    * svn checkouts in ``PROJECT/src/`` that no plan or requirements
+      file uses, and ``custom_skel_*`` directories in
+      ``PROJECT/src/*/`` that no plan uses, for the projects in
+      ``src_projects`` (the plans of all the built projects should be
+      in ``reachable``, as one project can use another's checkouts)
+    * tarballs downloaded by tasks (``tarball_names``, and any in
+      ``tarball_patterns``) left in ``base_path`` or ``tarball_dirs``
+
+    ``reachable`` are the paths the plans use; they and the
+    directories that contain them are kept (but not everything in
+    them).  ``skip_paths`` aren't looked in at all, and neither are
+    ``var/``, svn metadata and the libraries of virtualenvs.
+    """
+
+    shadow_re = re.compile(r'^\.(.+)\.(?:orig|base)$')
+    tarball_patterns = ['openplans-bundle-*.tar.bz2']
+    skip_dirs = ['.svn']
+    skip_top_dirs = ['var']
+    # Skipped in directories that are virtualenvs:
+    skip_venv_dirs = ['lib', 'lib64', 'include']
+
+    def __init__(self, base_path, reachable=(), src_projects=(),
+                 tarball_names=(), tarball_dirs=(), skip_paths=(),
+                 backups=(), manifest_dir=None):
+        self.base_path = base_path
+        self.reachable = set(reachable)
+        # The paths used, and all the directories containing them:
+        self.kept = set()
+        for path in self.reachable:
+            while path.startswith(base_path + os.sep) and path not in self.kept:
+                self.kept.add(path)
+                path = os.path.dirname(path)
+        self.src_projects = set(src_projects)
+        self.tarball_names = set(tarball_names)
+        self.tarball_dirs = list(tarball_dirs)
+        self.skip_paths = set(skip_paths)
+        self.backups = list(backups)
+        self.manifest_dir = manifest_dir
+
+    def find(self):
+        """
+        Returns a list of `Garbage`
+        """
+        garbage = list(self._find_checkouts())
+        garbage.extend(self._find_backups())
+        garbage.extend(self._find_manifests())
+        # Nothing inside those needs to be looked at:
+        claimed = set([item.path for item in garbage])
+        garbage.extend(self._walk(claimed))
+        garbage.extend(self._find_tarballs())
+        return garbage
+
+    def is_reachable(self, path):
+        """
+        True if a plan uses ``path``, or something in it
+        """
+        return path in self.kept
+
+    def requirement_src_names(self):
+        """
+        The names of the checkouts of all the editable requirements
+        in ``requirements/*.txt``
+        """
+        names = set()
+        req_dir = os.path.join(self.base_path, 'requirements')
+        if not os.path.isdir(req_dir):
+            return names
+        for filename in os.listdir(req_dir):
+            if not filename.endswith('.txt'):
+                continue
+            reqs = read_requirements(os.path.join(req_dir, filename))
+            if reqs is None:
+                continue
+            for value in reqs.editables:
+                if value.startswith('svn+') and not value.startswith('svn+ssh'):
+                    value = value[4:]
+                try:
+                    names.add(parse_editable(value)[2])
+                except (ValueError, IndexError):
+                    continue
+        return names
+
+    def _find_checkouts(self):
+        src_names = self.requirement_src_names()
+        for project in sorted(self.src_projects):
+            src = os.path.join(self.base_path, project, 'src')
+            if not os.path.isdir(src):
+                continue
+            for name in sorted(os.listdir(src)):
+                path = os.path.join(src, name)
+                if (not os.path.isdir(os.path.join(path, '.svn'))
+                    or name.lower() in src_names
+                    or self.is_reachable(path)):
+                    continue
+                yield Garbage('checkout', path, 'checkout not in any plan or requirements file')
+            for path in sorted(glob.glob(os.path.join(src, '*', 'custom_skel_*'))):
+                if os.path.isdir(path) and not self.is_reachable(path):
+                    yield Garbage('skeleton', path, 'skeleton not used by the current plan')
+
+    def _find_backups(self):
+        prefix = self.base_path + os.sep
+        for path in self.backups:
+            if (path.startswith(prefix) and not self.is_reachable(path)
+                and os.path.lexists(path)):
+                yield Garbage('backup', path, 'backup copy')
+
+    def _find_manifests(self):
+        if not self.manifest_dir or not os.path.isdir(self.manifest_dir):
+            return
+        for name in sorted(os.listdir(self.manifest_dir)):
+            path = os.path.join(self.manifest_dir, name)
+            dirname = read_manifest_dirname(path)
+            if dirname is None:
+                continue
+            manifest = Manifest(dirname, self.manifest_dir)
+            if manifest.filename != path:
+                continue
+            if not [n for n in manifest.entries
+                    if os.path.exists(os.path.join(dirname, n))]:
+                yield Garbage('manifest', path, 'none of the files in %s exist' % dirname)
+
+    def _skip_dir(self, dirpath, name, claimed):
+        path = os.path.join(dirpath, name)
+        if name in self.skip_dirs or path in self.skip_paths or path in claimed:
+            return True
+        if dirpath == self.base_path and name in self.skip_top_dirs:
+            return True
+        if (name in self.skip_venv_dirs
+            and os.path.exists(os.path.join(dirpath, 'bin', 'activate'))):
+            return True
+        return False
+
+    def _walk(self, claimed):
+        claimed = claimed | set(self.backups)
+        for dirpath, dirnames, filenames in os.walk(self.base_path):
+            names = set(dirnames) | set(filenames)
+            for name in sorted(dirnames):
+                if self._skip_dir(dirpath, name, claimed):
+                    dirnames.remove(name)
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                if path in self.skip_paths or path in claimed:
+                    continue
+                match = self.shadow_re.search(name)
+                if match and match.group(1) not in names:
+                    yield Garbage('shadow', path, '%s no longer exists' % match.group(1))
+
+    def _find_tarballs(self):
+        seen = set()
+        for dirname in [self.base_path] + self.tarball_dirs:
+            dirname = os.path.abspath(dirname)
+            if dirname in seen or not os.path.isdir(dirname):
+                continue
+            seen.add(dirname)
+            for name in sorted(os.listdir(dirname)):
+                path = os.path.join(dirname, name)
+                if not os.path.isfile(path):
+                    continue
+                if name in self.tarball_names or [
+                    p for p in self.tarball_patterns if fnmatch.fnmatch(name, p)]:
+                    yield Garbage('tarball', path, 'download left behind')
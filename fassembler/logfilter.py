@@ -0,0 +1,124 @@
+"""
+Picking the log level of lines of command output by regular expression.
+
+The output of installs (easy_install, ``setup.py develop``, pip) runs
+to tens of thousands of lines, and each one is checked against many
+regular expressions.  `LogRules` combines the regular expressions for
+each level into one alternation, so a line takes one search per level
+(stopping at the first level that matches) instead of one per regular
+expression.
+
+Run this module with a log of command output to compare the time
+taken with and without combining the rules of `InstallSpec`::
+
+    python -m fassembler.logfilter install-output.log
+"""
+
+import re
+import sys
+import time
+
+def _pattern(regex):
+    if isinstance(regex, basestring):
+        return regex
+    return regex.pattern
+
+def _flags(regex):
+    if isinstance(regex, basestring):
+        return 0
+    return regex.flags
+
+class LogRules(object):
+    """
+    ``rules`` is a list of ``(level, regexes)``, most important first;
+    each regex can be a string or a compiled regular expression.  A
+    line gets the level of the first rule with a regex that matches
+    anywhere in it (see `classify`).
+
+    Regexes are only combined with others that have the same flags
+    (like ``re.I``), so each still matches the way it did alone;
+    ``self.rules`` is a list of ``(level, combined_regexes)``.
+    """
+
+    def __init__(self, rules):
+        self.rules = []
+        for level, regexes in rules:
+            by_flags = {}
+            flags_order = []
+            for regex in regexes:
+                flags = _flags(regex)
+                if flags not in by_flags:
+                    by_flags[flags] = []
+                    flags_order.append(flags)
+                by_flags[flags].append(_pattern(regex))
+            if not flags_order:
+                continue
+            combined = []
+            for flags in flags_order:
+                combined.append(re.compile(
+                    '|'.join(['(?:%s)' % pattern for pattern in by_flags[flags]]),
+                    flags))
+            self.rules.append((level, combined))
+
+    def __repr__(self):
+        return '<%s levels %s>' % (
+            self.__class__.__name__, ', '.join([str(level) for level, regexes in self.rules]))
+
+    def classify(self, line, default=None):
+        """
+        The level of ``line``, or ``default`` if no rule matches it
+        """
+        for level, regexes in self.rules:
+            for regex in regexes:
+                if regex.search(line):
+                    return level
+        return default
+
+def _classify_each(rules, line, default=None):
+    # What LogRules.classify does, one regex at a time:
+    for level, regexes in rules:
+        for regex in regexes:
+            if regex.search(line):
+                return level
+    return default
+
+def benchmark(lines, rules, repeat=3):
+    """
+    Returns the seconds (the best of ``repeat`` tries) it takes to
+    classify all of ``lines`` with the regexes of ``rules`` one at a
+    time, and with `LogRules`.
+    """
+    compiled = [(level, [re.compile(_pattern(regex), _flags(regex)) for regex in regexes])
+                for level, regexes in rules]
+    log_rules = LogRules(rules)
+    lines = [line.strip() for line in lines]
+    times = []
+    for classify in [lambda line: _classify_each(compiled, line),
+                     log_rules.classify]:
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            for line in lines:
+                classify(line)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        times.append(best)
+    return times[0], times[1]
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print 'Usage: %s LOG_FILE...' % sys.argv[0]
+        sys.exit()
+    from fassembler.tasks import InstallSpec
+    lines = []
+    for filename in sys.argv[1:]:
+        f = open(filename)
+        lines.extend(f.readlines())
+        f.close()
+    rules = [('info', InstallSpec.log_filter_info_regexes),
+             ('debug', InstallSpec.log_filter_debug_regexes)]
+    each, combined = benchmark(lines, rules)
+    print '%i lines' % len(lines)
+    print 'One regex at a time: %.3fs (%.2f usec/line)' % (each, each*1e6/max(len(lines), 1))
+    print 'Combined rules:      %.3fs (%.2f usec/line)' % (combined, combined*1e6/max(len(lines), 1))
@@ -0,0 +1,150 @@
+"""
+Manifests of the files the Maker has written.
+
+Each destination directory gets a manifest that records, for each
+file written (or confirmed) there, its size, modification time, inode
+and the md5 of its content, and for copied files the size and
+modification time of the source it came from.  If a file's stat still
+matches its entry, its content is known without reading it.
+
+The manifests are all kept in one directory (``var/fassembler/manifests/``),
+named after the md5 of the directory they describe, so nothing is
+added to the destination directories (which may be svn checkouts, or
+skeletons that get copied elsewhere).
+"""
+
+import os
+from fassembler.util import atomic_write, md5
+
+def content_hash(content):
+    return md5(content).hexdigest()
+
+def stat_key(st):
+    """
+    The parts of a stat result that identify a version of a file
+    """
+    return (st.st_size, st.st_mtime, st.st_ino)
+
+def manifest_filename(manifest_dir, dirname):
+    """
+    The file in ``manifest_dir`` that keeps the manifest of ``dirname``
+    """
+    return os.path.join(manifest_dir, content_hash(dirname) + '.txt')
+
+def read_manifest_dirname(filename):
+    """
+    The directory the manifest ``filename`` describes (from its first
+    line), or None if it doesn't say
+    """
+    f = open(filename, 'rb')
+    try:
+        line = f.readline()
+    finally:
+        f.close()
+    if not line.startswith(_header):
+        return None
+    return line[len(_header):].rstrip('\n')
+
+_header = '# Written by fassembler; used to detect unchanged files in '
+
+class Manifest(object):
+    """
+    The manifest of the directory ``dirname``, kept in
+    ``manifest_dir`` (or only in memory if that is None).  ``entries``
+    maps file basenames to dictionaries with the keys ``stat`` (see
+    `stat_key`), ``md5`` and ``source`` (``(filename, size, mtime)``
+    or None).
+    """
+
+    def __init__(self, dirname, manifest_dir=None):
+        self.dirname = dirname
+        if manifest_dir is None:
+            self.filename = None
+        else:
+            self.filename = manifest_filename(manifest_dir, dirname)
+        self.entries = {}
+        self.dirty = False
+        self._load()
+
+    def __repr__(self):
+        return '<%s %s (%i entries)>' % (
+            self.__class__.__name__, self.filename, len(self.entries))
+
+    def _load(self):
+        if self.filename is None or not os.path.exists(self.filename):
+            return
+        f = open(self.filename, 'rb')
+        try:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) != 8 or line.startswith('#'):
+                    continue
+                name, size, mtime, ino, digest, src, src_size, src_mtime = parts
+                try:
+                    stat = (int(size), float(mtime), int(ino))
+                    if src:
+                        source = (src, int(src_size), float(src_mtime))
+                    else:
+                        source = None
+                except ValueError:
+                    continue
+                self.entries[name] = dict(stat=stat, md5=digest, source=source)
+        finally:
+            f.close()
+
+    def lookup(self, name, st):
+        """
+        Returns the entry for ``name`` if it matches the stat result
+        ``st``, otherwise None
+        """
+        entry = self.entries.get(name)
+        if entry is None or entry['stat'] != stat_key(st):
+            return None
+        return entry
+
+    def record(self, name, st, digest, source=None):
+        """
+        Records that ``name`` (with stat result ``st``) has content
+        with the given md5 ``digest``.  A source is kept if the
+        content didn't change.
+        """
+        old = self.entries.get(name)
+        if source is None and old is not None and old['md5'] == digest:
+            source = old['source']
+        entry = dict(stat=stat_key(st), md5=digest, source=source)
+        if old != entry:
+            self.entries[name] = entry
+            self.dirty = True
+
+    def forget(self, name):
+        if name in self.entries:
+            del self.entries[name]
+            self.dirty = True
+
+    def save(self):
+        """
+        Writes the manifest, if it has changed
+        """
+        if not self.dirty or self.filename is None:
+            return
+        if not os.path.isdir(self.dirname):
+            self.dirty = False
+            return
+        lines = [_header + self.dirname + '\n']
+        for name in sorted(self.entries):
+            if '\t' in name or '\n' in name:
+                continue
+            entry = self.entries[name]
+            size, mtime, ino = entry['stat']
+            if entry['source']:
+                src, src_size, src_mtime = entry['source']
+                source = '%s\t%i\t%r' % (src, src_size, src_mtime)
+            else:
+                source = '\t\t'
+            lines.append('%s\t%i\t%r\t%i\t%s\t%s\n' % (
+                name, size, mtime, ino, entry['md5'], source))
+        manifest_dir = os.path.dirname(self.filename)
+        if not os.path.exists(manifest_dir):
+            os.makedirs(manifest_dir)
+        atomic_write(self.filename, ''.join(lines), fsync=False)
+        self.dirty = False
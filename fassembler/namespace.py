@@ -189,7 +189,7 @@ class Namespace(DictMixin):
                     print 'Template: %s' % template_content
                 while 1:
                     ## FIXME: should beep here
-                    response = raw_input('What to do? [(c)ancel/(q)uit/(r)etry/(s)how source/(n)amespace/(t)raceback/(p)db/(e)xecute/(r)etry/] ')
+                    response = self['maker'].read_input('What to do? [(c)ancel/(q)uit/(r)etry/(s)how source/(n)amespace/(t)raceback/(p)db/(e)xecute/(r)etry/] ')
                     if not response.strip():
                         continue
                     char = response.strip().lower()[0]
@@ -0,0 +1,138 @@
+"""
+Caching the output of read-only commands (probes).
+
+Commands like ``httpd -v`` or ``svn info PATH`` are run again and again
+to find out about the host, but their output only changes when the
+executable (or the files they look at) changes.  `ProbeCache` keeps
+their output, keyed by the command and the environment variables that
+can change it (like ``$LANG``), and checks the modification time and
+size of the executable and of any files the probe depends on before
+using it.  The cache is kept in ``var/fassembler/probes.json``
+between runs.
+"""
+
+import os
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+from fassembler.util import atomic_write
+
+def find_executable(name, path=None):
+    """
+    The full path of the executable ``name`` (searched for on
+    ``$PATH``, unless it has a directory), or None
+    """
+    if os.path.dirname(name):
+        if os.path.exists(name):
+            return os.path.abspath(name)
+        return None
+    if path is None:
+        path = os.environ.get('PATH', os.defpath)
+    for dir in path.split(os.pathsep):
+        filename = os.path.join(dir, name)
+        if os.path.isfile(filename) and os.access(filename, os.X_OK):
+            return filename
+    return None
+
+def _file_signature(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+class ProbeCache(object):
+    """
+    The output of probes, kept in ``filename`` (or only in memory, if
+    that is None or there is no json module).  ``entries`` maps the
+    key of each probe (see `key`) to a dictionary with ``signature``
+    (the mtime and size of the executable and the files it depends
+    on), ``stdout``, ``stderr`` and ``returncode``.
+    """
+
+    def __init__(self, filename, logger):
+        self.filename = filename
+        self.logger = logger
+        self.entries = {}
+        self.dirty = False
+        self.hits = 0
+        if json is None:
+            self.filename = None
+        self._load()
+
+    def __repr__(self):
+        return '<%s %s (%i probes)>' % (
+            self.__class__.__name__, self.filename, len(self.entries))
+
+    def _load(self):
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        f = open(self.filename, 'rb')
+        try:
+            try:
+                entries = json.load(f)
+            except ValueError, e:
+                self.logger.warn('Could not read probe cache %s: %s' % (self.filename, e))
+                return
+        finally:
+            f.close()
+        for key, entry in entries.items():
+            for name in 'stdout', 'stderr':
+                entry[name] = entry[name].encode('utf8')
+            self.entries[key] = entry
+
+    def save(self):
+        if not self.dirty or not self.filename:
+            return
+        dirname = os.path.dirname(self.filename)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        content = json.dumps(self.entries, sort_keys=True, indent=1)
+        atomic_write(self.filename, content + '\n', fsync=False)
+        self.dirty = False
+
+    # The environment variables that can change the output of a probe:
+    environ_vars = ['PATH', 'LANG', 'LANGUAGE', 'LC_ALL', 'LC_MESSAGES']
+
+    def key(self, executable, args, depends, environ=None):
+        if environ is None:
+            environ = os.environ
+        env = ['%s=%s' % (name, environ[name]) for name in self.environ_vars
+               if name in environ]
+        return '\0'.join([executable] + list(args) + ['--'] + list(depends)
+                         + ['--'] + env)
+
+    def signature(self, executable, depends):
+        return [_file_signature(filename) for filename in [executable] + list(depends)]
+
+    def lookup(self, executable, args, depends=(), environ=None):
+        """
+        Returns ``(stdout, stderr, returncode)`` of the probe, or None
+        if it hasn't been run (in an environment like ``environ``, by
+        default ``os.environ``), or the executable or the files it
+        depends on have changed since.
+        """
+        entry = self.entries.get(self.key(executable, args, depends, environ))
+        if entry is None or entry['signature'] != self.signature(executable, depends):
+            return None
+        self.hits += 1
+        return entry['stdout'], entry['stderr'], entry['returncode']
+
+    def store(self, executable, args, depends, stdout, stderr, returncode,
+              environ=None):
+        if json is not None:
+            try:
+                json.dumps([stdout, stderr])
+            except UnicodeDecodeError:
+                # Output that isn't UTF-8 can't be kept
+                return
+        self.entries[self.key(executable, args, depends, environ)] = dict(
+            signature=self.signature(executable, depends),
+            stdout=stdout, stderr=stderr, returncode=returncode)
+        self.dirty = True
@@ -0,0 +1,386 @@
+"""
+Talking to a subprocess through its pipes.
+
+`communicate` feeds a process its stdin while it reads stdout and
+stderr, all at the same time (with ``select``), so a process that
+writes a lot to one pipe while we are writing to or reading from
+another can't deadlock.  Output is passed on line by line as it
+arrives, and only a bounded amount of it is kept.  A process that
+runs out of time is killed (see `kill_process_group`).  The resources
+each process used are recorded (see `wait` and `CommandStats`).
+"""
+
+import errno
+import fcntl
+import os
+import posixpath
+import select
+import shlex
+import signal
+import time
+from collections import deque
+
+# How much is read from or written to a pipe at a time:
+CHUNK_SIZE = 64*1024
+
+class TimeoutExpired(Exception):
+    """
+    Raised by `communicate` when the process took longer than
+    ``timeout`` seconds (it has been killed).  ``stdout`` and
+    ``stderr`` are the output read before then.
+    """
+
+    def __init__(self, timeout, stdout, stderr):
+        Exception.__init__(self, 'Timed out after %s seconds' % timeout)
+        self.timeout = timeout
+        self.stdout = stdout
+        self.stderr = stderr
+
+class OutputBuffer(object):
+    """
+    Keeps the output written to it, up to ``max_size`` bytes (or all
+    of it, if ``max_size`` is None).  When there is more than that,
+    the start and the end are kept and the middle is dropped.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.head = []
+        self.head_size = 0
+        self.tail = deque()
+        self.tail_size = 0
+        self.dropped = 0
+
+    def write(self, data):
+        if self.max_size is None:
+            self.head.append(data)
+            return
+        head_max = self.max_size // 2
+        if self.head_size < head_max:
+            part = data[:head_max - self.head_size]
+            self.head.append(part)
+            self.head_size += len(part)
+            data = data[len(part):]
+            if not data:
+                return
+        tail_max = self.max_size - head_max
+        self.tail.append(data)
+        self.tail_size += len(data)
+        while self.tail_size > tail_max:
+            extra = self.tail_size - tail_max
+            first = self.tail[0]
+            if len(first) <= extra:
+                self.tail.popleft()
+                extra = len(first)
+            else:
+                self.tail[0] = first[extra:]
+            self.tail_size -= extra
+            self.dropped += extra
+
+    def getvalue(self):
+        parts = list(self.head)
+        if self.dropped:
+            parts.append('\n[... %i bytes of output not kept ...]\n' % self.dropped)
+        parts.extend(self.tail)
+        return ''.join(parts)
+
+class LineSplitter(object):
+    """
+    Calls ``callback(line)`` with each line of the data fed to it
+    (including the newline).  Lines longer than ``max_line`` are
+    passed on in pieces.
+    """
+
+    max_line = 64*1024
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.partial = ''
+
+    def feed(self, data):
+        data = self.partial + data
+        start = 0
+        while 1:
+            end = data.find('\n', start)
+            if end == -1:
+                break
+            self.callback(data[start:end+1])
+            start = end+1
+        self.partial = data[start:]
+        while len(self.partial) >= self.max_line:
+            self.callback(self.partial[:self.max_line])
+            self.partial = self.partial[self.max_line:]
+
+    def close(self):
+        if self.partial:
+            self.callback(self.partial)
+            self.partial = ''
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def kill_process_group(proc, grace_period):
+    """
+    Sends SIGTERM to the process group of ``proc`` (which must lead
+    its own group, e.g. by being started with ``preexec_fn=os.setpgrp``),
+    and after ``grace_period`` seconds (or as soon as ``proc`` exits)
+    SIGKILL to anything left in it.
+    """
+    for sig in signal.SIGTERM, signal.SIGKILL:
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+            break
+        if sig == signal.SIGTERM:
+            deadline = time.time() + grace_period
+            while _running(proc) and time.time() < deadline:
+                time.sleep(0.1)
+    wait(proc)
+
+def kill_process(proc):
+    """
+    Sends SIGKILL to ``proc`` (but not to the processes it started),
+    if it is still running, and waits for it.
+    """
+    if not _running(proc):
+        return
+    try:
+        os.kill(proc.pid, signal.SIGKILL)
+    except OSError, e:
+        if e.errno != errno.ESRCH:
+            raise
+    wait(proc)
+
+def wait(proc, block=True):
+    """
+    Waits for ``proc`` to exit (or, if ``block`` is false, only checks
+    if it has) and returns its return code (None if it is still
+    running).  This sets ``proc.returncode`` and ``proc.rusage`` (the
+    resources used by the process and the children it waited for, or
+    None if ``os.wait4`` isn't available).
+
+    If something else already waited for the process, its exit status
+    is lost: this returns None and sets ``proc.status_unknown``.
+    """
+    if proc.returncode is not None or getattr(proc, 'status_unknown', False):
+        return proc.returncode
+    if not hasattr(os, 'wait4'):
+        proc.rusage = None
+        if block:
+            return proc.wait()
+        return proc.poll()
+    if block:
+        flags = 0
+    else:
+        flags = os.WNOHANG
+    while 1:
+        try:
+            pid, status, rusage = os.wait4(proc.pid, flags)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno != errno.ECHILD:
+                raise
+            # Somebody else waited for it:
+            proc.rusage = None
+            proc.status_unknown = True
+            return None
+        break
+    if pid == 0:
+        return None
+    proc.rusage = rusage
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return proc.returncode
+
+def _running(proc):
+    return wait(proc, False) is None and not getattr(proc, 'status_unknown', False)
+
+def communicate(proc, input=None, stdout_lines=None, stderr_lines=None,
+                max_output=None, timeout=None, grace_period=10):
+    """
+    Writes ``input`` to the stdin of the ``subprocess.Popen`` object
+    ``proc`` (closing it afterwards) while reading its stdout and
+    stderr (those that are pipes), then waits for it to exit.
+
+    Each line of output is passed to ``stdout_lines(line)`` or
+    ``stderr_lines(line)`` as soon as it is read.  Returns ``(stdout,
+    stderr)``, each keeping at most ``max_output`` bytes (see
+    `OutputBuffer`); the value for a stream that isn't a pipe is ''.
+
+    If the process hasn't exited after ``timeout`` seconds, its
+    process group is killed (see `kill_process_group`) and
+    `TimeoutExpired` is raised.  Either way `wait` is used to wait
+    for the process, so ``proc.rusage`` is set.
+    """
+    if timeout is not None:
+        deadline = time.time() + timeout
+    readers = {}
+    buffers = []
+    for pipe, callback in [(proc.stdout, stdout_lines),
+                           (proc.stderr, stderr_lines)]:
+        buffer = OutputBuffer(max_output)
+        buffers.append(buffer)
+        if pipe is None:
+            continue
+        if callback is None:
+            splitter = None
+        else:
+            splitter = LineSplitter(callback)
+        readers[pipe.fileno()] = (pipe, buffer, splitter)
+    writing = None
+    if proc.stdin is not None:
+        if input:
+            writing = proc.stdin.fileno()
+            _set_nonblocking(writing)
+        else:
+            proc.stdin.close()
+    offset = 0
+    while readers or writing is not None:
+        if writing is not None:
+            wlist = [writing]
+        else:
+            wlist = []
+        if timeout is None:
+            args = ()
+        else:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                _timed_out(proc, readers, buffers, timeout, grace_period)
+            args = (remaining, )
+        try:
+            ready, writable, x = select.select(readers.keys(), wlist, [], *args)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        if writable:
+            try:
+                offset += os.write(writing, input[offset:offset+CHUNK_SIZE])
+            except OSError, e:
+                if e.errno == errno.EPIPE:
+                    # The process doesn't want the rest
+                    offset = len(input)
+                elif e.errno not in (errno.EAGAIN, errno.EINTR):
+                    raise
+            if offset >= len(input):
+                proc.stdin.close()
+                writing = None
+        for fd in ready:
+            pipe, buffer, splitter = readers[fd]
+            try:
+                data = os.read(fd, CHUNK_SIZE)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                raise
+            if not data:
+                pipe.close()
+                del readers[fd]
+                if splitter is not None:
+                    splitter.close()
+                continue
+            buffer.write(data)
+            if splitter is not None:
+                splitter.feed(data)
+    if timeout is not None:
+        # It may have closed its output and still be running:
+        while _running(proc):
+            if time.time() >= deadline:
+                _timed_out(proc, readers, buffers, timeout, grace_period)
+            time.sleep(0.1)
+    wait(proc)
+    return buffers[0].getvalue(), buffers[1].getvalue()
+
+def _timed_out(proc, readers, buffers, timeout, grace_period):
+    kill_process_group(proc, grace_period)
+    for pipe, buffer, splitter in readers.values():
+        pipe.close()
+        if splitter is not None:
+            splitter.close()
+    if proc.stdin is not None and not proc.stdin.closed:
+        proc.stdin.close()
+    raise TimeoutExpired(timeout, buffers[0].getvalue(), buffers[1].getvalue())
+
+class CommandStats(object):
+    """
+    The resources used by one command run by the task ``task``:
+    ``wall`` (seconds), ``user`` and ``sys`` (CPU seconds), ``maxrss``
+    (the peak resident memory, in KB) and ``inblock``/``oublock``
+    (blocks read and written).  All but ``wall`` are None if the
+    resource usage isn't known.
+    """
+
+    def __init__(self, command, task, wall, rusage=None, returncode=None):
+        self.command = command
+        self.task = task
+        self.wall = wall
+        self.returncode = returncode
+        if rusage is None:
+            self.user = self.sys = self.maxrss = self.inblock = self.oublock = None
+        else:
+            self.user = rusage.ru_utime
+            self.sys = rusage.ru_stime
+            self.maxrss = rusage.ru_maxrss
+            self.inblock = rusage.ru_inblock
+            self.oublock = rusage.ru_oublock
+
+    def __repr__(self):
+        return '<%s %s (%s) %.1fs wall, %s CPU>' % (
+            self.__class__.__name__, self.label, self.task, self.wall, self.cpu)
+
+    @property
+    def cpu(self):
+        if self.user is None:
+            return None
+        return self.user + self.sys
+
+    @property
+    def label(self):
+        return command_label(self.command)
+
+    def as_dict(self):
+        return dict(command=command_label(self.command, 0), task=self.task,
+                    wall=self.wall, user=self.user, sys=self.sys,
+                    maxrss=self.maxrss, inblock=self.inblock,
+                    oublock=self.oublock, returncode=self.returncode)
+
+_interpreters = ['python', 'sh', 'bash']
+
+def command_label(cmd, words=2):
+    """
+    A short name for the kind of command ``cmd`` (a string or a list
+    of arguments) is, like ``'svn checkout'`` or ``'setup.py
+    develop'``: the name of the script (not the interpreter running
+    it) and its first ``words``-1 arguments that aren't options.  With
+    ``words=0`` this is the whole command.
+    """
+    if isinstance(cmd, basestring):
+        try:
+            args = shlex.split(cmd)
+        except ValueError:
+            args = cmd.split()
+    else:
+        args = list(cmd)
+    if not words:
+        return ' '.join(args)
+    if not args:
+        return ''
+    name = posixpath.basename(args[0])
+    args = args[1:]
+    if (name.rstrip('0123456789.') in _interpreters and args
+        and not args[0].startswith('-')):
+        name = posixpath.basename(args[0])
+        args = args[1:]
+    parts = [name]
+    for arg in args:
+        if len(parts) >= words:
+            break
+        if not arg.startswith('-'):
+            parts.append(arg)
+    return ' '.join(parts)
@@ -6,9 +6,12 @@ These classes should be listed as the entry point [fassembler.project]
 import os
 import sys
 import re
+import time
 from cStringIO import StringIO
 from fassembler.namespace import Namespace
+from fassembler.requirements import read_requirements
 from fassembler.text import indent, underline, dedent
+from fassembler.util import md5
 from cmdutils import CommandError
 from tempita import Template
 
@@ -100,33 +103,221 @@ class Project(object):
             raise NotImplementedError(
                 "The actions attribute has not been overridden in %r"
                 % self)
+        start = time.time()
+        first_command = len(self.maker.command_stats)
+        self.maker.events.emit('project_start', project=self.project_name)
+        try:
+            self.run_tasks()
+        except:
+            exc_info = sys.exc_info()
+            self.maker.events.emit('project_end', project=self.project_name,
+                                   duration=time.time()-start, status=1, build=None)
+            try:
+                self.environ.record_build(
+                    self.project_name, duration=time.time()-start,
+                    fingerprint=self.input_fingerprint(), status=1,
+                    commands=self.command_records(first_command))
+            except Exception, e:
+                self.logger.warn('Could not record failed build of %s: %s'
+                                 % (self.project_name, e))
+            raise exc_info[0], exc_info[1], exc_info[2]
+        # (The build succeeded, even if its inputs can't be read now)
+        try:
+            fingerprint = self.input_fingerprint()
+        except Exception, e:
+            self.logger.warn('Could not fingerprint the inputs of %s: %s'
+                             % (self.project_name, e))
+            fingerprint = None
+        build_id = self.environ.add_built_project(
+            self.project_name, duration=time.time()-start,
+            fingerprint=fingerprint,
+            commands=self.command_records(first_command))
+        self.maker.events.emit('project_end', project=self.project_name,
+                               duration=time.time()-start, status=0, build=build_id)
+        try:
+            settings, build_properties = self.config_snapshot()
+            self.environ.save_config_snapshot(
+                self.project_name, build_id, settings, build_properties)
+        except Exception, e:
+            self.logger.warn('Could not save config snapshot of %s: %s'
+                             % (self.project_name, e))
+        deduper = self.environ.deduper
+        venv = self.build_properties.get('virtualenv_path')
+        if deduper is not None and venv:
+            try:
+                deduper.dedupe(venv)
+            except (OSError, IOError), e:
+                self.logger.warn('Could not share files of %s with other virtualenvs: %s'
+                                 % (venv, e))
+
+    def command_records(self, first=0):
+        """
+        The resources used by the commands run since the first
+        ``first`` (see `Maker.command_stats`), as dictionaries for the
+        build history
+        """
+        return [stats.as_dict() for stats in self.maker.command_stats[first:]]
+
+    def run_tasks(self):
+        """
+        Bind and run all the tasks
+        """
         self.setup_config()
         tasks = self.bind_tasks()
-        for task in tasks:
-            self.logger.set_section(self.name+'.'+task.name)
-            self.logger.notify('== %s ==' % task.name, color='bold green')
-            self.logger.indent += 2
+        deduper = self.environ.deduper
+        venv = self.build_properties.get('virtualenv_path')
+        if deduper is not None and venv:
+            # The files it shares with other virtualenvs mustn't be
+            # changed by this build:
+            deduper.break_links(venv)
+        for group in self.task_groups(tasks):
             while 1:
                 try:
-                    try:
-                        self.logger.debug('Task Plan:')
-                        self.logger.debug(indent(str(task), '  '))
-                        task.run()
-                    finally:
-                        self.logger.indent -= 2
+                    if self.maker.changesets and group[0].file_task:
+                        self.run_changeset(group)
+                    else:
+                        self.run_task(group[0])
                 except (KeyboardInterrupt, CommandError):
                     raise
                 except:
                     should_continue = self.maker.handle_exception(sys.exc_info(), can_continue=True,
                                                                   can_retry=True)
                     if should_continue == 'retry':
-                        self.logger.notify('Retrying task %s' % task.name)
+                        self.logger.notify('Retrying task %s' % ', '.join([task.name for task in group]))
                         continue
                     if not should_continue:
                         self.logger.fatal('Project %s aborted.' % self.title, color='red')
                         raise CommandError('Aborted', show_usage=False)
                 break
-        self.environ.add_built_project(self.project_name)
+
+    def task_groups(self, tasks):
+        """
+        Splits the tasks into the groups that are run together: each
+        series of file tasks is one group if ``maker.changesets`` is
+        true, and every other task is a group of its own.
+        """
+        groups = []
+        for task in tasks:
+            if (self.maker.changesets and task.file_task
+                and groups and groups[-1][-1].file_task):
+                groups[-1].append(task)
+            else:
+                groups.append([task])
+        return groups
+
+    def run_task(self, task):
+        """
+        Runs one task
+        """
+        self.maker.set_log_section(self.name+'.'+task.name)
+        self.logger.notify('== %s ==' % task.name, color='bold green')
+        self.logger.indent += 2
+        start = time.time()
+        status = 1
+        self.maker.events.emit('task_start', project=self.project_name, task=task.name)
+        try:
+            self.logger.debug('Task Plan:')
+            self.logger.debug(indent(str(task), '  '))
+            if self.environ.unsaved_settings and not task.saves_settings:
+                # The task may read build.ini, so pending
+                # settings are written out first:
+                self.environ.save()
+            self.maker.command_timeout = task.command_timeout()
+            self.maker.current_task = self.name+'.'+task.name
+            task.run()
+            status = 0
+        finally:
+            self.maker.command_timeout = None
+            self.maker.current_task = None
+            self.maker.forget_known_dirs()
+            self.maker.reap_deleters()
+            self.maker.events.emit('task_end', project=self.project_name, task=task.name,
+                                   duration=time.time()-start, status=status)
+            self.logger.indent -= 2
+            self.maker.flush_svn_adds()
+            self.maker.save_manifests()
+            if self.maker.durability == 'task':
+                self.maker.sync()
+
+    def run_changeset(self, tasks):
+        """
+        Runs the (file) tasks as one changeset: the conflicts of each
+        task are asked about together after it has run (before the
+        next task can change the same files), and if anything fails
+        all their changes are rolled back.
+        """
+        self.maker.begin_changeset()
+        try:
+            for task in tasks:
+                self.run_task(task)
+                self.maker.resolve_conflicts()
+            self.maker.set_log_section(self.name)
+            self.maker.commit_changeset()
+        except:
+            exc_info = sys.exc_info()
+            if self.maker.changeset is not None:
+                self.maker.rollback_changeset()
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if self.maker.durability == 'task':
+            self.maker.sync()
+
+    def input_fingerprint(self):
+        """
+        A hash of the inputs of this project's build: its configuration
+        section and its requirements file.
+        """
+        digest = md5()
+        if self.config.has_section(self.config_section):
+            for option in sorted(self.config.options(self.config_section)):
+                digest.update('%s=%s\n' % (option, self.config.get(self.config_section, option)))
+        spec_filename = self.maker.path('requirements/%s-req.txt' % (
+            self.spec_filename or self.name))
+        if os.path.exists(spec_filename):
+            f = open(spec_filename, 'rb')
+            digest.update(f.read())
+            f.close()
+        return digest.hexdigest()
+
+    def config_snapshot(self):
+        """
+        The fully resolved configuration of this project, as
+        ``(settings, build_properties)``.  ``settings`` maps each
+        setting name (from this project's section and [DEFAULT]) to a
+        dictionary with the interpolated ``value``, its ``source``
+        (``filename:line``, if known) and the ``raw`` value if it is
+        different.  Both are plain data, suitable for JSON.
+        """
+        ns = self.create_namespace()
+        section = ns[self.config_section]
+        settings = {}
+        # Errors are recorded in the snapshot, not asked about:
+        interactive = self.maker.interactive
+        self.maker.interactive = False
+        try:
+            for config_section in 'DEFAULT', self.config_section:
+                for option in self.config.options(config_section):
+                    raw = self.config.get(config_section, option)
+                    try:
+                        value = getattr(section, option)
+                    except KeyboardInterrupt:
+                        raise
+                    except Exception, e:
+                        value = 'Error evaluating: %s' % e
+                    setting = {'value': _jsonable(value)}
+                    if value != raw:
+                        setting['raw'] = raw
+                    filename, line_number = self.config.setting_location(config_section, option)
+                    if filename:
+                        if line_number:
+                            filename = '%s:%s' % (filename, line_number)
+                        setting['source'] = filename
+                    settings[option] = setting
+        finally:
+            self.maker.interactive = interactive
+        build_properties = {}
+        for name, value in self.build_properties.items():
+            build_properties[name] = _jsonable(value)
+        return settings, build_properties
 
     def bind_tasks(self):
         """
@@ -282,45 +473,35 @@ class Project(object):
             "and/or add the relevant directory to your $PATH."
             % (', '.join(executables), os.environ['PATH']))
 
-    _setting_re = re.compile(r'^(\w+)\s*=\s*(.*)$')
-
     @property
     def req_settings(self):
         """
         Reads settings from the requirements file in requirements/<self.spec_filename or self.name>-req.txt
         Returns a dictionary
         """
-        
         spec_filename = self.maker.path('requirements/%s-req.txt' % (
             self.spec_filename or self.name))
-        if not os.path.exists(spec_filename):
+        reqs = read_requirements(spec_filename)
+        if reqs is None:
             self.logger.debug('No requirements file in %s' % spec_filename)
             return {}
-        settings = {}
-        f = open(spec_filename)
-        in_setting = None
-        for line in f:
-            line = line.rstrip()
-            if line.strip() != line and in_setting:
-                # Continuation line
-                cur = settings[in_setting]
-                settings[in_setting] = cur + '\n' + line.strip()
-                continue
-            if not line or line.strip().startswith('#'):
-                continue
-            match = self._setting_re.search(line)
-            if match:
-                name = match.group(1)
-                value = match.group(2)
-                if name in settings:
-                    settings[name] = settings[name] + '\n' + value
-                else:
-                    settings[name] = value
-                in_setting = name
-            else:
-                in_setting = None
-        f.close()
-        return settings        
+        return dict(reqs.settings)
+
+def _jsonable(value):
+    """
+    Returns value as something JSON can represent (other objects are
+    turned into their repr)
+    """
+    if value is None or isinstance(value, (basestring, bool, int, long, float)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, dict):
+        result = {}
+        for key, v in value.items():
+            result[str(key)] = _jsonable(v)
+        return result
+    return repr(value)
 
 class Setting(object):
     """
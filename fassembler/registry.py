@@ -0,0 +1,227 @@
+"""
+The record of what has been built.
+
+``etc/projects.txt`` lists the projects that are built (and is kept
+for compatibility with older tools); the full history of builds is
+kept in a sqlite database under ``var/``.
+"""
+
+import os
+from fassembler.util import atomic_write
+
+try:
+    import sqlite3
+except ImportError:
+    try:
+        from pysqlite2 import dbapi2 as sqlite3
+    except ImportError:
+        sqlite3 = None
+
+class BuildRegistry(object):
+    """
+    Keeps track of built projects (in ``projects_filename``) and of
+    every build run (in the sqlite database ``db_filename``).
+
+    ``projects.txt`` is read once and indexed by project name; it is
+    only re-read if the file changes on disk.
+    """
+
+    columns = ['id', 'project', 'time', 'duration', 'fassembler_version',
+               'fingerprint', 'status']
+    command_columns = ['task', 'command', 'wall', 'user', 'sys', 'maxrss',
+                       'inblock', 'oublock', 'returncode']
+
+    def __init__(self, projects_filename, db_filename, logger):
+        self.projects_filename = projects_filename
+        self.db_filename = db_filename
+        self.logger = logger
+        self._lines = None
+        self._index = None
+        self._stat = None
+        self._warned_no_sqlite = False
+
+    def _file_stat(self):
+        try:
+            st = os.stat(self.projects_filename)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def _load(self):
+        """
+        Read projects.txt (if it has changed since it was last read),
+        and index the lines by project name.
+        """
+        stat = self._file_stat()
+        if self._index is not None and stat == self._stat:
+            return
+        lines = []
+        if stat is not None:
+            f = open(self.projects_filename, 'r')
+            lines = f.readlines()
+            f.close()
+        index = {}
+        for i, line in enumerate(lines):
+            if not line.strip() or line.strip().startswith('#'):
+                continue
+            index[line.split()[0]] = i
+        self._lines = lines
+        self._index = index
+        self._stat = stat
+
+    def is_built(self, name):
+        """
+        Is the project listed in projects.txt?
+        """
+        self._load()
+        return name in self._index
+
+    def built_projects(self):
+        """
+        The names of all the projects listed in projects.txt
+        """
+        self._load()
+        return sorted(self._index)
+
+    def add_built(self, name, time):
+        """
+        List the project as built in projects.txt, at the given time
+        (a datetime object)
+        """
+        self._load()
+        line = '%s %s\n' % (name, time.strftime('%Y-%m-%d %H:%M:%S'))
+        if name in self._index:
+            lines = [l for i, l in enumerate(self._lines)
+                     if i != self._index[name]]
+        else:
+            lines = list(self._lines)
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        lines.append(line)
+        self.logger.info('Writing build info for %s to %s' % (name, self.projects_filename))
+        atomic_write(self.projects_filename, ''.join(lines))
+        # Force a re-read next time, in case the mtime didn't change:
+        self._index = None
+
+    def _connect(self, create=False):
+        """
+        Returns a connection to the build database, or None if sqlite
+        isn't available (or there is no database and ``create`` is
+        false).
+        """
+        if sqlite3 is None:
+            if not self._warned_no_sqlite:
+                self.logger.info('sqlite is not available; build history is not being recorded')
+                self._warned_no_sqlite = True
+            return None
+        if not os.path.exists(self.db_filename):
+            if not create:
+                return None
+            dir = os.path.dirname(self.db_filename)
+            if not os.path.exists(dir):
+                os.makedirs(dir)
+        conn = sqlite3.connect(self.db_filename)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS builds (
+                id INTEGER PRIMARY KEY,
+                project TEXT NOT NULL,
+                time TEXT NOT NULL,
+                duration REAL,
+                fassembler_version TEXT,
+                fingerprint TEXT,
+                status INTEGER
+            )''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS builds_project_time
+            ON builds (project, time)''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS commands (
+                build INTEGER NOT NULL REFERENCES builds (id),
+                task TEXT,
+                command TEXT,
+                wall REAL,
+                user REAL,
+                sys REAL,
+                maxrss INTEGER,
+                inblock INTEGER,
+                oublock INTEGER,
+                returncode INTEGER
+            )''')
+        return conn
+
+    def record(self, name, time, duration=None, fassembler_version=None,
+               fingerprint=None, status=0, commands=None):
+        """
+        Record one build of a project.  ``status`` is 0 for a
+        successful build.  ``commands`` are dictionaries with the
+        resources used by each command the build ran (with the keys
+        of `command_columns`).  Returns the id of the new record (or
+        None if nothing could be recorded).
+        """
+        conn = self._connect(create=True)
+        if conn is None:
+            return None
+        try:
+            cursor = conn.execute(
+                'INSERT INTO builds (project, time, duration, fassembler_version, '
+                'fingerprint, status) VALUES (?, ?, ?, ?, ?, ?)',
+                (name, time.strftime('%Y-%m-%d %H:%M:%S'), duration,
+                 fassembler_version, fingerprint, status))
+            if commands:
+                conn.executemany(
+                    'INSERT INTO commands (build, %s) VALUES (?, %s)' % (
+                        ', '.join(self.command_columns),
+                        ', '.join(['?']*len(self.command_columns))),
+                    [[cursor.lastrowid] + [command.get(c) for c in self.command_columns]
+                     for command in commands])
+            conn.commit()
+            self.logger.debug('Recorded build %s of %s in %s'
+                              % (cursor.lastrowid, name, self.db_filename))
+            return cursor.lastrowid
+        finally:
+            conn.close()
+
+    def history(self, projects=None, limit=None):
+        """
+        Returns the recorded builds (newest last) as a list of
+        dictionaries, optionally only for the given project names.
+        """
+        conn = self._connect()
+        if conn is None:
+            return []
+        sql = 'SELECT %s FROM builds' % ', '.join(self.columns)
+        args = []
+        if projects:
+            sql += ' WHERE project IN (%s)' % ', '.join(['?']*len(projects))
+            args.extend(projects)
+        sql += ' ORDER BY time DESC, id DESC'
+        if limit:
+            sql += ' LIMIT %i' % limit
+        try:
+            rows = conn.execute(sql, args).fetchall()
+        finally:
+            conn.close()
+        rows.reverse()
+        return [dict(zip(self.columns, row)) for row in rows]
+
+    def last_build(self, name, status=None):
+        """
+        The most recent build record of the project (optionally only
+        with the given status), or None
+        """
+        conn = self._connect()
+        if conn is None:
+            return None
+        sql = 'SELECT %s FROM builds WHERE project = ?' % ', '.join(self.columns)
+        args = [name]
+        if status is not None:
+            sql += ' AND status = ?'
+            args.append(status)
+        sql += ' ORDER BY time DESC, id DESC LIMIT 1'
+        try:
+            row = conn.execute(sql, args).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return dict(zip(self.columns, row))
@@ -0,0 +1,147 @@
+"""
+Parsing of requirements files (``requirements/<project>-req.txt``)
+
+A requirements file contains settings (``name = value``, possibly
+continued on indented lines), ``-f``/``--find-links`` locations,
+``-Z``/``--always-unzip``, editable checkouts (``-e``/``--editable``)
+and plain requirements.  Files are parsed once and the result is
+reused until the file changes on disk.
+"""
+
+import os
+import re
+
+class Requirements(object):
+    """
+    The parsed contents of one requirements file.
+
+    ``entries`` is the list of things to install, in order, as
+    ``(kind, value)`` where ``kind`` is ``'editable'`` or
+    ``'requirement'``.  These objects are shared by everyone who reads
+    the same file, so they should not be modified.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.settings = {}
+        self.find_links = []
+        self.always_unzip = False
+        self.entries = []
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.filename)
+
+    @property
+    def editables(self):
+        return [value for kind, value in self.entries if kind == 'editable']
+
+    @property
+    def requirements(self):
+        return [value for kind, value in self.entries if kind == 'requirement']
+
+    # The value can't start with = or <>, so that Package==1.0 is not a
+    # setting (but it can be empty):
+    _setting_re = re.compile(r'^(\w+)\s*=\s*(?![=<>])(.*)$')
+
+    def parse(self, lines):
+        """
+        Parse the lines of the file into this object
+        """
+        # The setting whose value continues on indented lines, like:
+        # setting = value
+        #           line 2
+        in_setting = None
+        for line in lines:
+            line = line.rstrip()
+            if not line or line.strip().startswith('#'):
+                continue
+            if in_setting:
+                if line.strip() != line:
+                    self.settings[in_setting] += '\n' + line.strip()
+                    continue
+                in_setting = None
+            match = self._setting_re.search(line)
+            if match:
+                name, value = match.group(1), match.group(2)
+                if name in self.settings:
+                    self.settings[name] += '\n' + value
+                else:
+                    self.settings[name] = value
+                in_setting = name
+                continue
+            line = line.strip()
+            if line.startswith('--find-links'):
+                self.find_links.append(line[len('--find-links'):].lstrip('=').strip())
+            elif line.startswith('-f'):
+                self.find_links.append(line[2:].strip())
+            elif line.startswith('--always-unzip') or line.startswith('-Z'):
+                self.always_unzip = True
+            elif line.startswith('--editable'):
+                self.entries.append(
+                    ('editable', line[len('--editable'):].lstrip('=').strip()))
+            elif line.startswith('-e'):
+                self.entries.append(('editable', line[2:].strip()))
+            else:
+                self.entries.append(('requirement', line))
+
+_rev_svn_re = re.compile(r'@(\d+)$')
+_egg_spec_re = re.compile(r'egg=([^-=&]*)')
+
+def parse_editable(svn):
+    """
+    Splits an editable requirement (an svn URL, optionally with
+    ``@REV`` and ``#egg=Name``) into ``(url, revision, name)``.  The
+    name is lower-cased, as it is the name of the checkout under
+    ``src/``.  Raises ValueError if there is no name and none can be
+    guessed from the URL.
+    """
+    name = None
+    if '#' in svn:
+        svn, fragment = svn.split('#', 1)
+        match = _egg_spec_re.search(fragment)
+        if match:
+            name = match.group(1)
+    revision = None
+    match = _rev_svn_re.search(svn)
+    if match:
+        svn = svn[:match.start()]
+        revision = match.group(1)
+    if name is None:
+        parts = [p for p in svn.split('/') if p]
+        if parts[-2] in ('tags', 'branches', 'tag', 'branch'):
+            name = parts[-3]
+        elif parts[-1] == 'trunk':
+            name = parts[-2]
+        else:
+            raise ValueError(
+                "Cannot determine the name of the package from the svn directory %s; "
+                "you should add #egg=Name to the URL" % svn)
+    # Normalizing the name, so it's more predictable later:
+    return svn, revision, name.lower()
+
+_cache = {}
+
+def read_requirements(filename):
+    """
+    Returns the parsed `Requirements` for the file, or None if the
+    file does not exist.  The file is only re-read when its
+    modification time or size changes.
+    """
+    filename = os.path.abspath(filename)
+    try:
+        st = os.stat(filename)
+    except OSError:
+        _cache.pop(filename, None)
+        return None
+    key = (st.st_mtime, st.st_size)
+    cached = _cache.get(filename)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    reqs = Requirements(filename)
+    f = open(filename)
+    try:
+        reqs.parse(f)
+    finally:
+        f.close()
+    _cache[filename] = (key, reqs)
+    return reqs
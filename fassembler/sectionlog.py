@@ -0,0 +1,85 @@
+"""
+Keeping the log of a section without keeping all of it in memory.
+
+The logger keeps every message of the current section (see
+``Logger.set_section``) so that they can all be shown if something
+goes wrong.  A verbose section (like ``pip install -vvvv``) can log
+hundreds of megabytes; `SectionLog` keeps only the newest messages in
+memory and writes older ones to a temporary file, reading them back
+when the whole log is looked at.
+"""
+
+import tempfile
+from collections import deque
+
+class SectionLog(object):
+    """
+    A list-like log of messages: it can be appended to, iterated over
+    (oldest message first) and has a length.  When the messages in
+    memory take more than ``max_size`` bytes the older ones are
+    written to a temporary file (in ``dir``, if given).
+    """
+
+    def __init__(self, max_size, dir=None):
+        self.max_size = max_size
+        self.dir = dir
+        self.messages = deque()
+        self.size = 0
+        self.spilled = 0
+        self.file = None
+
+    def __repr__(self):
+        return '<%s %i messages (%i on disk)>' % (
+            self.__class__.__name__, len(self), self.spilled)
+
+    def __len__(self):
+        return self.spilled + len(self.messages)
+
+    def append(self, msg):
+        self.messages.append(msg)
+        self.size += len(msg)
+        if self.size > self.max_size:
+            self._spill()
+
+    def _spill(self):
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(prefix='fassembler-section-', dir=self.dir)
+        # Half is written out, so this isn't done for every message:
+        parts = []
+        while self.messages and self.size > self.max_size // 2:
+            msg = self.messages.popleft()
+            self.size -= len(msg)
+            if isinstance(msg, unicode):
+                msg = msg.encode('utf8')
+                kind = 'u'
+            else:
+                kind = 's'
+            # (Messages can have newlines, so each is prefixed by its
+            # length, and whether it was unicode)
+            parts.append('%s%i\n%s' % (kind, len(msg), msg))
+            self.spilled += 1
+        self.file.write(''.join(parts))
+
+    def __iter__(self):
+        if self.file is not None:
+            self.file.seek(0)
+            for i in xrange(self.spilled):
+                header = self.file.readline()
+                msg = self.file.read(int(header[1:]))
+                if header[0] == 'u':
+                    msg = msg.decode('utf8')
+                yield msg
+            self.file.seek(0, 2)
+        for msg in list(self.messages):
+            yield msg
+
+    def close(self):
+        """
+        Deletes the temporary file (the log is empty afterwards)
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.messages.clear()
+        self.size = 0
+        self.spilled = 0
@@ -11,6 +11,8 @@ import sys
 import urlparse
 
 from fassembler.distutilspatch import find_distutils_file, update_distutils_file
+from fassembler.requirements import read_requirements, parse_editable
+from fassembler.logfilter import LogRules
 from fassembler.util import asbool
 from glob import glob
 from tempita import Template
@@ -53,6 +55,12 @@ class Task(object):
     maker = None
     description = None
     name = interpolated('name')
+    # True for tasks that only change settings; pending settings are
+    # written to build.ini before any other kind of task is run:
+    saves_settings = False
+    # True for tasks that only change files through the Maker; with
+    # --changesets a series of these is applied as one changeset:
+    file_task = False
 
     def __init__(self, name, stacklevel=1):
         self.name = name
@@ -91,6 +99,31 @@ class Task(object):
         tasks might need.
         """
 
+    def command_timeout(self):
+        """
+        The most seconds a command run by this task may take (or None).
+        This is set in ``[command_timeouts]`` by task class name (e.g.,
+        ``SvnCheckout = 600``; the setting of a base class applies to
+        its subclasses), or for all tasks in ``[general]
+        command_timeout``.
+        """
+        for cls in self.__class__.__mro__:
+            value = self.config.getdefault('command_timeouts', cls.__name__)
+            if value:
+                break
+        else:
+            value = self.config.getdefault('general', 'command_timeout')
+        if not value:
+            return None
+        try:
+            value = float(value)
+        except ValueError:
+            raise ValueError(
+                "Bad command timeout for task %s: %r" % (self.name, value))
+        if value <= 0:
+            return None
+        return value
+
     def run(self):
         """
         Subclasses should implement this.
@@ -238,6 +271,8 @@ class CopyDir(Task):
     source = interpolated('source')
     dest = interpolated('dest')
 
+    file_task = True
+
     def __init__(self, name, source, dest, stacklevel=1, add_dest_to_svn=False):
         super(CopyDir, self).__init__(name, stacklevel=stacklevel+1)
         self.source = source
@@ -274,6 +309,8 @@ class EnsureFile(Task):
     content = interpolated('content')
     content_path = interpolated('content_path')
 
+    file_task = True
+
     def __init__(self, name, dest, content=None, content_path=None, overwrite=True,
                  svn_add=False, executable=False, stacklevel=1,
                  force_overwrite=False):
@@ -322,6 +359,8 @@ class EnsureSymlink(Task):
     dest = interpolated('dest')
     source = interpolated('source')
 
+    file_task = True
+
     def __init__(self, name, source, dest, overwrite=True, stacklevel=1,
                  force_overwrite=False):
         super(EnsureSymlink, self).__init__(name, stacklevel=stacklevel+1)
@@ -353,6 +392,8 @@ class EnsureDir(Task):
 
     dest = interpolated('dest')
 
+    file_task = True
+
     def __init__(self, name, dest, svn_add=True, stacklevel=1):
         super(EnsureDir, self).__init__(name, stacklevel=stacklevel+1)
         self.dest = dest
@@ -593,9 +634,8 @@ never_create_virtualenv=False):
         if not self.different_python:
             props['virtualenv_lib_python'] = os.path.join(path, 'lib', 'python%s' % sys.version[:3])
         else:
-            proc = subprocess.Popen([self.different_python, '-V'],
-                                    stderr=subprocess.PIPE)
-            ver = proc.communicate()[1].strip()
+            stdout, stderr, returncode = self.maker.probe([self.different_python, '-V'])
+            ver = (stderr or stdout).strip()
             ver = ver.split()[1][:3]
             props['virtualenv_lib_python'] = os.path.join(path, 'lib', 'python%s' % ver[:3])
 
@@ -667,6 +707,8 @@ class InstallPasteConfig(Task):
     from {{if task.template}}a static template{{else}}the file {{task.path}}{{endif}}
     """
 
+    file_task = True
+
     def __init__(self, template=None, path=None, name='Install Paste configuration',
                  ininame=None, stacklevel=1):
         super(InstallPasteConfig, self).__init__(name, stacklevel=stacklevel+1)
@@ -694,6 +736,8 @@ class InstallPasteStartup(Task):
 
     exe_dir = interpolated('exe_dir')
 
+    file_task = True
+
     def __init__(self, name='Install Paste startup script', exe_dir='{{env.base_path}}/{{project.name}}/src/{{project.name}}', stacklevel=1):
         super(InstallPasteStartup, self).__init__(name, stacklevel=stacklevel+1)
         self.exe_dir = exe_dir
@@ -724,6 +768,8 @@ class InstallSupervisorConfig(Task):
 
     script_name = interpolated('script_name')
 
+    file_task = True
+
     def __init__(self, name='Install supervisor startup script',
                  script_name='{{project.name}}', stacklevel=1):
         super(InstallSupervisorConfig, self).__init__(name, stacklevel=stacklevel+1)
@@ -925,7 +971,8 @@ class CheckMySQLDatabase(Task):
                     ## anyone looking over my shoulder?
                     try:
                         self.maker.beep_if_necessary()
-                        self.__class__._root_password_override = raw_input('Please enter the correct password (^C to abort): ')
+                        self.__class__._root_password_override = self.maker.read_input(
+                            'Please enter the correct password (^C to abort): ', secret=True)
                     except KeyboardInterrupt:
                         print '^C'
                         raise exc_info[0], exc_info[1], exc_info[2]
@@ -934,7 +981,8 @@ class CheckMySQLDatabase(Task):
         
 class SaveSetting(Task):
     """
-    Save a setting in build.ini.
+    Save a setting in build.ini.  Consecutive settings tasks are
+    batched into a single write of the file.
 
     Optional validation can be performed by passing a validators
     dictionary, where keys correspond to the keys in variables, and
@@ -956,6 +1004,7 @@ class SaveSetting(Task):
 
     variables = interpolated('variables')
     section = interpolated('section')
+    saves_settings = True
 
     def __init__(self, name, variables, section='general',
                  overwrite_if_empty=True, overwrite=True,
@@ -983,13 +1032,14 @@ class SaveSetting(Task):
                 self.validators[key](value)
             should_write = self.should_write_setting(section, key, value)
             if should_write:
-                config.set(section, key, value)
+                self.environ.set_setting(section, key, value)
             else:
                 if value != config.get(section, key):
                     self.logger.notify(
                         'Not overwriting build.ini option [%s] %s = %r (new value would have been %r)'
                         % (section, key, config.get(section, key), value))
-        self.environ.save()
+        # The settings are written to build.ini by the project, in a
+        # batch (see Environment.save)
 
     def should_write_setting(self, section, key, value):
         if self.overwrite:
@@ -1159,9 +1209,8 @@ class InstallSpec(Task):
 
     description = """
     Install the packages from {{task.spec_filename}}:
-    {{for line in open(maker.path(task.spec_filename)):}}
-    {{py: line = line.strip()}}
-    {{if line.startswith('-e') or line.startswith('--editable'):}}* svn checkout {{line.split(None, 1)[1]}}{{else}}* {{line}}{{endif}}{{endfor}}
+    {{for kind, value in task.requirements.entries:}}
+    {{if kind == 'editable':}}* svn checkout {{value}}{{else}}* {{value}}{{endif}}{{endfor}}
     """
 
     spec_filename = interpolated('spec_filename')
@@ -1170,6 +1219,13 @@ class InstallSpec(Task):
         super(InstallSpec, self).__init__(name, stacklevel=stacklevel+1)
         self.spec_filename = spec_filename
 
+    @property
+    def requirements(self):
+        """
+        The parsed spec file (or None if it doesn't exist)
+        """
+        return read_requirements(self.maker.path(self.spec_filename))
+
     def run(self):
         if self.config.has_option(self.project.name, 'use_pip'):
             use_pip = asbool(self.config.get(self.project.name, 'use_pip'))
@@ -1210,8 +1266,6 @@ class InstallSpec(Task):
         line = line[match.end():]
         return (line, level)
 
-    _setting_re = re.compile(r'^(\w+)\s*=\s*([^=<>\s].*)$')
-
     def read_commands(self, filename=None):
         """
         Reads the commands in the given file (or self.spec_filename),
@@ -1227,92 +1281,36 @@ class InstallSpec(Task):
         if filename is None:
             filename = self.spec_filename
         self.logger.debug('Reading spec %s' % filename)
-        f = open(self.maker.path(filename))
-        context = dict(find_links=[],
+        reqs = read_requirements(self.maker.path(filename))
+        if reqs is None:
+            raise IOError(
+                "The spec file %s does not exist" % self.maker.path(filename))
+        context = dict(find_links=list(reqs.find_links),
                        src_base=os.path.join(self.project.build_properties['virtualenv_path'], 'src'),
-                       always_unzip=False)
+                       always_unzip=reqs.always_unzip)
         commands = []
         uneditable_eggs = []
-        # Used to flag state when we are looking for multi-line settings, like:
-        # setting = value
-        #           line 2
-        in_setting = False
-        for line in f:
-            line = line.rstrip()
-            if not line or line.strip().startswith('#'):
-                continue
-            if in_setting:
-                if line.strip() != line:
-                    # Leading whitespace; multi-line setting
-                    continue
-                else:
-                    in_setting = False
-            if self._setting_re.search(line):
-                # We just skip settings here
-                in_setting = True
-                continue
-            if line.startswith('-f') or line.startswith('--find-links'):
-                if line.startswith('-f'):
-                    line = line[2:]
-                else:
-                    line = line[len('--find-links'):].lstrip('=')
-                context['find_links'].append(line.strip())
-                continue
-            if line.startswith('--always-unzip') or line.startswith('-Z'):
-                context['always_unzip'] = True
-                continue
-            if line.startswith('-e') or line.startswith('--editable'):
+        for kind, value in reqs.entries:
+            if kind == 'editable':
                 if uneditable_eggs:
                     commands.append((self.install_eggs, uneditable_eggs))
                     uneditable_eggs = []
-                if line.startswith('-e'):
-                    line = line[2:]
-                else:
-                    line = line[len('--editable'):].lstrip('=')
-                line = line.strip()
-                if line.startswith('svn+') and not line.startswith('svn+ssh'):
-                    line = line[4:]
-                commands.append((self.install_editable, line))
-                continue
-            uneditable_eggs.append(line.strip())
+                if value.startswith('svn+') and not value.startswith('svn+ssh'):
+                    value = value[4:]
+                commands.append((self.install_editable, value))
+            else:
+                uneditable_eggs.append(value)
         if uneditable_eggs:
             commands.append((self.install_eggs, uneditable_eggs))
         return context, commands
 
-    _rev_svn_re = re.compile(r'@(\d+)$')
-    _egg_spec_re = re.compile(r'egg=([^-=&]*)')
-
     def install_editable(self, context, svn):
         """
         Installs one editable project.  This step does not install any
         dependencies for the project; that is done later by
         ``self.install_finalize_editable``
         """
-        ops = []
-        name = None
-        if '#' in svn:
-            svn, fragment = svn.split('#', 1)
-            match = self._egg_spec_re.search(fragment)
-            if match:
-                name = match.group(1)
-        revision = None
-        match = self._rev_svn_re.search(svn)
-        if match:
-            svn = svn[:match.start()]
-            revision = match.group(1)
-        ops.append(svn)
-        if name is None:
-            parts = [p for p in svn.split('/') if p]
-            if parts[-2] in ('tags', 'branches', 'tag', 'branch'):
-                name = parts[-3]
-            elif parts[-1] == 'trunk':
-                name = parts[-2]
-            else:
-                raise ValueError(
-                    "Cannot determine the name of the package from the svn directory %s; "
-                    "you should add #egg=Name to the URL" % svn)
-        # Normalizing the name, so it's more predictable later:
-        name = name.lower()
+        svn, revision, name = parse_editable(svn)
         dest = os.path.join(context['src_base'], name)
         self.logger.notify('Preparing checkout %s' % name)
         self.logger.indent += 2
@@ -1389,9 +1387,19 @@ class InstallSpec(Task):
         re.compile(r'^reading manifest template .MANIFEST\.in.$'),
         ]
 
+    def log_rules(self):
+        """
+        The `LogRules` that pick the level of lines that
+        ``make_log_filter`` doesn't handle specially (by default, from
+        ``log_filter_info_regexes`` and ``log_filter_debug_regexes``)
+        """
+        return LogRules([(self.logger.INFO, self.log_filter_info_regexes),
+                         (self.logger.DEBUG, self.log_filter_debug_regexes)])
+
     def make_log_filter(self):
         context = []
         hanging_processing = []
+        rules = self.log_rules()
         def log_filter(line):
             """
             Filter the output of setup.py develop and easy_install
@@ -1431,14 +1439,11 @@ class InstallSpec(Task):
                     context.pop()
                 context.append('searching')
                 adjust = -2
-            if not line.strip():
+            stripped = line.strip()
+            if not stripped:
                 level = self.logger.DEBUG
-            for regex in self.log_filter_debug_regexes:
-                if regex.search(line.strip()):
-                    level = self.logger.DEBUG
-            for regex in self.log_filter_info_regexes:
-                if regex.search(line.strip()):
-                    level = self.logger.INFO
+            else:
+                level = rules.classify(stripped, level)
             indent = len(context) * 2 + adjust
             line = ' '*indent + line
             if hanging_processing:
@@ -1452,10 +1457,9 @@ class InstallSpecIfPresent(InstallSpec):
 
     description = """
     Install the packages from {{task.spec_filename}} if the file exists:
-    {{if maker.exists(task.spec_filename)}}
-    {{for line in open(maker.path(task.spec_filename)):}}
-    {{py: line = line.strip()}}
-    {{if line.startswith('-e') or line.startswith('--editable'):}}* svn checkout {{line.split(None, 1)[1]}}{{else}}* {{line}}{{endif}}{{endfor}}
+    {{if task.requirements is not None}}
+    {{for kind, value in task.requirements.entries:}}
+    {{if kind == 'editable':}}* svn checkout {{value}}{{else}}* {{value}}{{endif}}{{endfor}}
     {{else}}
     The file does not exist, so nothing to do.
     {{endif}}
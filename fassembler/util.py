@@ -1,4 +1,18 @@
+import os
+import shutil
 import subprocess
+import tempfile
+
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
+try:
+    from hashlib import md5
+except ImportError:
+    # Python 2.4
+    from md5 import new as md5
 
 def asbool(obj):
     if isinstance(obj, (str, unicode)):
@@ -22,3 +36,260 @@ def popen(args, raise_on_returncode=True, **kw):
         raise OSError("Running %r failed.\nOutput:\n%s" %
                       (' '.join(args), stderr or stdout))
     return proc.returncode, stdout, stderr
+
+# Read once: checking the umask means changing it, which isn't safe
+# once other threads are creating files.
+_umask = os.umask(0)
+os.umask(_umask)
+
+def default_file_mode():
+    """
+    The mode a newly created file would get, given the umask.
+    """
+    return 0666 & ~_umask
+
+def fsync_dir(dirname):
+    """
+    Flushes a directory (i.e., the names of the files in it) to disk.
+    Does nothing where directories can't be opened.
+    """
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+    finally:
+        os.close(fd)
+
+def fsync_file(filename):
+    """
+    Flushes the contents of a file that has already been written to disk.
+    """
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def atomic_write(filename, content, fsync=True, mode=None):
+    """
+    Write ``content`` to ``filename`` by writing a temporary file in
+    the same directory and renaming it over the destination, so that
+    an interrupted write never leaves a truncated file behind.
+
+    The mode of an existing file is kept (unless ``mode`` is given),
+    except that a read-only file with other hard links (one shared by
+    `fassembler.dedupe`) gets its write permission back, as the new
+    file is not shared.  If ``filename`` is a symlink, the file it
+    points to is replaced.
+    If ``fsync`` is true the data is flushed to disk before the
+    rename, and the directory after it.
+    """
+    def write(f):
+        f.write(content)
+    _atomic_replace(filename, write, fsync, mode)
+
+def atomic_copy(src, filename, fsync=True, mode=None):
+    """
+    Like `atomic_write`, but copies the content of the file ``src``
+    (in chunks, so any size of file can be copied).  Returns the md5
+    hex digest of the content.
+    """
+    digest = md5()
+    def write(f):
+        src_f = open(src, 'rb')
+        try:
+            while 1:
+                chunk = src_f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+        finally:
+            src_f.close()
+    _atomic_replace(filename, write, fsync, mode)
+    return digest.hexdigest()
+
+def _atomic_replace(filename, write, fsync, mode):
+    filename = os.path.realpath(filename)
+    dirname = os.path.dirname(filename)
+    if mode is None:
+        if os.path.exists(filename):
+            st = os.stat(filename)
+            mode = st.st_mode & 07777
+            if st.st_nlink > 1 and not mode & 0222:
+                mode |= default_file_mode() & 0222
+        else:
+            mode = default_file_mode()
+    fd, tmp_name = tempfile.mkstemp(
+        prefix='.%s.' % os.path.basename(filename), suffix='.tmp', dir=dirname)
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            write(f)
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.chmod(tmp_name, mode)
+        os.rename(tmp_name, filename)
+    except:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+    if fsync:
+        fsync_dir(dirname)
+
+## Comparing files without reading them whole:
+
+CHUNK_SIZE = 256*1024
+# Files at least this big are read through a memory map...
+MMAP_MIN_SIZE = 1024*1024
+# ...of this much of the file at a time:
+MMAP_WINDOW = 32*CHUNK_SIZE
+
+class _FileReader(object):
+    """
+    Reads a file in chunks.  Big files are read through a memory map
+    of one window of the file at a time, so the memory used doesn't
+    grow with the size of the file.
+    """
+
+    def __init__(self, filename):
+        self.f = open(filename, 'rb')
+        self.size = os.fstat(self.f.fileno()).st_size
+        self.pos = 0
+        self.use_mmap = mmap is not None and self.size >= MMAP_MIN_SIZE
+        self.map = None
+        self.map_start = 0
+
+    def _map_window(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        length = min(MMAP_WINDOW, self.size - self.pos)
+        try:
+            self.map = mmap.mmap(self.f.fileno(), length,
+                                 access=mmap.ACCESS_READ, offset=self.pos)
+        except (EnvironmentError, ValueError, TypeError):
+            # (TypeError: Python before 2.6 can't map part of a file)
+            self.use_mmap = False
+            self.f.seek(self.pos)
+            return
+        self.map_start = self.pos
+
+    def read(self, size=CHUNK_SIZE):
+        if self.use_mmap and self.pos < self.size:
+            if self.map is None or self.pos >= self.map_start + len(self.map):
+                self._map_window()
+            if self.map is not None:
+                offset = self.pos - self.map_start
+                chunk = self.map[offset:offset+size]
+                self.pos += len(chunk)
+                return chunk
+        chunk = self.f.read(size)
+        self.pos += len(chunk)
+        return chunk
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.f.close()
+
+def file_md5(filename):
+    """
+    The md5 hex digest of the file's content
+    """
+    digest = md5()
+    reader = _FileReader(filename)
+    try:
+        while 1:
+            chunk = reader.read()
+            if not chunk:
+                break
+            digest.update(chunk)
+    finally:
+        reader.close()
+    return digest.hexdigest()
+
+def content_equals_file(content, filename):
+    """
+    Does the file contain exactly ``content``?  Only a chunk of the
+    file is in memory at a time (and the file isn't read at all if
+    its size is different).
+    """
+    if os.path.getsize(filename) != len(content):
+        return False
+    reader = _FileReader(filename)
+    try:
+        pos = 0
+        while 1:
+            chunk = reader.read()
+            if not chunk:
+                return pos == len(content)
+            if chunk != content[pos:pos+len(chunk)]:
+                return False
+            pos += len(chunk)
+    finally:
+        reader.close()
+
+def files_equal(filename1, filename2):
+    """
+    Do the two files have the same content?  Reads them a chunk at a
+    time (not at all if their sizes are different).
+    """
+    if os.path.getsize(filename1) != os.path.getsize(filename2):
+        return False
+    reader1 = _FileReader(filename1)
+    try:
+        reader2 = _FileReader(filename2)
+        try:
+            while 1:
+                chunk = reader1.read()
+                if chunk != reader2.read():
+                    return False
+                if not chunk:
+                    return True
+        finally:
+            reader2.close()
+    finally:
+        reader1.close()
+
+def reflink_copy(src, dest):
+    """
+    Copies the file or directory ``src`` to ``dest`` (which must not
+    exist) as copy-on-write clones that share their data with the
+    originals.  This only works on filesystems that support it (like
+    btrfs or XFS) with GNU cp; returns False (leaving nothing behind)
+    if the clone could not be made.
+    """
+    try:
+        returncode, stdout, stderr = popen(
+            ['cp', '-a', '--reflink=always', src, dest],
+            raise_on_returncode=False)
+    except OSError:
+        return False
+    if returncode:
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            shutil.rmtree(dest, True)
+        elif os.path.lexists(dest):
+            os.unlink(dest)
+        return False
+    return True
+
+def format_size(bytes):
+    """
+    ``bytes`` as a short human-readable string, like ``'1.5MB'``
+    """
+    for unit in ['bytes', 'KB', 'MB', 'GB']:
+        if bytes < 1024 or unit == 'GB':
+            break
+        bytes /= 1024.0
+    if unit == 'bytes':
+        return '%i bytes' % bytes
+    return '%.1f%s' % (bytes, unit)
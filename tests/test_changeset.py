@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from cmdutils.log import Logger
+from fassembler.changeset import Changeset
+from fassembler.filemaker import Maker
+
+def make_logger():
+    return Logger([(Logger.DEBUG, open(os.devnull, 'w'))])
+
+class TempDirTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def path(self, *parts):
+        return os.path.join(self.tmp, *parts)
+
+    def read(self, *parts):
+        f = open(self.path(*parts))
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def write(self, filename, content):
+        f = open(filename, 'w')
+        f.write(content)
+        f.close()
+
+class ChangesetTest(TempDirTest):
+
+    def test_rollback(self):
+        changeset = Changeset(self.path('journal'))
+        old = self.path('old.txt')
+        self.write(old, 'old\n')
+        changeset.file_changing(old)
+        os.unlink(old)
+        self.write(old, 'new\n')
+        new_dir = self.path('dir')
+        os.mkdir(new_dir)
+        changeset.dir_created(new_dir)
+        new = self.path('dir', 'new.txt')
+        changeset.file_changing(new)
+        self.write(new, 'new\n')
+        forgotten = []
+        self.assertEqual(changeset.rollback(make_logger(), forgotten.append), 0)
+        self.assertEqual(self.read('old.txt'), 'old\n')
+        self.failIf(os.path.exists(new_dir))
+        self.assertEqual(forgotten, [new_dir])
+        self.assertEqual(changeset.journal, [])
+
+    def test_only_first_version_saved(self):
+        changeset = Changeset(self.path('journal'))
+        filename = self.path('f')
+        self.write(filename, 'first\n')
+        changeset.file_changing(filename)
+        os.unlink(filename)
+        self.write(filename, 'second\n')
+        changeset.file_changing(filename)
+        os.unlink(filename)
+        self.write(filename, 'third\n')
+        self.assertEqual(len(changeset.journal), 1)
+        changeset.rollback(make_logger())
+        self.assertEqual(self.read('f'), 'first\n')
+
+class MakerChangesetTest(TempDirTest):
+
+    def setUp(self):
+        TempDirTest.setUp(self)
+        self.maker = Maker(self.tmp, make_logger(), interactive=True)
+        self.asked = []
+        def ask_difference(dest, *args, **kw):
+            self.asked.append(dest)
+            return True
+        self.maker.ask_difference = ask_difference
+        self.write(self.path('f'), 'old\n')
+
+    def test_conflict_deferred(self):
+        self.maker.begin_changeset()
+        self.maker.ensure_file('f', 'new\n')
+        self.assertEqual(self.read('f'), 'old\n')
+        self.assertEqual(len(self.maker.changeset.conflicts), 1)
+        self.assertEqual(self.asked, [])
+        self.maker.resolve_conflicts()
+        self.assertEqual(self.asked, [self.path('f')])
+        self.assertEqual(self.read('f'), 'new\n')
+        self.assertEqual(self.maker.changeset.conflicts, [])
+        self.maker.commit_changeset()
+        self.assertEqual(self.maker.changeset, None)
+        self.assertEqual(self.read('f'), 'new\n')
+
+    def test_rollback_resolved(self):
+        self.maker.begin_changeset()
+        self.maker.ensure_file('f', 'new\n')
+        self.maker.resolve_conflicts()
+        self.maker.ensure_dir('sub')
+        self.maker.ensure_file('sub/g', 'g\n')
+        self.maker.ensure_file('f', 'newer\n', overwrite=True)
+        self.maker.rollback_changeset()
+        self.assertEqual(self.maker.changeset, None)
+        self.assertEqual(self.read('f'), 'old\n')
+        self.failIf(os.path.exists(self.path('sub')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import re
+import unittest
+
+from cmdutils.log import Logger
+from fassembler.logfilter import LogRules, _classify_each
+from fassembler.tasks import InstallSpec
+
+INFO, DEBUG, NOTIFY = Logger.INFO, Logger.DEBUG, Logger.NOTIFY
+
+lines = [
+    'Installing paster script to /usr/local/env/bin',
+    'Creating /usr/local/env/lib/Foo.egg-link (link to .)',
+    "reading manifest template 'MANIFEST.in'",
+    'foo/bar.py: module references __file__',
+    'zip_safe flag not set; analyzing archive contents...',
+    'foo.bar: module MAY be using inspect.getsource',
+    'Extracting Foo-1.0.tar.gz to /tmp/easy_install-xyz',
+    'create build/Foo-1.0-py2.4.egg',
+    'writing requirements to Foo.egg-info/requires.txt',
+    'writing Foo.egg-info/PKG-INFO',
+    "writing manifest file 'Foo.egg-info/SOURCES.txt'",
+    'running develop',
+    'running build_py',
+    'libImaging/Foo.c:10: warning: unused variable defined but not used',
+    # Matches both a debug and an info regex:
+    'Installing lib.so: warning: x defined but not used script to /env/bin',
+    'Installed /usr/local/env/lib/Foo.egg',
+    'Best match: Foo 1.0',
+    'error: Setup script exited with error',
+    ]
+
+def old_level(line):
+    # The precedence of make_log_filter before LogRules: debug
+    # regexes, then info regexes (so info wins), NOTIFY otherwise.
+    level = NOTIFY
+    if not line.strip():
+        level = DEBUG
+    for regex in InstallSpec.log_filter_debug_regexes:
+        if regex.search(line.strip()):
+            level = DEBUG
+    for regex in InstallSpec.log_filter_info_regexes:
+        if regex.search(line.strip()):
+            level = INFO
+    return level
+
+class LogRulesTest(unittest.TestCase):
+
+    def test_old_precedence(self):
+        rules = LogRules([(INFO, InstallSpec.log_filter_info_regexes),
+                          (DEBUG, InstallSpec.log_filter_debug_regexes)])
+        for line in lines:
+            self.assertEqual(rules.classify(line, NOTIFY), old_level(line),
+                             'Level of %r' % line)
+
+    def test_make_log_filter(self):
+        spec = InstallSpec('Install', 'requirements/test-req.txt')
+        spec.logger = Logger([(Logger.DEBUG, open(os.devnull, 'w'))])
+        log_filter = spec.make_log_filter()
+        for line in lines + ['', '   ']:
+            new_line, level = log_filter(line)
+            self.assertEqual(new_line.strip(), line.strip())
+            self.assertEqual(level, old_level(line), 'Level of %r' % line)
+
+    def test_flags(self):
+        rules = [('first', [re.compile('abc', re.I), 'xyz', r'^\d+$']),
+                 ('second', ['ABC', re.compile('q.r', re.S), re.compile('^end', re.M)])]
+        compiled = [(level, [re.compile(getattr(r, 'pattern', r), getattr(r, 'flags', 0))
+                             for r in regexes])
+                    for level, regexes in rules]
+        log_rules = LogRules(rules)
+        for line in ['ABC', 'abc', 'aBc xyz', 'XYZ', '123', '12a', 'q\nr',
+                     'start\nend', 'nothing', '']:
+            self.assertEqual(log_rules.classify(line, 'none'),
+                             _classify_each(compiled, line, 'none'),
+                             'Level of %r' % line)
+
+    def test_empty_level(self):
+        rules = LogRules([('first', []), ('second', ['x'])])
+        self.assertEqual([level for level, regexes in rules.rules], ['second'])
+        self.assertEqual(rules.classify('x'), 'second')
+        self.assertEqual(rules.classify('y'), None)
+
+if __name__ == '__main__':
+    unittest.main()
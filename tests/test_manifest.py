@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from fassembler.manifest import Manifest, content_hash, manifest_filename, \
+     read_manifest_dirname
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dirname = os.path.join(self.tmp, 'files')
+        self.manifest_dir = os.path.join(self.tmp, 'manifests')
+        os.mkdir(self.dirname)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, content):
+        filename = os.path.join(self.dirname, name)
+        f = open(filename, 'wb')
+        f.write(content)
+        f.close()
+        return os.stat(filename)
+
+    def test_round_trip(self):
+        st = self.write('a.txt', 'content a')
+        source = ('/src/a.txt', 9, 1234567890.25)
+        manifest = Manifest(self.dirname, self.manifest_dir)
+        manifest.record('a.txt', st, content_hash('content a'), source=source)
+        manifest.save()
+        filename = manifest_filename(self.manifest_dir, self.dirname)
+        self.assertEqual(manifest.filename, filename)
+        self.assert_(os.path.exists(filename))
+        self.assertEqual(read_manifest_dirname(filename), self.dirname)
+        loaded = Manifest(self.dirname, self.manifest_dir)
+        entry = loaded.lookup('a.txt', st)
+        self.assertNotEqual(entry, None)
+        self.assertEqual(entry['md5'], content_hash('content a'))
+        self.assertEqual(entry['source'], source)
+        self.failIf(loaded.dirty)
+
+    def test_stat_change_invalidates(self):
+        st = self.write('a.txt', 'content a')
+        manifest = Manifest(self.dirname, self.manifest_dir)
+        manifest.record('a.txt', st, content_hash('content a'))
+        manifest.save()
+        new_st = self.write('a.txt', 'content a, changed')
+        self.assertEqual(Manifest(self.dirname, self.manifest_dir).lookup(
+            'a.txt', new_st), None)
+        # The same size, only a different mtime:
+        filename = os.path.join(self.dirname, 'a.txt')
+        os.utime(filename, (time.time(), st.st_mtime + 10))
+        self.assertEqual(manifest.lookup('a.txt', os.stat(filename)), None)
+
+    def test_record_keeps_source(self):
+        st = self.write('a.txt', 'content a')
+        manifest = Manifest(self.dirname)
+        source = ('/src/a.txt', 9, 1.5)
+        manifest.record('a.txt', st, content_hash('content a'), source=source)
+        manifest.record('a.txt', st, content_hash('content a'))
+        self.assertEqual(manifest.lookup('a.txt', st)['source'], source)
+        manifest.record('a.txt', st, content_hash('other'))
+        self.assertEqual(manifest.lookup('a.txt', st)['source'], None)
+
+    def test_forget_and_save(self):
+        st = self.write('a.txt', 'content a')
+        manifest = Manifest(self.dirname, self.manifest_dir)
+        manifest.record('a.txt', st, content_hash('content a'))
+        manifest.save()
+        manifest.forget('a.txt')
+        self.assert_(manifest.dirty)
+        manifest.save()
+        self.assertEqual(Manifest(self.dirname, self.manifest_dir).entries, {})
+
+    def test_no_manifest_dir(self):
+        st = self.write('a.txt', 'content a')
+        manifest = Manifest(self.dirname)
+        manifest.record('a.txt', st, content_hash('content a'))
+        manifest.save()
+        self.failIf(os.path.exists(self.manifest_dir))
+
+    def test_missing_dirname(self):
+        manifest = Manifest(os.path.join(self.tmp, 'gone'), self.manifest_dir)
+        manifest.record('a.txt', os.stat(self.dirname), content_hash(''))
+        manifest.save()
+        self.failIf(manifest.dirty)
+        self.failIf(os.path.exists(self.manifest_dir))
+
+if __name__ == '__main__':
+    unittest.main()
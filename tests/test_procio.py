@@ -0,0 +1,99 @@
+import os
+import subprocess
+import time
+import unittest
+
+from cmdutils.log import Logger
+from fassembler.filemaker import Maker
+from fassembler.procio import OutputBuffer, TimeoutExpired, communicate
+
+def popen(script, **kw):
+    return subprocess.Popen(['sh', '-c', script], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            **kw)
+
+class CommunicateTest(unittest.TestCase):
+
+    def test_lines(self):
+        lines = []
+        proc = popen('cat; echo err >&2')
+        stdout, stderr = communicate(proc, input='a\nb\nc', stdout_lines=lines.append)
+        self.assertEqual(stdout, 'a\nb\nc')
+        self.assertEqual(stderr, 'err\n')
+        self.assertEqual(lines, ['a\n', 'b\n', 'c'])
+        self.assertEqual(proc.returncode, 0)
+
+    def test_timeout(self):
+        proc = popen('echo started; exec sleep 30', preexec_fn=os.setpgrp)
+        start = time.time()
+        try:
+            communicate(proc, timeout=1, grace_period=1)
+        except TimeoutExpired, e:
+            self.assertEqual(e.timeout, 1)
+            self.assertEqual(e.stdout, 'started\n')
+        else:
+            self.fail('No TimeoutExpired raised')
+        self.assert_(time.time() - start < 10)
+        self.assertNotEqual(proc.returncode, None)
+
+    def test_timeout_closed_output(self):
+        # The output is closed, but the process is still running:
+        proc = popen('exec sleep 30 >&- 2>&-', preexec_fn=os.setpgrp)
+        self.assertRaises(TimeoutExpired, communicate, proc,
+                          timeout=1, grace_period=1)
+        self.assertNotEqual(proc.returncode, None)
+
+    def test_max_output(self):
+        proc = popen('i=0; while [ $i -lt 1000 ]; do echo line $i; i=$((i+1)); done')
+        lines = []
+        stdout, stderr = communicate(proc, stdout_lines=lines.append, max_output=100)
+        self.assertEqual(len(lines), 1000)
+        self.assert_(stdout.startswith('line 0\n'))
+        self.assert_(stdout.endswith('line 999\n'))
+        kept = stdout.split('\n[... ')
+        self.assertEqual(len(kept), 2)
+        dropped, tail = kept[1].split(' bytes of output not kept ...]\n')
+        self.assertEqual(len(kept[0]) + len(tail), 100)
+        self.assertEqual(len(kept[0]) + int(dropped) + len(tail),
+                         len(''.join(lines)))
+
+class OutputBufferTest(unittest.TestCase):
+
+    def test_unbounded(self):
+        buffer = OutputBuffer()
+        for i in range(100):
+            buffer.write('x' * 100)
+        self.assertEqual(buffer.getvalue(), 'x' * 10000)
+
+    def test_bounded(self):
+        buffer = OutputBuffer(10)
+        for c in 'abcdefghijklmnopqrstuvwxyz':
+            buffer.write(c)
+        self.assertEqual(buffer.getvalue(),
+                         'abcde\n[... 16 bytes of output not kept ...]\nvwxyz')
+
+class RunCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        logger = Logger([(Logger.DEBUG, open(os.devnull, 'w'))])
+        self.maker = Maker(os.getcwd(), logger, interactive=False)
+
+    def test_full_output(self):
+        output = self.maker.run_command(
+            ['sh', '-c', 'i=0; while [ $i -lt 20000 ]; do echo line $i; i=$((i+1)); done'])
+        self.assertEqual(len(output.splitlines()), 20000)
+
+    def test_log_filter_raises(self):
+        def log_filter(line):
+            raise ValueError('bad filter')
+        for timeout in None, 30:
+            self.maker.command_timeout = timeout
+            start = time.time()
+            self.assertRaises(ValueError, self.maker.run_command,
+                              ['sh', '-c', 'echo hi; exec sleep 30'],
+                              log_filter=log_filter)
+            self.assert_(time.time() - start < 20)
+            self.assertNotEqual(self.maker.command_stats[-1].returncode, None)
+
+if __name__ == '__main__':
+    unittest.main()
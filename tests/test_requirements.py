@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from fassembler.requirements import Requirements, parse_editable, \
+     read_requirements
+
+class ParseTest(unittest.TestCase):
+
+    def parse(self, text):
+        requirements = Requirements('test-req.txt')
+        requirements.parse(text.splitlines(True))
+        return requirements
+
+    def test_settings(self):
+        req = self.parse('''\
+# A comment
+a = 1
+empty =
+b=
+multi =
+   line 2
+   line 3
+c = x == y
+Package==1.0
+Foo>=2
+Bar <= 3
+''')
+        self.assertEqual(req.settings, {
+            'a': '1', 'empty': '', 'b': '', 'multi': '\nline 2\nline 3',
+            'c': 'x == y'})
+        self.assertEqual(req.requirements, ['Package==1.0', 'Foo>=2', 'Bar <= 3'])
+        self.assertEqual(req.editables, [])
+
+    def test_repeated_setting(self):
+        req = self.parse('a = 1\na = 2\n')
+        self.assertEqual(req.settings, {'a': '1\n2'})
+
+    def test_options(self):
+        req = self.parse('''\
+-f http://example.com/dist
+--find-links=http://example.com/other
+-Z
+-e svn+http://svn.example.com/Foo/trunk#egg=Foo
+--editable=svn+http://svn.example.com/Bar/trunk
+Baz
+''')
+        self.assertEqual(req.find_links, ['http://example.com/dist',
+                                          'http://example.com/other'])
+        self.assert_(req.always_unzip)
+        self.assertEqual(req.entries, [
+            ('editable', 'svn+http://svn.example.com/Foo/trunk#egg=Foo'),
+            ('editable', 'svn+http://svn.example.com/Bar/trunk'),
+            ('requirement', 'Baz')])
+
+    def test_parse_editable(self):
+        self.assertEqual(parse_editable('http://svn.example.com/Foo/trunk@123'),
+                         ('http://svn.example.com/Foo/trunk', '123', 'foo'))
+        self.assertEqual(parse_editable('http://svn.example.com/Foo/tags/1.0'),
+                         ('http://svn.example.com/Foo/tags/1.0', None, 'foo'))
+        self.assertEqual(parse_editable('http://svn.example.com/x/y#egg=Bar'),
+                         ('http://svn.example.com/x/y', None, 'bar'))
+        self.assertRaises(ValueError, parse_editable, 'http://svn.example.com/x/y')
+
+class ReadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp, 'test-req.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, content):
+        f = open(self.filename, 'w')
+        f.write(content)
+        f.close()
+
+    def test_read(self):
+        self.assertEqual(read_requirements(self.filename), None)
+        self.write('a = 1\nFoo\n')
+        req = read_requirements(self.filename)
+        self.assertEqual(req.settings, {'a': '1'})
+        self.assert_(read_requirements(self.filename) is req)
+        self.write('a = 22\nFoo\nBar\n')
+        req = read_requirements(self.filename)
+        self.assertEqual(req.settings, {'a': '22'})
+        self.assertEqual(req.requirements, ['Foo', 'Bar'])
+
+if __name__ == '__main__':
+    unittest.main()